@@ -0,0 +1,271 @@
+"""HTTP response helpers: file delivery and conditional GET validators"""
+
+import os
+import uuid
+from email.utils import formatdate, parsedate_to_datetime
+from pathlib import Path
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+
+import aiofiles
+from fastapi import Request, Response
+from fastapi.responses import FileResponse, StreamingResponse
+
+from app.config import settings
+
+
+def stat_etag(stat_result: os.stat_result, variant: str = "") -> str:
+    """Strong ETag for a stored object (objects are only ever replaced atomically)."""
+    tag = f"{stat_result.st_size:x}-{stat_result.st_mtime_ns:x}"
+    return f'"{tag}-{variant}"' if variant else f'"{tag}"'
+
+
+def cache_headers(etag: str, stat_result: os.stat_result) -> dict:
+    return {
+        "ETag": etag,
+        "Last-Modified": formatdate(stat_result.st_mtime, usegmt=True),
+        "Cache-Control": f"private, max-age={settings.HTTP_CACHE_MAX_AGE}, must-revalidate",
+    }
+
+
+def etag_matches(request: Request, etag: str) -> bool:
+    """Whether the request's If-None-Match includes ``etag``."""
+    candidates = [tag.strip() for tag in request.headers.get("if-none-match", "").split(",")]
+    return "*" in candidates or etag in candidates or f"W/{etag}" in candidates
+
+
+def is_not_modified(request: Request, etag: str, stat_result: os.stat_result) -> bool:
+    """Evaluate If-None-Match / If-Modified-Since against the stored object."""
+    if request.headers.get("if-none-match") is not None:
+        return etag_matches(request, etag)
+
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since:
+        try:
+            since = parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+        return int(stat_result.st_mtime) <= since
+    return False
+
+
+def not_modified(etag: str, stat_result: os.stat_result) -> Response:
+    return Response(status_code=304, headers=cache_headers(etag, stat_result))
+
+
+def file_response(
+    request: Request,
+    path: Path,
+    media_type: str,
+    filename: Optional[str] = None,
+) -> Response:
+    """Serve a stored file with validators, 304 handling and Range support.
+
+    The body is sent by Starlette's FileResponse, which honours Range/If-Range
+    and hands the path to the server (pathsend) when it supports zero-copy.
+    """
+    stat_result = os.stat(path)
+    etag = stat_etag(stat_result)
+
+    if is_not_modified(request, etag, stat_result):
+        return not_modified(etag, stat_result)
+
+    return FileResponse(
+        path,
+        media_type=media_type,
+        filename=filename,
+        stat_result=stat_result,
+        headers=cache_headers(etag, stat_result),
+    )
+
+
+
+def encoding_etag(etag: str, encoding: str) -> str:
+    """The strong ETag of one content-coding of a representation: different bytes, different validator."""
+    if encoding == "identity":
+        return etag
+    return f'{etag[:-1]}-{encoding}"' if etag.endswith('"') else f"{etag}-{encoding}"
+
+
+def precompressed_response(request: Request, path: Path, media_type: str, etag: str, encoding: str) -> Response:
+    """Serve a pre-encoded file variant with a per-encoding content ETag and Vary: Accept-Encoding.
+
+    ``etag`` is the validator of the identity body.
+    """
+    etag = encoding_etag(etag, encoding)
+    headers = {
+        "ETag": etag,
+        "Vary": "Accept-Encoding",
+        "Cache-Control": f"private, max-age={settings.HTTP_CACHE_MAX_AGE}, must-revalidate",
+    }
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers=headers)
+    if encoding != "identity":
+        headers["Content-Encoding"] = encoding
+    return FileResponse(path, media_type=media_type, headers=headers)
+
+
+def parse_single_range(range_header: Optional[str], size: int) -> Optional[Tuple[int, int]]:
+    """Parse a single ``bytes=`` range into an inclusive (start, end) pair.
+
+    Returns None when there is no usable single range (the full body is sent).
+    Raises ValueError when the range is unsatisfiable.
+    """
+    if not range_header or not range_header.startswith("bytes=") or "," in range_header:
+        return None
+    start_text, _, end_text = range_header[6:].strip().partition("-")
+    try:
+        if start_text:
+            start = int(start_text)
+            end = int(end_text) if end_text else size - 1
+        else:
+            start = max(size - int(end_text), 0)
+            end = size - 1
+    except ValueError:
+        return None
+    if start >= size or start > end:
+        raise ValueError("Range not satisfiable")
+    return start, min(end, size - 1)
+
+
+async def _file_slice_chunks(path: Path, offset: int, length: int) -> AsyncIterator[bytes]:
+    async with aiofiles.open(path, "rb") as f:
+        await f.seek(offset)
+        while length > 0:
+            chunk = await f.read(min(MULTIPART_CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+
+
+def file_slice_response(
+    request: Request,
+    path: Path,
+    offset: int,
+    length: int,
+    media_type: str,
+    variant: str,
+) -> Response:
+    """Stream ``length`` bytes at ``offset`` of a stored file, with Range and validators."""
+    stat_result = os.stat(path)
+    etag = stat_etag(stat_result, variant)
+
+    if is_not_modified(request, etag, stat_result):
+        return not_modified(etag, stat_result)
+
+    headers = cache_headers(etag, stat_result)
+    headers["Accept-Ranges"] = "bytes"
+
+    try:
+        byte_range = parse_single_range(request.headers.get("range"), length)
+    except ValueError:
+        return Response(status_code=416, headers={"Content-Range": f"bytes */{length}"})
+
+    if request.headers.get("if-range") not in (None, etag):
+        byte_range = None
+
+    if byte_range is None:
+        headers["Content-Length"] = str(length)
+        return StreamingResponse(_file_slice_chunks(path, offset, length), media_type=media_type, headers=headers)
+
+    start, end = byte_range
+    headers["Content-Range"] = f"bytes {start}-{end}/{length}"
+    headers["Content-Length"] = str(end - start + 1)
+    return StreamingResponse(
+        _file_slice_chunks(path, offset + start, end - start + 1),
+        status_code=206,
+        media_type=media_type,
+        headers=headers,
+    )
+
+
+# ==================== multipart/related ====================
+
+MULTIPART_CHUNK_SIZE = 64 * 1024
+
+
+def parse_accept(accept: Optional[str]) -> List[Tuple[str, Dict[str, str]]]:
+    """Split an Accept header into (media type, parameters) ranges."""
+    ranges = []
+    for media_range in (accept or "").split(","):
+        pieces = [piece.strip() for piece in media_range.split(";")]
+        if not pieces[0]:
+            continue
+        params = {}
+        for piece in pieces[1:]:
+            if "=" in piece:
+                key, value = piece.split("=", 1)
+                params[key.strip().lower()] = value.strip().strip('"')
+        ranges.append((pieces[0].lower(), params))
+    return ranges
+
+
+def accepts_encoding(accept_encoding: Optional[str], encoding: str) -> bool:
+    """Whether an Accept-Encoding header allows ``encoding``."""
+    for token in (accept_encoding or "").split(","):
+        name, _, params = token.partition(";")
+        if name.strip().lower() in (encoding, "*"):
+            return params.replace(" ", "").lower() not in ("q=0", "q=0.0", "q=0.00", "q=0.000")
+    return False
+
+
+def negotiate_media_type(accept: Optional[str], supported: List[str]) -> Optional[str]:
+    """First of ``supported`` acceptable to the client (the first one if there is no Accept)."""
+    ranges = parse_accept(accept)
+    if not ranges:
+        return supported[0]
+    for media_type, params in ranges:
+        if params.get("q") in ("0", "0.0"):
+            continue
+        for candidate in supported:
+            if media_type in (candidate, "*/*", candidate.split("/")[0] + "/*"):
+                return candidate
+    return None
+
+
+def requested_transfer_syntax(accept: Optional[str], part_type: str) -> Optional[str]:
+    """Return the transfer-syntax asked for with ``part_type``, ``"*"``, or None if unspecified."""
+    for media_type, params in parse_accept(accept):
+        if media_type == "multipart/related":
+            if params.get("type", part_type).lower() != part_type:
+                continue
+        elif media_type not in (part_type, "*/*"):
+            continue
+        if "transfer-syntax" in params:
+            return params["transfer-syntax"]
+    return None
+
+
+async def file_chunks(path: Path) -> AsyncIterator[bytes]:
+    async with aiofiles.open(path, "rb") as f:
+        while True:
+            chunk = await f.read(MULTIPART_CHUNK_SIZE)
+            if not chunk:
+                break
+            yield chunk
+
+
+async def _multipart_body(parts: AsyncIterator[Tuple[str, AsyncIterator[bytes]]], boundary: str):
+    async for content_type, chunks in parts:
+        yield f"--{boundary}\r\nContent-Type: {content_type}\r\n\r\n".encode()
+        async for chunk in chunks:
+            yield chunk
+        yield b"\r\n"
+    yield f"--{boundary}--\r\n".encode()
+
+
+def multipart_response(
+    parts: AsyncIterator[Tuple[str, AsyncIterator[bytes]]],
+    part_type: str,
+    transfer_syntax: Optional[str] = None,
+) -> StreamingResponse:
+    """Stream ``(content type, chunks)`` parts as a multipart/related body.
+
+    Parts are produced lazily, so only one chunk of one part is in memory
+    at a time regardless of how many parts there are.
+    """
+    boundary = uuid.uuid4().hex
+    media_type = f'multipart/related; type="{part_type}"; boundary={boundary}'
+    if transfer_syntax:
+        media_type += f"; transfer-syntax={transfer_syntax}"
+    return StreamingResponse(_multipart_body(parts, boundary), media_type=media_type)
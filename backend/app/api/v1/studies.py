@@ -1,89 +1,58 @@
 """Study-level API endpoints"""
 
-from fastapi import APIRouter, HTTPException
-from pathlib import Path
+from fastapi import APIRouter, HTTPException, Query, Request
 from typing import List, Dict, Any
 
-from app.config import settings
-from app.services.dicom_parser import DICOMParserService
+from app.services.executor import blocking_executor
+from app.services.frame_scheduler import ViewportHint, frame_scheduler, viewer_id
+from app.services.lifecycle import storage_lifecycle
+from app.services.metadata_index import metadata_index
+from app.services.storage import is_valid_uid
 
 router = APIRouter()
-parser = DICOMParserService()
 
 
 @router.get("/")
-async def list_studies() -> List[Dict[str, Any]]:
-    """List all available studies."""
-    
-    studies = []
-    storage_path = settings.STORAGE_PATH
-    
-    if not storage_path.exists():
-        return []
-    
-    for study_dir in storage_path.iterdir():
-        if study_dir.is_dir():
-            study_uid = study_dir.name
-            
-            # Get first DICOM file for metadata
-            first_file = None
-            series_count = 0
-            instance_count = 0
-            
-            for series_dir in study_dir.iterdir():
-                if series_dir.is_dir():
-                    series_count += 1
-                    for dcm_file in series_dir.glob("*.dcm"):
-                        instance_count += 1
-                        if first_file is None:
-                            first_file = dcm_file
-            
-            if first_file:
-                metadata = parser.parse_file(first_file)
-                studies.append({
-                    "study_instance_uid": study_uid,
-                    "patient_name": metadata.get("patient_name"),
-                    "patient_id": metadata.get("patient_id"),
-                    "study_date": metadata.get("study_date"),
-                    "study_description": metadata.get("study_description"),
-                    "modality": metadata.get("modality"),
-                    "series_count": series_count,
-                    "instance_count": instance_count,
-                })
-    
-    return studies
+async def list_studies(
+    limit: int = Query(1000, ge=1, le=10000),
+    offset: int = Query(0, ge=0),
+) -> List[Dict[str, Any]]:
+    """List available studies from the metadata index."""
+    
+    studies = await blocking_executor.run_io(metadata_index.search_studies, limit=limit, offset=offset)
+    
+    return [
+        {
+            "study_instance_uid": study["study_instance_uid"],
+            "patient_name": study["patient_name"],
+            "patient_id": study["patient_id"],
+            "study_date": study["study_date"],
+            "study_description": study["study_description"],
+            "modality": study["modality"],
+            "series_count": study["series_count"],
+            "instance_count": study["instance_count"],
+        }
+        for study in studies
+    ]
 
 
 @router.get("/{study_uid}")
 async def get_study(study_uid: str) -> Dict[str, Any]:
     """Get study details including all series."""
     
-    study_path = settings.STORAGE_PATH / study_uid
-    
-    if not study_path.exists():
+    if await blocking_executor.run_io(metadata_index.get_study, study_uid) is None:
         raise HTTPException(status_code=404, detail="Study not found")
     
-    series_list = []
-    
-    for series_dir in study_path.iterdir():
-        if series_dir.is_dir():
-            series_uid = series_dir.name
-            instances = list(series_dir.glob("*.dcm"))
-            
-            if instances:
-                # Get series metadata from first instance
-                metadata = parser.parse_file(instances[0])
-                
-                series_list.append({
-                    "series_instance_uid": series_uid,
-                    "series_description": metadata.get("series_description"),
-                    "series_number": metadata.get("series_number"),
-                    "modality": metadata.get("modality"),
-                    "instance_count": len(instances),
-                })
-    
-    # Sort by series number
-    series_list.sort(key=lambda x: x.get("series_number") or 0)
+    series_list = [
+        {
+            "series_instance_uid": series["series_instance_uid"],
+            "series_description": series["series_description"],
+            "series_number": series["series_number"],
+            "modality": series["modality"],
+            "instance_count": series["instance_count"],
+        }
+        for series in await blocking_executor.run_io(metadata_index.list_series, study_uid)
+    ]
     
     return {
         "study_instance_uid": study_uid,
@@ -92,28 +61,34 @@ async def get_study(study_uid: str) -> Dict[str, Any]:
 
 
 @router.get("/{study_uid}/series/{series_uid}")
-async def get_series(study_uid: str, series_uid: str) -> Dict[str, Any]:
-    """Get series details including all instances."""
+async def get_series(request: Request, study_uid: str, series_uid: str) -> Dict[str, Any]:
+    """Get series details including all instances.
     
-    series_path = settings.STORAGE_PATH / study_uid / series_uid
+    The viewer asks for the first frames next: they are decoded ahead of time.
+    """
     
-    if not series_path.exists():
-        raise HTTPException(status_code=404, detail="Series not found")
+    series = await blocking_executor.run_io(metadata_index.get_series, series_uid)
     
-    instances = []
+    if series is None or series["study_instance_uid"] != study_uid:
+        raise HTTPException(status_code=404, detail="Series not found")
     
-    for dcm_file in sorted(series_path.glob("*.dcm")):
-        metadata = parser.parse_file(dcm_file)
-        instances.append({
+    instances = [
+        {
             "sop_instance_uid": metadata["sop_instance_uid"],
             "instance_number": metadata.get("instance_number"),
             "image_position_patient": metadata.get("image_position_patient"),
             "rows": metadata.get("rows"),
             "columns": metadata.get("columns"),
-        })
+        }
+        for metadata in await blocking_executor.run_io(metadata_index.list_instances, study_uid, series_uid)
+    ]
     
-    # Sort by instance number or image position
-    instances.sort(key=lambda x: x.get("instance_number") or 0)
+    await frame_scheduler.open_series(
+        viewer_id(request.headers, request.client.host if request.client else None),
+        study_uid,
+        series_uid,
+        ViewportHint.from_headers(request.headers),
+    )
     
     return {
         "study_instance_uid": study_uid,
@@ -124,14 +99,12 @@ async def get_series(study_uid: str, series_uid: str) -> Dict[str, Any]:
 
 @router.delete("/{study_uid}")
 async def delete_study(study_uid: str):
-    """Delete a study and all its files."""
+    """Delete a study; it disappears at once and its files are reclaimed in the background."""
     
-    study_path = settings.STORAGE_PATH / study_uid
+    if not is_valid_uid(study_uid):
+        raise HTTPException(status_code=400, detail="Invalid Study Instance UID")
     
-    if not study_path.exists():
+    if not await blocking_executor.run_io(storage_lifecycle.delete_study, study_uid):
         raise HTTPException(status_code=404, detail="Study not found")
     
-    import shutil
-    shutil.rmtree(study_path)
-    
     return {"message": f"Study {study_uid} deleted"}
@@ -1,72 +1,74 @@
 """DICOM file upload endpoints"""
 
-from fastapi import APIRouter, UploadFile, File, HTTPException
-from fastapi.responses import JSONResponse
-from typing import List
-import aiofiles
-from pathlib import Path
-import uuid
+from fastapi import APIRouter, HTTPException, Request
 
-from app.config import settings
-from app.services.dicom_parser import DICOMParserService
+from app.services.executor import blocking_executor
+from app.services.ingest import IngestError, ingest_service
+from app.services.ingest_jobs import ingest_pipeline
 
 router = APIRouter()
-parser = DICOMParserService()
 
+# Uploads are parsed from the raw request stream, so describe the form for the docs by hand
+UPLOAD_OPENAPI = {
+    "requestBody": {
+        "required": True,
+        "content": {
+            "multipart/form-data": {
+                "schema": {
+                    "type": "object",
+                    "properties": {
+                        "files": {"type": "array", "items": {"type": "string", "format": "binary"}},
+                    },
+                    "required": ["files"],
+                },
+            },
+        },
+    },
+}
 
-@router.post("/")
-async def upload_dicom_files(files: List[UploadFile] = File(...)):
-    """Upload one or more DICOM files."""
+
+@router.post("/", openapi_extra=UPLOAD_OPENAPI)
+async def upload_dicom_files(request: Request):
+    """Upload one or more DICOM files.
+    
+    Each file part is streamed to a staging file on the storage volume,
+    only its header is parsed, and it is then renamed into place.
+    """
+    
+    try:
+        staged_files = await ingest_service.receive(request.headers.get("content-type", ""), request.stream())
+    except IngestError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    return await blocking_executor.run_io(ingest_service.commit_all, staged_files)
+
+
+@router.post("/folder", status_code=202, openapi_extra=UPLOAD_OPENAPI)
+async def upload_dicom_folder(request: Request):
+    """Upload multiple DICOM files from a folder selection.
+    
+    The files are staged while the body is received; parsing, validation
+    and indexing then run in the background ingestion pipeline. Poll
+    ``/upload/jobs/{job_id}`` for progress.
+    """
     
-    results = []
-    errors = []
+    try:
+        staged_files = await ingest_service.receive(request.headers.get("content-type", ""), request.stream())
+    except IngestError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     
-    for file in files:
-        try:
-            # Read file content
-            content = await file.read()
-            
-            # Parse DICOM to extract metadata
-            metadata = parser.parse_bytes(content)
-            
-            if not metadata:
-                errors.append({"filename": file.filename, "error": "Invalid DICOM file"})
-                continue
-            
-            # Organize by Study/Series/Instance
-            study_uid = metadata["study_instance_uid"]
-            series_uid = metadata["series_instance_uid"]
-            sop_uid = metadata["sop_instance_uid"]
-            
-            # Create directory structure
-            study_dir = settings.STORAGE_PATH / study_uid / series_uid
-            study_dir.mkdir(parents=True, exist_ok=True)
-            
-            # Save file
-            file_path = study_dir / f"{sop_uid}.dcm"
-            async with aiofiles.open(file_path, "wb") as f:
-                await f.write(content)
-            
-            results.append({
-                "filename": file.filename,
-                "study_uid": study_uid,
-                "series_uid": series_uid,
-                "sop_uid": sop_uid,
-                "metadata": metadata,
-            })
-            
-        except Exception as e:
-            errors.append({"filename": file.filename, "error": str(e)})
+    job = ingest_pipeline.submit(staged_files)
     
-    return {
-        "uploaded": len(results),
-        "failed": len(errors),
-        "results": results,
-        "errors": errors,
-    }
+    return job.to_dict()
 
 
-@router.post("/folder")
-async def upload_dicom_folder(files: List[UploadFile] = File(...)):
-    """Upload multiple DICOM files from a folder selection."""
-    return await upload_dicom_files(files)
+@router.get("/jobs/{job_id}")
+async def get_ingest_job(job_id: str):
+    """Get the progress of a background folder ingestion."""
+    
+    job = ingest_pipeline.get_job(job_id)
+    
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    
+    return job.to_dict()
@@ -1,163 +1,213 @@
 """DICOMweb WADO-RS and QIDO-RS endpoints for Cornerstone3D"""
 
-from fastapi import APIRouter, HTTPException, Response, Query
+from fastapi import APIRouter, Depends, HTTPException, Request, Response, Query, Header
 from fastapi.responses import StreamingResponse
 from pathlib import Path
-from typing import Optional
+from pydicom.uid import UID, ExplicitVRLittleEndian
+from typing import List, Optional
+import aiofiles
+import hashlib
 import io
 import json
+import math
+import os
 
+from app.api.v1.responses import (
+    accepts_encoding,
+    cache_headers,
+    etag_matches,
+    file_chunks,
+    file_response,
+    file_slice_response,
+    is_not_modified,
+    multipart_response,
+    negotiate_media_type,
+    not_modified,
+    parse_accept,
+    precompressed_response,
+    requested_transfer_syntax,
+    stat_etag,
+)
 from app.config import settings
 from app.services.dicom_parser import DICOMParserService
+from app.services.executor import blocking_executor
+from app.services.frame_scheduler import ViewportHint, frame_scheduler, viewer_id
+from app.services.lifecycle import storage_lifecycle
+from app.services.metadata_documents import metadata_documents
+from app.services.metadata_index import metadata_index
+from app.services.pacs_proxy import PacsError, pacs_proxy
+from app.services.profiling import timed_stage
+from app.services.pyramid import pyramid_service
+from app.services.qido import QidoError, qido_engine
+from app.services.reformat import ReformatError, reformat_service
+from app.services.renderer import RENDERED_MEDIA_TYPES, VOI_FUNCTIONS, render_service
+from app.services.storage import IntegrityError, instance_store
+from app.services.transcoder import UNCOMPRESSED_SYNTAXES, frame_content_type, frame_transcoder
+from app.services.volume import VolumeError, encode_header, volume_service
 
 router = APIRouter()
 parser = DICOMParserService()
 
-
 # ==================== QIDO-RS Endpoints ====================
 
-@router.get("/studies")
-async def search_studies(
-    PatientID: Optional[str] = Query(None),
-    PatientName: Optional[str] = Query(None),
-    StudyDate: Optional[str] = Query(None),
-    limit: int = Query(100, le=1000),
-    offset: int = Query(0),
-):
-    """QIDO-RS: Search for studies."""
-    
-    storage_path = settings.STORAGE_PATH
-    
-    if not storage_path.exists():
-        return Response(content="[]", media_type="application/dicom+json")
-    
-    studies = []
-    
-    for study_dir in storage_path.iterdir():
-        if not study_dir.is_dir():
-            continue
-            
-        # Find first DICOM file to extract study metadata
-        study_metadata = None
-        for series_dir in study_dir.iterdir():
-            if series_dir.is_dir():
-                for dcm_file in series_dir.glob("*.dcm"):
-                    try:
-                        study_metadata = parser.parse_file(dcm_file)
-                        break
-                    except:
-                        continue
-            if study_metadata:
-                break
-        
-        if not study_metadata:
-            continue
-            
-        # Apply filters
-        if PatientID and PatientID not in study_metadata.get("patient_id", ""):
-            continue
-        if PatientName and PatientName.lower() not in study_metadata.get("patient_name", "").lower():
-            continue
-        if StudyDate and StudyDate != study_metadata.get("study_date", ""):
-            continue
-        
-        # Count series and instances
-        series_count = sum(1 for d in study_dir.iterdir() if d.is_dir())
-        instance_count = sum(
-            len(list(s.glob("*.dcm"))) 
-            for s in study_dir.iterdir() 
-            if s.is_dir()
+async def _qido_response(request: Request, level: str, study_uid: Optional[str] = None, series_uid: Optional[str] = None):
+    """Run a QIDO-RS query from the request's query parameters."""
+    try:
+        results = await blocking_executor.run_io(
+            qido_engine.search, level, request.query_params.multi_items(), study_uid, series_uid
         )
-        
-        studies.append({
-            "0020000D": {"vr": "UI", "Value": [study_metadata.get("study_instance_uid", "")]},
-            "00100010": {"vr": "PN", "Value": [{"Alphabetic": study_metadata.get("patient_name", "")}]},
-            "00100020": {"vr": "LO", "Value": [study_metadata.get("patient_id", "")]},
-            "00080020": {"vr": "DA", "Value": [study_metadata.get("study_date", "")]},
-            "00080030": {"vr": "TM", "Value": [study_metadata.get("study_time", "")]},
-            "00080050": {"vr": "SH", "Value": [study_metadata.get("accession_number", "")]},
-            "00080061": {"vr": "CS", "Value": [study_metadata.get("modality", "")]},
-            "00081030": {"vr": "LO", "Value": [study_metadata.get("study_description", "")]},
-            "00201206": {"vr": "IS", "Value": [series_count]},
-            "00201208": {"vr": "IS", "Value": [instance_count]},
-        })
-    
-    # Apply pagination
-    paginated = studies[offset:offset + limit]
+    except QidoError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    # Studies not archived here are answered from the PACS (first page only: PACS results are not paged)
+    if pacs_proxy.enabled and int(request.query_params.get("offset", 0)) == 0:
+        try:
+            remote = await blocking_executor.run_io(
+                pacs_proxy.search, level, request.query_params.multi_items(), study_uid, series_uid
+            )
+        except PacsError:
+            remote = []  # the local results still answer the query
+        local = {result["00081190"]["Value"][0] for result in results}
+        remote = [result for result in remote if result["00081190"]["Value"][0] not in local]
+        results += remote[: max(0, int(request.query_params.get("limit", 100)) - len(results))]
     
     return Response(
-        content=json.dumps(paginated),
+        content=json.dumps(results),
         media_type="application/dicom+json",
     )
 
 
+@router.get("/studies")
+async def search_studies(
+    request: Request,
+    limit: int = Query(100, ge=1, le=1000),
+    offset: int = Query(0, ge=0),
+):
+    """QIDO-RS: Search for studies.
+    
+    Any study attribute (keyword or tag) can be matched, with ``*``/``?``
+    wildcards, ``from-to`` date and time ranges and ``\\``-separated UID lists.
+    Supports includefield, fuzzymatching and orderby (e.g. ``-StudyDate``).
+    """
+    return await _qido_response(request, "study")
+
+
+@router.get("/series")
+async def search_all_series(
+    request: Request,
+    limit: int = Query(100, ge=1, le=1000),
+    offset: int = Query(0, ge=0),
+):
+    """QIDO-RS: Search for series across all studies."""
+    return await _qido_response(request, "series")
+
+
 @router.get("/studies/{study_uid}/series")
 async def search_series(
+    request: Request,
     study_uid: str,
-    Modality: Optional[str] = Query(None),
-    SeriesNumber: Optional[int] = Query(None),
+    limit: int = Query(100, ge=1, le=1000),
+    offset: int = Query(0, ge=0),
 ):
     """QIDO-RS: Search for series within a study."""
     
-    study_path = settings.STORAGE_PATH / study_uid
+    if await blocking_executor.run_io(metadata_index.get_study, study_uid) is None and not pacs_proxy.enabled:
+        raise HTTPException(status_code=404, detail="Study not found")
+    
+    return await _qido_response(request, "series", study_uid)
+
+
+@router.get("/instances")
+async def search_all_instances(
+    request: Request,
+    limit: int = Query(100, ge=1, le=1000),
+    offset: int = Query(0, ge=0),
+):
+    """QIDO-RS: Search for instances across all studies."""
+    return await _qido_response(request, "instance")
+
+
+@router.get("/studies/{study_uid}/instances")
+async def search_study_instances(
+    request: Request,
+    study_uid: str,
+    limit: int = Query(100, ge=1, le=1000),
+    offset: int = Query(0, ge=0),
+):
+    """QIDO-RS: Search for instances within a study."""
     
-    if not study_path.exists():
+    if await blocking_executor.run_io(metadata_index.get_study, study_uid) is None and not pacs_proxy.enabled:
         raise HTTPException(status_code=404, detail="Study not found")
     
-    series_list = []
-    
-    for series_dir in study_path.iterdir():
-        if not series_dir.is_dir():
-            continue
-        
-        # Get first DICOM file for series metadata
-        series_metadata = None
-        dcm_files = list(series_dir.glob("*.dcm"))
-        
-        if dcm_files:
-            try:
-                series_metadata = parser.parse_file(dcm_files[0])
-            except:
-                continue
-        
-        if not series_metadata:
-            continue
-        
-        # Apply filters
-        if Modality and Modality != series_metadata.get("modality", ""):
-            continue
-        if SeriesNumber is not None and SeriesNumber != series_metadata.get("series_number"):
-            continue
-        
-        series_list.append({
-            "0020000E": {"vr": "UI", "Value": [series_metadata.get("series_instance_uid", "")]},
-            "0020000D": {"vr": "UI", "Value": [study_uid]},
-            "00080060": {"vr": "CS", "Value": [series_metadata.get("modality", "")]},
-            "0008103E": {"vr": "LO", "Value": [series_metadata.get("series_description", "")]},
-            "00200011": {"vr": "IS", "Value": [series_metadata.get("series_number", 0)]},
-            "00201209": {"vr": "IS", "Value": [len(dcm_files)]},
-        })
+    return await _qido_response(request, "instance", study_uid)
+
+
+@router.get("/studies/{study_uid}/series/{series_uid}/instances")
+async def search_series_instances(
+    request: Request,
+    study_uid: str,
+    series_uid: str,
+    limit: int = Query(100, ge=1, le=1000),
+    offset: int = Query(0, ge=0),
+):
+    """QIDO-RS: Search for instances within a series."""
     
-    return Response(
-        content=json.dumps(series_list),
-        media_type="application/dicom+json",
-    )
+    series = await blocking_executor.run_io(metadata_index.get_series, series_uid)
+    if (series is None or series["study_instance_uid"] != study_uid) and not pacs_proxy.enabled:
+        raise HTTPException(status_code=404, detail="Series not found")
+    
+    return await _qido_response(request, "instance", study_uid, series_uid)
 
 
 # ==================== WADO-RS Endpoints ====================
 
 
-@router.get("/studies/{study_uid}/series/{series_uid}/instances/{sop_uid}/metadata")
-async def get_instance_metadata(study_uid: str, series_uid: str, sop_uid: str):
-    """WADO-RS: Get instance metadata as DICOMweb JSON."""
+async def _local_study(study_uid: str) -> None:
+    """Retrieve the study from the PACS before serving it when it is not archived here."""
+    try:
+        await pacs_proxy.ensure_local(study_uid)
+    except PacsError as e:
+        raise HTTPException(status_code=502, detail=str(e))
+
+
+LOCAL_STUDY = [Depends(_local_study)]
+
+
+async def _verified_path(relative_path: str, content_hash: Optional[str]) -> Path:
+    """Absolute path of a stored file, re-hashed first when VERIFY_CHECKSUMS is on."""
+    if settings.VERIFY_CHECKSUMS:
+        try:
+            await blocking_executor.run_io(instance_store.verify, relative_path, content_hash)
+        except FileNotFoundError:
+            raise HTTPException(status_code=404, detail="Instance not found")
+        except IntegrityError as e:
+            raise HTTPException(status_code=500, detail=str(e))
+    return instance_store.path(relative_path)
+
+
+async def _instance_file(study_uid: str, series_uid: str, sop_uid: str) -> Path:
+    """Stored file of an instance, looked up in the index."""
+    location = await blocking_executor.run_io(metadata_index.get_location, sop_uid)
     
-    file_path = settings.STORAGE_PATH / study_uid / series_uid / f"{sop_uid}.dcm"
+    if location is None or (location["study_instance_uid"], location["series_instance_uid"]) != (study_uid, series_uid):
+        raise HTTPException(status_code=404, detail="Instance not found")
+    
+    await storage_lifecycle.ensure_hot(study_uid)
+    file_path = await _verified_path(location["file_path"], location["content_hash"])
     
-    if not file_path.exists():
+    if not await blocking_executor.run_io(file_path.exists):
         raise HTTPException(status_code=404, detail="Instance not found")
     
-    metadata = parser.parse_file(file_path)
-    dicomweb_json = parser.to_dicomweb_json(file_path)
+    return file_path
+
+
+@router.get("/studies/{study_uid}/series/{series_uid}/instances/{sop_uid}/metadata", dependencies=LOCAL_STUDY)
+async def get_instance_metadata(study_uid: str, series_uid: str, sop_uid: str):
+    """WADO-RS: Get instance metadata as DICOMweb JSON."""
+    
+    file_path = await _instance_file(study_uid, series_uid, sop_uid)
+    
+    dicomweb_json = await blocking_executor.run_io(parser.to_dicomweb_json, file_path, sop_uid)
     
     return Response(
         content=f"[{dicomweb_json}]",
@@ -165,86 +215,579 @@ async def get_instance_metadata(study_uid: str, series_uid: str, sop_uid: str):
     )
 
 
-@router.get("/studies/{study_uid}/series/{series_uid}/instances/{sop_uid}")
-async def get_instance(study_uid: str, series_uid: str, sop_uid: str):
-    """WADO-RS: Get DICOM instance (full file)."""
+@router.get("/studies/{study_uid}/series/{series_uid}/instances/{sop_uid}", dependencies=LOCAL_STUDY)
+async def get_instance(request: Request, study_uid: str, series_uid: str, sop_uid: str):
+    """WADO-RS: Get DICOM instance (full file).
     
-    file_path = settings.STORAGE_PATH / study_uid / series_uid / f"{sop_uid}.dcm"
+    Supports Range requests and conditional GET (ETag / Last-Modified).
+    """
     
-    if not file_path.exists():
-        raise HTTPException(status_code=404, detail="Instance not found")
-    
-    with open(file_path, "rb") as f:
-        content = f.read()
+    file_path = await _instance_file(study_uid, series_uid, sop_uid)
     
-    return Response(
-        content=content,
-        media_type="application/dicom",
-        headers={
-            "Content-Disposition": f'attachment; filename="{sop_uid}.dcm"',
-        },
-    )
+    return file_response(request, file_path, "application/dicom", filename=f"{sop_uid}.dcm")
 
 
-@router.get("/studies/{study_uid}/series/{series_uid}/instances/{sop_uid}/frames/{frame}")
-async def get_frame(study_uid: str, series_uid: str, sop_uid: str, frame: int = 1):
-    """WADO-RS: Get pixel data for a specific frame."""
+@router.get("/studies/{study_uid}/series/{series_uid}/instances/{sop_uid}/frames/{frames}", dependencies=LOCAL_STUDY)
+async def get_frame(
+    request: Request,
+    study_uid: str,
+    series_uid: str,
+    sop_uid: str,
+    frames: str,
+    level: int = Query(0, ge=0, description="Resolution level: 0 is full size, each level halves it"),
+    accept: Optional[str] = Header(None),
+    accept_encoding: Optional[str] = Header(None),
+):
+    """WADO-RS: Get pixel data for one or more frames (e.g. ``/frames/1,2,3``).
+    
+    The transfer syntax is negotiated from the Accept header: compressed
+    frames are passed through as stored when the client accepts the stored
+    syntax (or ``transfer-syntax=*``); otherwise they are decoded and sent
+    uncompressed (gzip-encoded if Accept-Encoding allows) or re-encoded as
+    RLE Lossless (``image/x-dicom-rle``). Several frames, or an Accept of
+    multipart/related, produce a streamed multipart/related body.
+    
+    ``level`` > 0 returns a downsampled frame for progressive display, in
+    the same pixel format at ceil(rows / 2**level) x ceil(columns / 2**level).
+    Levels go down until the longest side is at most 64 pixels.
+    """
+    
+    file_path = await _instance_file(study_uid, series_uid, sop_uid)
+    
+    try:
+        frame_numbers = [int(frame) for frame in frames.split(",")]
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid frame list")
+    
+    multipart = len(frame_numbers) > 1 or "multipart/related" in (accept or "")
+    
+    if level:
+        instance = await blocking_executor.run_io(metadata_index.get_instance, sop_uid)
+        if instance is None:
+            raise HTTPException(status_code=404, detail="Instance not found")
+        level_paths = [
+            await blocking_executor.run_io(pyramid_service.get_level, instance, frame, level)
+            for frame in frame_numbers
+        ]
+        if any(path is None for path in level_paths):
+            raise HTTPException(status_code=404, detail="Frame or resolution level not found")
+        if multipart:
+            return multipart_response(_file_parts(level_paths), "application/octet-stream")
+        return file_response(request, level_paths[0], "application/octet-stream")
+    
+    stored_syntax = await blocking_executor.run_io(parser.get_transfer_syntax, file_path)
+    target_syntax = frame_transcoder.negotiate(parse_accept(accept), stored_syntax)
+    
+    if target_syntax is None:
+        raise HTTPException(status_code=406, detail="No acceptable transfer syntax for this frame")
+    
+    # Decodes are queued by distance from the viewer's position; its neighbours are warmed meanwhile
+    priority = await frame_scheduler.on_frame(
+        viewer_id(request.headers, request.client.host if request.client else None),
+        study_uid,
+        series_uid,
+        sop_uid,
+        frame_numbers[0],
+        ViewportHint.from_headers(request.headers),
+        read_ahead=not (target_syntax == stored_syntax and UID(stored_syntax).is_compressed),
+    )
+    
+    if multipart:
+        number_of_frames = (await blocking_executor.run_io(parser.parse_file, file_path, sop_uid))["number_of_frames"]
+        if any(frame < 1 or frame > number_of_frames for frame in frame_numbers):
+            raise HTTPException(status_code=404, detail="Frame not found")
+        return multipart_response(
+            _frame_parts(file_path, sop_uid, frame_numbers, stored_syntax, target_syntax, priority),
+            "application/octet-stream",
+        )
     
-    file_path = settings.STORAGE_PATH / study_uid / series_uid / f"{sop_uid}.dcm"
+    frame = frame_numbers[0]
+    use_gzip = target_syntax in UNCOMPRESSED_SYNTAXES and accepts_encoding(accept_encoding, "gzip")
+    stat_result = await blocking_executor.run_io(os.stat, file_path)
+    etag = stat_etag(stat_result, f"{frame}-{target_syntax}{'-gz' if use_gzip else ''}")
+    headers = {**cache_headers(etag, stat_result), "Vary": "Accept, Accept-Encoding"}
     
-    if not file_path.exists():
-        raise HTTPException(status_code=404, detail="Instance not found")
+    if is_not_modified(request, etag, stat_result):
+        return Response(status_code=304, headers=headers)
     
-    pixel_data = parser.get_pixel_data(file_path, frame)
+    result = await frame_transcoder.get_frame(file_path, sop_uid, frame, stored_syntax, target_syntax, priority)
     
-    if pixel_data is None:
+    if result is None:
         raise HTTPException(status_code=404, detail="Frame not found")
     
-    return Response(
-        content=pixel_data,
-        media_type="application/octet-stream",
+    pixel_data, transfer_syntax = result
+    if use_gzip and transfer_syntax in UNCOMPRESSED_SYNTAXES:
+        pixel_data = await frame_transcoder.gzip_frame(sop_uid, frame, transfer_syntax, pixel_data)
+        headers["Content-Encoding"] = "gzip"
+    
+    return Response(content=pixel_data, media_type=frame_content_type(transfer_syntax), headers=headers)
+
+
+@router.get("/studies/{study_uid}/series/{series_uid}/instances/{sop_uid}/bulkdata/{tag_path:path}", dependencies=LOCAL_STUDY)
+async def get_bulkdata(request: Request, study_uid: str, series_uid: str, sop_uid: str, tag_path: str):
+    """WADO-RS: Retrieve the value of a binary element referenced by a BulkDataURI.
+    
+    The bytes are streamed straight from their offset in the stored file,
+    honouring Range requests.
+    """
+    
+    file_path = await _instance_file(study_uid, series_uid, sop_uid)
+    
+    location = await blocking_executor.run_io(parser.get_bulkdata, file_path, tag_path, sop_uid)
+    
+    if location is None:
+        raise HTTPException(status_code=404, detail="Bulk data not found")
+    
+    offset, length = location
+    
+    return file_slice_response(
+        request, file_path, offset, length, "application/octet-stream", variant=tag_path.replace("/", ".")
     )
 
 
-@router.get("/studies/{study_uid}/metadata")
-async def get_study_metadata(study_uid: str):
-    """WADO-RS: Get all instance metadata for a study."""
+async def _single_chunk(data: bytes):
+    yield data
+
+
+async def _frame_parts(
+    file_path: Path, sop_uid: str, frame_numbers: List[int], stored_syntax: str, target_syntax: str, priority: float = 0.0
+):
+    """Yield one multipart part per requested frame, reading each only when it is sent."""
+    for frame in frame_numbers:
+        result = await frame_transcoder.get_frame(file_path, sop_uid, frame, stored_syntax, target_syntax, priority)
+        pixel_data, transfer_syntax = result or (b"", target_syntax)
+        yield frame_content_type(transfer_syntax), _single_chunk(pixel_data)
+
+
+async def _file_parts(paths: List[Path]):
+    for path in paths:
+        yield f"application/octet-stream; transfer-syntax={ExplicitVRLittleEndian}", file_chunks(path)
+
+
+async def _instance_parts(instances: List[dict], transfer_syntax: Optional[str]):
+    """Yield one multipart part per instance, streaming stored files from disk."""
+    for instance in instances:
+        file_path = await _verified_path(instance["file_path"], instance.get("content_hash"))
+        stored_syntax = instance["transfer_syntax_uid"]
+        if transfer_syntax in (None, "*", stored_syntax):
+            yield f"application/dicom; transfer-syntax={stored_syntax}", file_chunks(file_path)
+        else:
+            with timed_stage("encode"):
+                content = await blocking_executor.run_cpu(parser.to_explicit_little_endian, file_path)
+            yield f"application/dicom; transfer-syntax={transfer_syntax}", _single_chunk(content)
+
+
+def _retrieve_instances(instances: List[dict], accept: Optional[str]) -> Response:
+    """Build the multipart/related retrieve response for a set of instances.
+    
+    Instances are sent as stored unless the Accept header names a specific
+    transfer syntax; Explicit VR Little Endian is the only one we transcode to.
+    """
+    transfer_syntax = requested_transfer_syntax(accept, "application/dicom")
     
-    study_path = settings.STORAGE_PATH / study_uid
+    if transfer_syntax not in (None, "*", ExplicitVRLittleEndian):
+        if any(instance["transfer_syntax_uid"] != transfer_syntax for instance in instances):
+            raise HTTPException(status_code=406, detail=f"Cannot transcode to transfer syntax {transfer_syntax}")
     
-    if not study_path.exists():
+    return multipart_response(_instance_parts(instances, transfer_syntax), "application/dicom")
+
+
+@router.get("/studies/{study_uid}", dependencies=LOCAL_STUDY)
+async def retrieve_study(study_uid: str, accept: Optional[str] = Header(None)):
+    """WADO-RS: Retrieve all instances of a study as multipart/related."""
+    
+    instances = await blocking_executor.run_io(metadata_index.list_instances, study_uid)
+    
+    if not instances:
         raise HTTPException(status_code=404, detail="Study not found")
     
-    metadata_list = []
+    await storage_lifecycle.ensure_hot(study_uid)
+    return _retrieve_instances(instances, accept)
+
+
+@router.get("/studies/{study_uid}/series/{series_uid}", dependencies=LOCAL_STUDY)
+async def retrieve_series(study_uid: str, series_uid: str, accept: Optional[str] = Header(None)):
+    """WADO-RS: Retrieve all instances of a series as multipart/related."""
     
-    for series_dir in study_path.iterdir():
-        if series_dir.is_dir():
-            for dcm_file in series_dir.glob("*.dcm"):
-                dicomweb_json = parser.to_dicomweb_json(dcm_file)
-                metadata_list.append(dicomweb_json)
+    instances = await blocking_executor.run_io(metadata_index.list_instances, study_uid, series_uid)
     
-    return Response(
-        content=f"[{','.join(metadata_list)}]",
-        media_type="application/dicom+json",
-    )
+    if not instances:
+        raise HTTPException(status_code=404, detail="Series not found")
+    
+    await storage_lifecycle.ensure_hot(study_uid)
+    return _retrieve_instances(instances, accept)
+
+
+@router.get("/studies/{study_uid}/metadata", dependencies=LOCAL_STUDY)
+async def get_study_metadata(request: Request, study_uid: str):
+    """WADO-RS: Get all instance metadata for a study.
+    
+    Streamed from the precomputed series documents; no DICOM files are read.
+    """
+    
+    storage_lifecycle.touch(study_uid)
+    documents = [
+        await blocking_executor.run_io(metadata_documents.get_series, study_uid, series["series_instance_uid"])
+        for series in await blocking_executor.run_io(metadata_index.list_series, study_uid)
+    ]
+    documents = [document for document in documents if document is not None]
+    
+    if not documents:
+        raise HTTPException(status_code=404, detail="Study not found")
+    
+    etag = '"' + hashlib.sha1("".join(document.etag for document in documents).encode()).hexdigest() + '"'
+    headers = {"ETag": etag, "Cache-Control": f"private, max-age={settings.HTTP_CACHE_MAX_AGE}, must-revalidate"}
+    
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers=headers)
+    
+    async def body():
+        yield b"["
+        for i, document in enumerate(documents):
+            async with aiofiles.open(document.path, "rb") as f:
+                content = await f.read()
+            yield (b"," if i else b"") + content[1:-1]
+        yield b"]"
+    
+    return StreamingResponse(body(), media_type="application/dicom+json", headers=headers)
 
 
-@router.get("/studies/{study_uid}/series/{series_uid}/metadata")
-async def get_series_metadata(study_uid: str, series_uid: str):
-    """WADO-RS: Get all instance metadata for a series."""
+@router.get("/studies/{study_uid}/series/{series_uid}/metadata", dependencies=LOCAL_STUDY)
+async def get_series_metadata(
+    request: Request,
+    study_uid: str,
+    series_uid: str,
+    accept_encoding: Optional[str] = Header(None),
+):
+    """WADO-RS: Get all instance metadata for a series.
+    
+    Served from the document built at ingest, pre-compressed to match
+    Accept-Encoding (brotli, gzip or identity).
+    """
     
-    series_path = settings.STORAGE_PATH / study_uid / series_uid
+    series = await blocking_executor.run_io(metadata_index.get_series, series_uid)
     
-    if not series_path.exists():
+    if series is None or series["study_instance_uid"] != study_uid:
         raise HTTPException(status_code=404, detail="Series not found")
     
-    metadata_list = []
+    storage_lifecycle.touch(study_uid)
+    document = await blocking_executor.run_io(metadata_documents.get_series, study_uid, series_uid)
     
-    for dcm_file in sorted(series_path.glob("*.dcm")):
-        dicomweb_json = parser.to_dicomweb_json(dcm_file)
-        metadata_list.append(dicomweb_json)
+    if document is None:
+        raise HTTPException(status_code=404, detail="Series not found")
     
-    return Response(
-        content=f"[{','.join(metadata_list)}]",
-        media_type="application/dicom+json",
+    encoding, path = document.negotiate(accept_encoding)
+    
+    return precompressed_response(request, path, "application/dicom+json", document.etag, encoding)
+
+
+@router.get("/studies/{study_uid}/series/{series_uid}/volume", dependencies=LOCAL_STUDY)
+async def get_series_volume(request: Request, study_uid: str, series_uid: str):
+    """Get a series as one 3D volume for MPR.
+    
+    Slices are sorted along the image-plane normal and rescaled to modality
+    values. The body is a little-endian uint32 header length, a JSON header
+    (dimensions, spacing, origin, direction, dtype, data_offset) and then
+    the contiguous voxels (x fastest) starting at ``data_offset``. Volumes
+    are assembled once and then sent straight from their cache file.
+    """
+    
+    await storage_lifecycle.ensure_hot(study_uid)
+    try:
+        volume = await blocking_executor.run_io(volume_service.get_volume, study_uid, series_uid)
+    except VolumeError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    
+    if volume is None:
+        raise HTTPException(status_code=404, detail="Series not found")
+    
+    return file_response(request, volume.path, "application/octet-stream")
+
+
+@router.get("/studies/{study_uid}/series/{series_uid}/reformat", dependencies=LOCAL_STUDY)
+async def get_series_reformat(
+    request: Request,
+    study_uid: str,
+    series_uid: str,
+    plane: str = Query("axial", description="axial, coronal, sagittal or oblique"),
+    position: Optional[float] = Query(None, description="Slice index of an axial/coronal/sagittal plane"),
+    center: Optional[str] = Query(None, description="Oblique plane center x,y,z in patient mm"),
+    row: Optional[str] = Query(None, description="Oblique plane row direction x,y,z"),
+    column: Optional[str] = Query(None, description="Oblique plane column direction x,y,z"),
+    size: Optional[str] = Query(None, description="Oblique plane width,height in pixels"),
+    spacing: Optional[float] = Query(None, gt=0, description="Oblique plane pixel spacing in mm"),
+    thickness: float = Query(0.0, ge=0, description="Slab thickness in mm"),
+    mode: str = Query("mpr", description="mpr, mip, minip or average"),
+    window: Optional[str] = Query(None, description="center,width[,function], function LINEAR (default), LINEAR_EXACT or SIGMOID"),
+    viewport: Optional[str] = Query(None, description="width,height"),
+    quality: int = Query(90, ge=1, le=100),
+    accept: Optional[str] = Header(None),
+):
+    """Get a multiplanar reformatted plane or MIP/MinIP/average slab of a series.
+    
+    Computed from the cached series volume. Rendered as JPEG or PNG by
+    default; with ``Accept: application/octet-stream`` the modality values
+    are returned in the volume format (uint32 header length, JSON header
+    with the plane geometry, then little-endian pixels).
+    """
+    
+    media_type = negotiate_media_type(accept, [*RENDERED_MEDIA_TYPES, "application/octet-stream"])
+    if media_type is None:
+        raise HTTPException(status_code=406, detail="Reformat media type must be image/jpeg, image/png or application/octet-stream")
+    
+    window_args = _parse_window(window)
+    viewport_values = _parse_numbers(viewport, 2, "viewport")
+    size_values = _parse_numbers(size, 2, "size")
+    
+    await storage_lifecycle.ensure_hot(study_uid)
+    try:
+        opened = await blocking_executor.run_io(reformat_service.open_volume, study_uid, series_uid)
+    except VolumeError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    
+    if opened is None:
+        raise HTTPException(status_code=404, detail="Series not found")
+    
+    volume, voxels = opened
+    stat_result = await blocking_executor.run_io(os.stat, volume.path)
+    variant = hashlib.sha1(f"{request.url.query}|{media_type}".encode()).hexdigest()[:16]
+    etag = stat_etag(stat_result, f"mpr{variant}")
+    
+    if is_not_modified(request, etag, stat_result):
+        return not_modified(etag, stat_result)
+    
+    try:
+        result = await blocking_executor.run_io(
+            reformat_service.reformat,
+            volume,
+            voxels,
+            plane=plane,
+            position=position,
+            center=_parse_numbers(center, 3, "center"),
+            row_direction=_parse_numbers(row, 3, "row"),
+            column_direction=_parse_numbers(column, 3, "column"),
+            size=tuple(int(v) for v in size_values) if size_values else None,
+            pixel_spacing=spacing,
+            thickness=thickness,
+            mode=mode,
+        )
+    except ReformatError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    if media_type == "application/octet-stream":
+        pixels = result.pixels.astype(result.pixels.dtype.newbyteorder("<"), copy=False)
+        content = encode_header(result.header()) + pixels.tobytes()
+    else:
+        instance = await blocking_executor.run_io(render_service.representative_instance, study_uid, series_uid)
+        content = await blocking_executor.run_io(
+            render_service.render_plane,
+            result.pixels,
+            instance or {},
+            tuple(result.spacing),
+            media_type,
+            viewport=tuple(int(v) for v in viewport_values) if viewport_values else None,
+            **window_args,
+            quality=quality,
+        )
+    
+    return Response(content=content, media_type=media_type, headers=cache_headers(etag, stat_result))
+
+
+# ==================== Rendered Resources ====================
+
+
+async def _indexed_instance(study_uid: str, series_uid: str, sop_uid: str) -> dict:
+    instance = await blocking_executor.run_io(metadata_index.get_instance, sop_uid)
+    if (
+        instance is None
+        or instance["study_instance_uid"] != study_uid
+        or instance["series_instance_uid"] != series_uid
+    ):
+        raise HTTPException(status_code=404, detail="Instance not found")
+    return instance
+
+
+def _parse_numbers(value: Optional[str], count: int, name: str) -> Optional[List[float]]:
+    if not value:
+        return None
+    try:
+        numbers = [float(part) for part in value.split(",")[:count]]
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"Invalid {name} parameter")
+    if len(numbers) < count or not all(math.isfinite(number) for number in numbers):
+        raise HTTPException(status_code=400, detail=f"Invalid {name} parameter")
+    return numbers
+
+
+def _parse_window(value: Optional[str]) -> dict:
+    """Render arguments of a ``center,width[,function]`` window parameter."""
+    if not value:
+        return {}
+    parts = value.split(",")
+    function = parts[2].strip().upper() if len(parts) == 3 else "LINEAR"
+    if len(parts) > 3 or function not in VOI_FUNCTIONS:
+        raise HTTPException(status_code=400, detail=f"Invalid window parameter (function must be one of {', '.join(VOI_FUNCTIONS)})")
+    center, width = _parse_numbers(",".join(parts[:2]), 2, "window")
+    return {"window_center": center, "window_width": width, "voi_function": function}
+
+
+async def _rendered_response(
+    request: Request,
+    instance: dict,
+    frame: int,
+    accept: Optional[str],
+    window: Optional[str],
+    viewport: Optional[str],
+    quality: int,
+) -> Response:
+    """Render one frame of an indexed instance, honouring conditional requests."""
+    media_type = negotiate_media_type(accept, list(RENDERED_MEDIA_TYPES))
+    if media_type is None:
+        raise HTTPException(status_code=406, detail="Rendered media type must be image/jpeg or image/png")
+    
+    window_args = _parse_window(window)
+    viewport_values = _parse_numbers(viewport, 2, "viewport")
+    
+    if frame < 1 or frame > (instance.get("number_of_frames") or 1):
+        raise HTTPException(status_code=404, detail="Frame not found")
+    
+    await storage_lifecycle.ensure_hot(instance["study_instance_uid"])
+    file_path = await _verified_path(instance["file_path"], instance.get("content_hash"))
+    stat_result = await blocking_executor.run_io(os.stat, file_path)
+    variant = hashlib.sha1(f"{frame}|{media_type}|{window}|{viewport}|{quality}".encode()).hexdigest()[:16]
+    etag = stat_etag(stat_result, f"r{variant}")
+    
+    if is_not_modified(request, etag, stat_result):
+        return not_modified(etag, stat_result)
+    
+    # Decode on the process pool first so rendering finds the frame cached
+    await parser.get_pixel_data_async(file_path, frame, instance["sop_instance_uid"])
+    content = await blocking_executor.run_io(
+        render_service.render,
+        instance,
+        frame,
+        media_type,
+        viewport=tuple(int(v) for v in viewport_values) if viewport_values else None,
+        **window_args,
+        quality=quality,
     )
+    
+    if content is None:
+        raise HTTPException(status_code=404, detail="Frame not found")
+    
+    return Response(content=content, media_type=media_type, headers=cache_headers(etag, stat_result))
+
+
+def _thumbnail_response(request: Request, path: Optional[Path], detail: str) -> Response:
+    if path is None:
+        raise HTTPException(status_code=404, detail=detail)
+    return file_response(request, path, "image/jpeg")
+
+
+@router.get("/studies/{study_uid}/series/{series_uid}/instances/{sop_uid}/frames/{frame}/rendered", dependencies=LOCAL_STUDY)
+async def get_rendered_frame(
+    request: Request,
+    study_uid: str,
+    series_uid: str,
+    sop_uid: str,
+    frame: int,
+    window: Optional[str] = Query(None, description="center,width[,function], function LINEAR (default), LINEAR_EXACT or SIGMOID"),
+    viewport: Optional[str] = Query(None, description="width,height"),
+    quality: int = Query(90, ge=1, le=100),
+    accept: Optional[str] = Header(None),
+):
+    """WADO-RS: Get a frame rendered to JPEG or PNG with rescale and VOI applied."""
+    
+    instance = await _indexed_instance(study_uid, series_uid, sop_uid)
+    return await _rendered_response(request, instance, frame, accept, window, viewport, quality)
+
+
+@router.get("/studies/{study_uid}/series/{series_uid}/instances/{sop_uid}/rendered", dependencies=LOCAL_STUDY)
+async def get_rendered_instance(
+    request: Request,
+    study_uid: str,
+    series_uid: str,
+    sop_uid: str,
+    window: Optional[str] = Query(None, description="center,width[,function], function LINEAR (default), LINEAR_EXACT or SIGMOID"),
+    viewport: Optional[str] = Query(None, description="width,height"),
+    quality: int = Query(90, ge=1, le=100),
+    accept: Optional[str] = Header(None),
+):
+    """WADO-RS: Get an instance rendered to JPEG or PNG (first frame of multi-frame objects)."""
+    
+    instance = await _indexed_instance(study_uid, series_uid, sop_uid)
+    return await _rendered_response(request, instance, 1, accept, window, viewport, quality)
+
+
+@router.get("/studies/{study_uid}/series/{series_uid}/rendered", dependencies=LOCAL_STUDY)
+async def get_rendered_series(
+    request: Request,
+    study_uid: str,
+    series_uid: str,
+    window: Optional[str] = Query(None, description="center,width[,function], function LINEAR (default), LINEAR_EXACT or SIGMOID"),
+    viewport: Optional[str] = Query(None, description="width,height"),
+    quality: int = Query(90, ge=1, le=100),
+    accept: Optional[str] = Header(None),
+):
+    """WADO-RS: Get the series' representative (middle) instance rendered to JPEG or PNG."""
+    
+    instance = await blocking_executor.run_io(render_service.representative_instance, study_uid, series_uid)
+    
+    if instance is None:
+        raise HTTPException(status_code=404, detail="Series not found")
+    
+    return await _rendered_response(request, instance, 1, accept, window, viewport, quality)
+
+
+@router.get("/studies/{study_uid}/rendered", dependencies=LOCAL_STUDY)
+async def get_rendered_study(
+    request: Request,
+    study_uid: str,
+    window: Optional[str] = Query(None, description="center,width[,function], function LINEAR (default), LINEAR_EXACT or SIGMOID"),
+    viewport: Optional[str] = Query(None, description="width,height"),
+    quality: int = Query(90, ge=1, le=100),
+    accept: Optional[str] = Header(None),
+):
+    """WADO-RS: Get the representative instance of the study's first series with pixel data rendered to JPEG or PNG."""
+    
+    instance = await blocking_executor.run_io(render_service.study_representative_instance, study_uid)
+    
+    if instance is None:
+        raise HTTPException(status_code=404, detail="Study not found")
+    
+    return await _rendered_response(request, instance, 1, accept, window, viewport, quality)
+
+
+@router.get("/studies/{study_uid}/series/{series_uid}/instances/{sop_uid}/thumbnail", dependencies=LOCAL_STUDY)
+async def get_instance_thumbnail(request: Request, study_uid: str, series_uid: str, sop_uid: str):
+    """WADO-RS: Get a cached JPEG thumbnail of an instance."""
+    
+    instance = await _indexed_instance(study_uid, series_uid, sop_uid)
+    await storage_lifecycle.ensure_hot(study_uid)
+    path = await blocking_executor.run_io(render_service.instance_thumbnail, instance)
+    return _thumbnail_response(request, path, "Instance has no pixel data")
+
+
+@router.get("/studies/{study_uid}/series/{series_uid}/thumbnail", dependencies=LOCAL_STUDY)
+async def get_series_thumbnail(request: Request, study_uid: str, series_uid: str):
+    """WADO-RS: Get a cached JPEG thumbnail of a series (generated at ingest)."""
+    
+    storage_lifecycle.touch(study_uid)
+    path = await blocking_executor.run_io(render_service.series_thumbnail, study_uid, series_uid)
+    if path is None and storage_lifecycle.is_cold(study_uid):
+        # No thumbnail was kept before the study went cold: render one from its restored files
+        await storage_lifecycle.ensure_hot(study_uid)
+        path = await blocking_executor.run_io(render_service.series_thumbnail, study_uid, series_uid)
+    return _thumbnail_response(request, path, "Series not found")
+
+
+@router.get("/studies/{study_uid}/thumbnail", dependencies=LOCAL_STUDY)
+async def get_study_thumbnail(request: Request, study_uid: str):
+    """WADO-RS: Get a cached JPEG thumbnail of a study (its first series with pixel data)."""
+    
+    storage_lifecycle.touch(study_uid)
+    path = await blocking_executor.run_io(render_service.study_thumbnail, study_uid)
+    if path is None and storage_lifecycle.is_cold(study_uid):
+        await storage_lifecycle.ensure_hot(study_uid)
+        path = await blocking_executor.run_io(render_service.study_thumbnail, study_uid)
+    return _thumbnail_response(request, path, "Study not found")
@@ -2,7 +2,8 @@
 
 from pydantic_settings import BaseSettings
 from pathlib import Path
-from typing import List
+import os
+from typing import Any, Dict, List, Optional
 
 
 class Settings(BaseSettings):
@@ -16,12 +17,96 @@ class Settings(BaseSettings):
     # Storage
     STORAGE_PATH: Path = Path("/tmp/dicom-storage")
     MAX_UPLOAD_SIZE: int = 500 * 1024 * 1024  # 500MB
+    # "content": files named by SHA-256 in a sharded fan-out (.objects/ab/cd/<sha256>.dcm), duplicates stored once
+    # "hierarchical": <study>/<series>/<sop>.dcm
+    STORAGE_LAYOUT: str = "content"
+    VERIFY_CHECKSUMS: bool = False  # re-hash stored files before serving them (once per file version)
     
-    # PACS (optional)
+    # Storage lifecycle: studies not accessed for COLD_AFTER_DAYS are gzip-compressed into
+    # COLD_STORAGE_PATH and restored on first read (no cold tier while unset)
+    COLD_STORAGE_PATH: Optional[Path] = None
+    COLD_AFTER_DAYS: float = 90
+    COLD_COMPRESSION_LEVEL: int = 6
+    LIFECYCLE_INTERVAL: int = 3600  # seconds between cold-tier sweeps
+    LIFECYCLE_WORKERS: int = 4  # threads compressing and restoring files of one study
+    
+    # Archive reconciliation: files added to or removed from STORAGE_PATH behind the app's back (restores,
+    # rsync) are indexed at startup, on POST /archive/reconcile and, while the app runs, from inotify events
+    RECONCILE_ON_STARTUP: bool = True
+    ARCHIVE_WATCH: str = "inotify"  # "inotify", "poll" (a pass every ARCHIVE_POLL_INTERVAL) or "off"
+    ARCHIVE_WATCH_SETTLE: float = 2.0  # seconds a changed directory is left to settle before it is reconciled
+    ARCHIVE_POLL_INTERVAL: float = 300.0  # also the fallback when inotify is unavailable or out of watches
+    
+    # Folder ingestion pipeline
+    INGEST_WORKERS: int = os.cpu_count() or 4
+    INGEST_BATCH_SIZE: int = 200  # instances per metadata index transaction
+    # Series metadata documents touched by ingest are rebuilt on their next read (fast brotli) and recompressed
+    # at full quality once the series has been quiet for this long
+    METADATA_REBUILD_DELAY: float = 5.0  # seconds
+    
+    # Embedded C-STORE SCP: modalities push to LOCAL_AE_TITLE on SCP_PORT (started with the app when enabled)
+    SCP_ENABLED: bool = False
+    SCP_HOST: str = "0.0.0.0"
+    SCP_PORT: int = 11112
+    SCP_MAX_ASSOCIATIONS: int = 32
+    SCP_FLUSH_INTERVAL: float = 0.5  # seconds a received instance may wait for its index batch
+    
+    # Executors for blocking work in async endpoints
+    IO_WORKERS: int = 32  # threads for file reads, header parsing and directory operations
+    DECODE_WORKERS: int = os.cpu_count() or 4  # processes for decoding compressed frames
+    
+    # Frame scheduling: decodes take one of FRAME_DECODE_SLOTS nearest the viewer's position first
+    # (X-Viewport-Index / X-Scroll-Direction hints); opening a series or a frame warms the frame cache
+    # with the frames around that position and the first frames of the study's other series
+    FRAME_DECODE_SLOTS: int = 2 * (os.cpu_count() or 4)  # enough to keep the decode processes busy
+    FRAME_PREFETCH_AHEAD: int = 16  # frames in the scroll direction
+    FRAME_PREFETCH_BEHIND: int = 4
+    FRAME_PREFETCH_OTHER_SERIES: int = 2  # frames of each other series in the study
+    FRAME_PREFETCH_WORKERS: int = 2  # read-ahead decodes at once (0 turns read-ahead off)
+    
+    # Metadata index (defaults to STORAGE_PATH/index.sqlite3)
+    INDEX_PATH: Optional[Path] = None
+    
+    # In-process caches (memory budgets in bytes)
+    DATASET_CACHE_BYTES: int = 64 * 1024 * 1024  # 64MB of parsed headers
+    FRAME_CACHE_BYTES: int = 512 * 1024 * 1024  # 512MB of decoded frames
+    TRANSCODED_CACHE_BYTES: int = 128 * 1024 * 1024  # 128MB of re-encoded (RLE, gzip) frames
+    
+    # Binary values above this size are left on disk and referenced by BulkDataURI
+    BULKDATA_THRESHOLD: int = 1024
+    
+    # HTTP caching of WADO responses (clients revalidate with ETag after this many seconds)
+    HTTP_CACHE_MAX_AGE: int = 0
+    
+    # Server-side rendering (longest edge of cached thumbnails, in pixels)
+    THUMBNAIL_SIZE: int = 128
+    
+    # Frame resolution pyramids are built at ingest for images at least this large (others on first use)
+    PYRAMID_INGEST_MIN_SIZE: int = 1024
+    
+    # Prometheus metrics at /metrics (request middleware off when disabled; counters are in-process)
+    METRICS_ENABLED: bool = True
+    
+    # Per-request profiling: requests carrying this token in an X-Profile header or ?profile= are
+    # sampled and their reports kept under STORAGE_PATH/.profiles (off while the token is empty)
+    PROFILING_TOKEN: str = ""
+    PROFILE_MAX_REPORTS: int = 50
+    PROFILE_SAMPLE_INTERVAL_MS: float = 1.0
+    
+    # PACS (optional): studies not archived locally are searched with C-FIND and retrieved on first use
     PACS_HOST: str = ""
     PACS_PORT: int = 11112
     PACS_AE_TITLE: str = "PACS"
     LOCAL_AE_TITLE: str = "DICOM_VIEWER"
+    PACS_RETRIEVE_METHOD: str = "get"  # "get" (C-GET) or "move" (C-MOVE to our Storage SCP; needs SCP_ENABLED)
+    PACS_MOVE_DESTINATION: str = ""  # AE title the PACS moves to (defaults to LOCAL_AE_TITLE)
+    PACS_TIMEOUT: float = 30.0  # seconds to wait for the PACS on connect and per DIMSE message
+    PACS_FIND_TTL: int = 300  # seconds C-FIND results are reused
+    PACS_RETRIEVE_WORKERS: int = 4
+    # Retrieved ahead of time when a study is opened, e.g. [{"priors": 2, "modalities": ["CT"], "max_age_days": 1825}]:
+    # the patient's N most recent earlier studies, optionally limited by modality and age
+    PACS_PREFETCH_RULES: List[Dict[str, Any]] = [{"priors": 2}]
+    PACS_PREFETCH_WORKERS: int = 1
     
     class Config:
         env_file = ".env"
@@ -1,14 +1,52 @@
 """DICOM Viewer Backend - FastAPI Application"""
 
-from fastapi import FastAPI
+from contextlib import asynccontextmanager
+from typing import Optional
+from fastapi import FastAPI, Header, HTTPException, Query
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import PlainTextResponse
 from app.api.v1.router import api_router
 from app.config import settings
+from app.services.cache import dicom_cache
+from app.services.executor import blocking_executor
+from app.services.frame_scheduler import frame_scheduler
+from app.services.ingest_jobs import ingest_pipeline
+from app.services.lifecycle import storage_lifecycle
+from app.services.metadata_documents import metadata_documents
+from app.services.metadata_index import metadata_index
+from app.services.metrics import MetricsMiddleware, metrics
+from app.services.pacs_proxy import pacs_proxy
+from app.services.profiling import ProfilingMiddleware, is_authorized, profile_store
+from app.services.reconciler import archive_reconciler
+from app.services.storage_scp import storage_scp
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Seed the metadata index from an archive that predates it before serving
+    if metadata_index.count_instances() == 0:
+        await blocking_executor.run_io(archive_reconciler.reconcile)
+    # Pick up files added to or removed from the archive behind our back, then follow changes
+    archive_reconciler.start(reconcile=settings.RECONCILE_ON_STARTUP)
+    storage_lifecycle.start()
+    metadata_documents.start()
+    if settings.SCP_ENABLED:
+        storage_scp.start()
+    yield
+    pacs_proxy.shutdown()
+    storage_scp.shutdown()
+    archive_reconciler.shutdown()
+    storage_lifecycle.shutdown()
+    metadata_documents.shutdown()
+    ingest_pipeline.shutdown()
+    blocking_executor.shutdown()
+
 
 app = FastAPI(
     title="DICOM Viewer API",
     description="Full-featured DICOM medical imaging viewer backend",
     version="1.0.0",
+    lifespan=lifespan,
 )
 
 # CORS middleware - important for Cornerstone3D
@@ -21,6 +59,14 @@ app.add_middleware(
     expose_headers=["Content-Disposition"],
 )
 
+# Per-request profiling for callers holding the profiling token
+if settings.PROFILING_TOKEN:
+    app.add_middleware(ProfilingMiddleware)
+
+# Request metrics, outermost so they include the time spent in CORS handling
+if settings.METRICS_ENABLED:
+    app.add_middleware(MetricsMiddleware)
+
 # Include API router
 app.include_router(api_router, prefix="/api/v1")
 
@@ -28,3 +74,78 @@ app.include_router(api_router, prefix="/api/v1")
 @app.get("/health")
 async def health_check():
     return {"status": "healthy", "version": "1.0.0"}
+
+
+@app.get("/cache/stats")
+async def cache_stats():
+    """Hit/miss/eviction counters of the in-process caches."""
+    return dicom_cache.stats()
+
+
+@app.get("/executor/stats")
+async def executor_stats():
+    """Queue depth and wait times of the blocking I/O and decode pools."""
+    return blocking_executor.stats()
+
+
+@app.get("/frames/stats")
+async def frame_stats():
+    """Frame decode scheduling and read-ahead counters."""
+    return frame_scheduler.stats()
+
+
+@app.get("/scp/stats")
+async def scp_stats():
+    """State of the Storage SCP and per-association throughput of active and recent associations."""
+    return storage_scp.stats()
+
+
+@app.get("/pacs/stats")
+async def pacs_stats():
+    """C-FIND cache hits, retrieves (on demand and prefetched) and joined duplicate requests of the PACS proxy."""
+    return pacs_proxy.stats()
+
+
+@app.get("/archive/stats")
+async def archive_stats():
+    """How the index is kept in line with the archive, and the outcome of the last reconciliation."""
+    return archive_reconciler.stats()
+
+
+@app.post("/archive/reconcile")
+async def reconcile_archive(full: bool = Query(False)):
+    """Index files added to the archive behind the app's back and drop instances whose files are gone.
+
+    ``full`` stats every file instead of trusting unchanged directory mtimes.
+    """
+    return await blocking_executor.run_io(archive_reconciler.reconcile, full)
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def prometheus_metrics():
+    """Request, parser, ingest, cache and pool metrics in the Prometheus text format."""
+    if not settings.METRICS_ENABLED:
+        raise HTTPException(status_code=404, detail="Metrics are disabled")
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+def _require_profiling_token(token: Optional[str]) -> None:
+    if not is_authorized(token):
+        raise HTTPException(status_code=404, detail="Profiling is not available")
+
+
+@app.get("/profiles")
+async def list_profiles(x_profile: Optional[str] = Header(None)):
+    """Summaries of the stored request profiles, newest first."""
+    _require_profiling_token(x_profile)
+    return await blocking_executor.run_io(profile_store.list)
+
+
+@app.get("/profiles/{profile_id}")
+async def get_profile(profile_id: str, x_profile: Optional[str] = Header(None)):
+    """One request profile: stage timings and sampled call trees."""
+    _require_profiling_token(x_profile)
+    report = await blocking_executor.run_io(profile_store.get, profile_id)
+    if report is None:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    return report
@@ -0,0 +1,182 @@
+"""Byte-budgeted in-process LRU caches for parsed datasets and decoded frames"""
+
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Iterable, Optional, Set
+
+from pydicom.dataset import Dataset
+
+from app.config import settings
+
+
+class ByteLRUCache:
+    """LRU cache that evicts by total size in bytes rather than entry count.
+
+    ``on_evict`` is called, outside the lock, with each key pushed out by
+    the budget (or refused for being larger than all of it).
+    """
+
+    def __init__(
+        self, max_bytes: int, sizeof: Callable[[Any], int] = len, on_evict: Optional[Callable[[Hashable], None]] = None
+    ):
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.on_evict = on_evict
+        self._entries: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def __contains__(self, key: Hashable) -> bool:
+        """Whether a key is cached, without counting a lookup or refreshing it."""
+        with self._lock:
+            return key in self._entries
+
+    def put(self, key: Hashable, value: Any) -> None:
+        size = self.sizeof(value)
+        if size > self.max_bytes:
+            # Would evict everything else and still not fit
+            if self.on_evict is not None:
+                self.on_evict(key)
+            return
+
+        evicted = []
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.current_bytes -= old[1]
+            self._entries[key] = (value, size)
+            self.current_bytes += size
+            while self.current_bytes > self.max_bytes and self._entries:
+                evicted_key, (_, evicted_size) = self._entries.popitem(last=False)
+                self.current_bytes -= evicted_size
+                self.evictions += 1
+                evicted.append(evicted_key)
+        if self.on_evict is not None:
+            for evicted_key in evicted:
+                self.on_evict(evicted_key)
+
+    def discard(self, key: Hashable) -> None:
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self.current_bytes -= entry[1]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self.current_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+def dataset_size(ds: Dataset) -> int:
+    """Rough in-memory footprint of a (header-only) dataset."""
+    size = 0
+    for tag in ds.keys():
+        # keep_deferred: sizing must not pull deferred bulk values off disk
+        elem = ds.get_item(tag, keep_deferred=True)
+        size += 96  # DataElement object overhead
+        value = elem.value
+        if isinstance(value, (bytes, str)):
+            size += len(value)
+        elif elem.VR == "SQ" and value is not None:
+            size += sum(dataset_size(item) for item in value)
+        else:
+            size += 32 * (getattr(elem, "VM", 1) or 1)
+    return size
+
+
+class DICOMCache:
+    """Parsed header datasets keyed by SOP UID, decoded frames keyed by (SOP UID, frame)
+    and re-encoded frames keyed by (SOP UID, frame, encoding)."""
+
+    def __init__(self, dataset_bytes: int, frame_bytes: int, transcoded_bytes: int):
+        self.datasets = ByteLRUCache(dataset_bytes, dataset_size)
+        self.frames = ByteLRUCache(frame_bytes, on_evict=self._forget_key)
+        self.transcoded = ByteLRUCache(transcoded_bytes, on_evict=self._forget_key)
+        # Cached frame keys per SOP UID, so invalidate() finds them; pruned on eviction
+        self._frame_keys: Dict[str, Set[Hashable]] = {}
+        self._lock = threading.Lock()
+
+    def get_dataset(self, sop_uid: str) -> Optional[Dataset]:
+        return self.datasets.get(sop_uid)
+
+    def put_dataset(self, sop_uid: str, ds: Dataset) -> None:
+        self.datasets.put(sop_uid, ds)
+
+    def get_frame(self, sop_uid: str, frame: int) -> Optional[bytes]:
+        return self.frames.get((sop_uid, frame))
+
+    def has_frame(self, sop_uid: str, frame: int) -> bool:
+        return (sop_uid, frame) in self.frames
+
+    def put_frame(self, sop_uid: str, frame: int, data: bytes) -> None:
+        # Registered first, so an eviction right after the put finds the key to prune
+        with self._lock:
+            self._frame_keys.setdefault(sop_uid, set()).add(frame)
+        self.frames.put((sop_uid, frame), data)
+
+    def get_transcoded(self, sop_uid: str, frame: int, encoding: str) -> Optional[bytes]:
+        return self.transcoded.get((sop_uid, frame, encoding))
+
+    def put_transcoded(self, sop_uid: str, frame: int, encoding: str, data: bytes) -> None:
+        with self._lock:
+            self._frame_keys.setdefault(sop_uid, set()).add((frame, encoding))
+        self.transcoded.put((sop_uid, frame, encoding), data)
+
+    def _forget_key(self, key: tuple) -> None:
+        sop_uid, *rest = key
+        with self._lock:
+            keys = self._frame_keys.get(sop_uid)
+            if keys is None:
+                return
+            keys.discard(rest[0] if len(rest) == 1 else tuple(rest))
+            if not keys:
+                del self._frame_keys[sop_uid]
+
+    def invalidate(self, sop_uid: str) -> None:
+        """Drop everything cached for one instance."""
+        self.datasets.discard(sop_uid)
+        with self._lock:
+            keys = self._frame_keys.pop(sop_uid, set())
+        for key in keys:
+            if isinstance(key, tuple):
+                self.transcoded.discard((sop_uid, *key))
+            else:
+                self.frames.discard((sop_uid, key))
+
+    def invalidate_many(self, sop_uids: Iterable[str]) -> None:
+        for sop_uid in sop_uids:
+            self.invalidate(sop_uid)
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        return {
+            "datasets": self.datasets.stats(),
+            "frames": self.frames.stats(),
+            "transcoded": self.transcoded.stats(),
+        }
+
+
+dicom_cache = DICOMCache(settings.DATASET_CACHE_BYTES, settings.FRAME_CACHE_BYTES, settings.TRANSCODED_CACHE_BYTES)
@@ -1,25 +1,71 @@
 """DICOM parsing service using pydicom"""
 
 from pydicom import dcmread
+from pydicom.datadict import dictionary_VR
+from pydicom.dataelem import RawDataElement
 from pydicom.dataset import Dataset
+from pydicom.tag import Tag
+from pydicom.uid import ExplicitVRLittleEndian
 from pathlib import Path
-from typing import Dict, Any, Optional
+from typing import Dict, Any, Optional, Tuple
+import base64
+import io
 import json
 
+from app.config import settings
+from app.services.cache import dicom_cache
+from app.services.executor import blocking_executor
+from app.services.frame_access import decode_frame, frame_accessor
+from app.services.profiling import timed_stage
+
+
+BINARY_VRS = ("OB", "OD", "OF", "OL", "OV", "OW", "UN")
+
+
+def element_vr(ds: Dataset, tag) -> str:
+    """VR of an element without reading a deferred value."""
+    elem = ds.get_item(tag, keep_deferred=True)
+    if elem.VR:
+        return elem.VR
+    try:
+        vr = dictionary_VR(tag)
+    except KeyError:
+        return "UN"
+    if vr == "OB or OW":
+        return "OW"  # implicit VR files encode these as OW (PS3.5 A.1)
+    if " or " in vr:
+        return ds[tag].VR  # e.g. "US or SS", resolved by pydicom from Pixel Representation
+    return vr
+
 
 class DICOMParserService:
     """Parse DICOM files and extract metadata."""
     
-    def parse_file(self, file_path: Path) -> Dict[str, Any]:
-        """Parse a DICOM file and extract metadata."""
-        ds = dcmread(file_path)
+    def read_header(self, file_path: Path, sop_uid: Optional[str] = None) -> Dataset:
+        """Read a DICOM header without pixel data, cached by SOP Instance UID when given."""
+        if sop_uid is not None:
+            ds = dicom_cache.get_dataset(sop_uid)
+            if ds is not None:
+                return ds
+        
+        with timed_stage("dcmread"):
+            ds = dcmread(file_path, stop_before_pixels=True, defer_size=settings.BULKDATA_THRESHOLD)
+        
+        if sop_uid is not None:
+            dicom_cache.put_dataset(sop_uid, ds)
+        return ds
+    
+    def parse_file(self, file_path: Path, sop_uid: Optional[str] = None) -> Dict[str, Any]:
+        """Parse a DICOM file header and extract metadata."""
+        ds = self.read_header(file_path, sop_uid)
         return self._extract_metadata(ds)
     
     def parse_bytes(self, content: bytes) -> Optional[Dict[str, Any]]:
         """Parse DICOM from bytes."""
         try:
             import io
-            ds = dcmread(io.BytesIO(content))
+            with timed_stage("dcmread"):
+                ds = dcmread(io.BytesIO(content))
             return self._extract_metadata(ds)
         except Exception:
             return None
@@ -93,9 +139,24 @@ class DICOMParserService:
         except (TypeError, ValueError):
             return None
     
-    def to_dicomweb_json(self, file_path: Path) -> str:
+    def to_dicomweb_json(self, file_path: Path, sop_uid: Optional[str] = None) -> str:
         """Convert DICOM to DICOMweb JSON format."""
-        ds = dcmread(file_path)
+        return self.dataset_to_dicomweb_json(self.read_header(file_path, sop_uid))
+    
+    def dataset_to_dicomweb_json(self, ds: Dataset) -> str:
+        """Convert an already-read Dataset to DICOMweb JSON format.
+        
+        Binary values longer than ``BULKDATA_THRESHOLD`` become a BulkDataURI
+        pointing at the instance's bulkdata endpoint; shorter ones are inlined.
+        """
+        bulkdata_uri = (
+            f"{settings.API_V1_PREFIX}/dicomweb/studies/{ds.StudyInstanceUID}"
+            f"/series/{ds.SeriesInstanceUID}/instances/{ds.SOPInstanceUID}/bulkdata"
+        )
+        with timed_stage("json"):
+            return json.dumps(self._dataset_to_json(ds, bulkdata_uri))
+    
+    def _dataset_to_json(self, ds: Dataset, bulkdata_uri: str) -> Dict[str, Any]:
         
         def tag_to_keyword(tag):
             """Convert tag to keyword string."""
@@ -103,11 +164,7 @@ class DICOMParserService:
         
         def value_to_json(elem):
             """Convert element value to JSON-serializable format."""
-            if elem.VR == "SQ":
-                return [{"Value": [value_to_json(item) for item in seq_item]} for seq_item in elem.value]
-            elif elem.VR in ("OB", "OW", "OF", "OD", "UN"):
-                return None  # Skip binary data
-            elif elem.VR == "PN":
+            if elem.VR == "PN":
                 return [{"Alphabetic": str(elem.value)}]
             elif elem.VM > 1:
                 return list(elem.value)
@@ -116,34 +173,136 @@ class DICOMParserService:
         
         result = {}
         
-        for elem in ds:
-            if elem.tag.group == 0x7FE0:  # Skip pixel data
+        for tag in sorted(ds.keys()):
+            if tag.group == 0x7FE0:  # Pixel data is served by the frames endpoints
                 continue
             
-            tag_str = tag_to_keyword(elem.tag)
-            value = value_to_json(elem)
+            tag_str = tag_to_keyword(tag)
+            vr = element_vr(ds, tag)
             
-            if value is not None:
+            if vr in BINARY_VRS:
+                # Look at the length without triggering a deferred read of the value
+                raw = ds.get_item(tag, keep_deferred=True)
+                length = raw.length if isinstance(raw, RawDataElement) else len(raw.value or b"")
+                if length > settings.BULKDATA_THRESHOLD:
+                    result[tag_str] = {"vr": vr, "BulkDataURI": f"{bulkdata_uri}/{tag_str}"}
+                elif length:
+                    inline = base64.b64encode(ds[tag].value).decode("ascii")
+                    result[tag_str] = {"vr": vr, "InlineBinary": inline}
+                else:
+                    result[tag_str] = {"vr": vr}
+                continue
+            
+            elem = ds[tag]
+            
+            if elem.VR == "SQ":
                 result[tag_str] = {
-                    "vr": elem.VR,
-                    "Value": value,
+                    "vr": "SQ",
+                    "Value": [
+                        self._dataset_to_json(item, f"{bulkdata_uri}/{tag_str}/{index}")
+                        for index, item in enumerate(elem.value)
+                    ],
                 }
+                continue
+            
+            result[tag_str] = {
+                "vr": elem.VR,
+                "Value": value_to_json(elem),
+            }
         
-        return json.dumps(result)
+        return result
     
-    def get_pixel_data(self, file_path: Path, frame: int = 1) -> Optional[bytes]:
-        """Get pixel data for a specific frame."""
-        ds = dcmread(file_path)
+    def get_bulkdata(self, file_path: Path, tag_path: str, sop_uid: Optional[str] = None) -> Optional[Tuple[int, int]]:
+        """Locate a binary value by BulkDataURI tag path (``TAG`` or ``SEQ/item/TAG/...``).
+        
+        Returns the ``(file offset, length)`` of the value bytes, or None if the
+        path does not resolve to a binary element.
+        """
+        parts = tag_path.strip("/").split("/")
+        if len(parts) % 2 != 1:
+            return None
+        
+        ds = self.read_header(file_path, sop_uid)
+        if ds.file_meta.TransferSyntaxUID.is_deflated:
+            return None  # value offsets refer to the inflated stream, not the file
+        
+        # Elements inside defined-length sequences are positioned relative to the sequence value
+        base = 0
+        try:
+            for sequence_tag, index in zip(parts[0:-1:2], parts[1:-1:2]):
+                sequence = ds[Tag(int(sequence_tag, 16))]
+                if not sequence.is_undefined_length:
+                    base += sequence.file_tell
+                ds = sequence.value[int(index)]
+            tag = Tag(int(parts[-1], 16))
+        except (ValueError, KeyError, IndexError, TypeError):
+            return None
         
-        if "PixelData" not in ds:
+        if tag not in ds or element_vr(ds, tag) not in BINARY_VRS:
             return None
         
-        pixel_array = ds.pixel_array
+        raw = ds.get_item(tag, keep_deferred=True)
+        if isinstance(raw, RawDataElement):
+            return base + raw.value_tell, raw.length
+        return base + raw.file_tell, len(raw.value or b"")
+    
+    def get_pixel_data(self, file_path: Path, frame: int = 1, sop_uid: Optional[str] = None) -> Optional[bytes]:
+        """Get decoded pixel data for a specific frame, cached by (SOP Instance UID, frame) when given."""
+        if sop_uid is not None:
+            pixel_data = dicom_cache.get_frame(sop_uid, frame)
+            if pixel_data is not None:
+                return pixel_data
+        
+        with timed_stage("frame_decode"):
+            pixel_data = frame_accessor.read_decoded_frame(file_path, frame)
+        
+        if sop_uid is not None and pixel_data is not None:
+            dicom_cache.put_frame(sop_uid, frame, pixel_data)
+        return pixel_data
+
+    async def get_pixel_data_async(self, file_path: Path, frame: int = 1, sop_uid: Optional[str] = None) -> Optional[bytes]:
+        """``get_pixel_data`` for async callers.
         
-        # Handle multi-frame
-        if len(pixel_array.shape) > 2 and pixel_array.shape[0] > 1:
-            if frame < 1 or frame > pixel_array.shape[0]:
-                return None
-            pixel_array = pixel_array[frame - 1]
+        Native frames are read on the I/O pool; compressed frames are decoded
+        on the decode process pool.
+        """
+        if sop_uid is not None:
+            pixel_data = dicom_cache.get_frame(sop_uid, frame)
+            if pixel_data is not None:
+                return pixel_data
         
-        return pixel_array.tobytes()
+        table = await blocking_executor.run_io(frame_accessor.get_table, file_path)
+        if table is not None and not table.encapsulated:
+            with timed_stage("frame_read"):
+                pixel_data = await blocking_executor.run_io(frame_accessor.read_raw_frame, file_path, frame)
+        else:
+            with timed_stage("frame_decode"):
+                pixel_data = await blocking_executor.run_cpu(decode_frame, file_path, frame)
+        
+        if sop_uid is not None and pixel_data is not None:
+            dicom_cache.put_frame(sop_uid, frame, pixel_data)
+        return pixel_data
+
+    def get_raw_frame(self, file_path: Path, frame: int = 1) -> Optional[bytes]:
+        """Get a frame in its stored transfer syntax (encapsulated fragment or native slice)."""
+        return frame_accessor.read_raw_frame(file_path, frame)
+
+    def to_explicit_little_endian(self, file_path: Path) -> bytes:
+        """Re-encode a stored instance as Explicit VR Little Endian."""
+        with timed_stage("dcmread"):
+            ds = dcmread(file_path)
+        if ds.file_meta.TransferSyntaxUID.is_compressed:
+            with timed_stage("frame_decode"):
+                ds.decompress()
+        else:
+            ds.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+        buffer = io.BytesIO()
+        ds.save_as(buffer, enforce_file_format=True)
+        return buffer.getvalue()
+
+    def get_transfer_syntax(self, file_path: Path) -> Optional[str]:
+        """Get the stored transfer syntax UID of a file."""
+        table = frame_accessor.get_table(file_path)
+        if table is not None:
+            return table.transfer_syntax_uid
+        return self.parse_file(file_path)["transfer_syntax_uid"]
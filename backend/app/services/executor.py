@@ -0,0 +1,145 @@
+"""Bounded executors for blocking file I/O and CPU-heavy decoding"""
+
+import asyncio
+import contextvars
+import functools
+import multiprocessing
+import threading
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from app.config import settings
+from app.services.profiling import current_profile
+
+
+def worker_context() -> multiprocessing.context.BaseContext:
+    """Start method for worker processes.
+
+    The server is multi-threaded by the time a pool starts its workers, and a
+    forked child inherits whatever locks other threads held at that moment
+    (metrics, caches, the index), so workers come from a fork server, or are
+    spawned where there is none. Either way they import the app afresh and
+    share no state with this process: stage timings recorded inside a worker
+    stay there, so callers time the submission instead.
+    """
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context("forkserver")
+    return multiprocessing.get_context("spawn")
+
+
+def _timed_call(fn: Callable, args: tuple, kwargs: dict) -> Tuple[float, Any]:
+    """Run ``fn`` and report when it started (wall clock, comparable across processes)."""
+    return time.time(), fn(*args, **kwargs)
+
+
+class PoolStats:
+    """Queue depth and wait-time counters of one pool."""
+
+    def __init__(self, workers: int):
+        self.workers = workers
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+        self.run_seconds = 0.0
+        self._lock = threading.Lock()
+
+    def submit(self) -> None:
+        with self._lock:
+            self.submitted += 1
+
+    def finish(self, wait: float, run: float, ok: bool) -> None:
+        with self._lock:
+            self.completed += 1
+            self.failed += 0 if ok else 1
+            self.wait_seconds += wait
+            self.max_wait_seconds = max(self.max_wait_seconds, wait)
+            self.run_seconds += run
+
+    def to_dict(self) -> Dict[str, Any]:
+        with self._lock:
+            in_flight = self.submitted - self.completed
+            return {
+                "workers": self.workers,
+                "submitted": self.submitted,
+                "completed": self.completed,
+                "failed": self.failed,
+                "in_flight": in_flight,
+                "queue_depth": max(in_flight - self.workers, 0),
+                "avg_wait_ms": round(1000 * self.wait_seconds / self.completed, 3) if self.completed else 0.0,
+                "max_wait_ms": round(1000 * self.max_wait_seconds, 3),
+                "avg_run_ms": round(1000 * self.run_seconds / self.completed, 3) if self.completed else 0.0,
+            }
+
+
+class BlockingExecutor:
+    """Keep blocking work off the event loop.
+
+    File reads, header parsing and directory operations run on a bounded
+    thread pool; pixel decoding of compressed frames runs on a process pool
+    so it neither holds the GIL nor competes with light requests for I/O
+    threads. Both pools are created lazily.
+    """
+
+    def __init__(self, io_workers: int, cpu_workers: int):
+        self.io_workers = io_workers
+        self.cpu_workers = cpu_workers
+        self.io_stats = PoolStats(io_workers)
+        self.cpu_stats = PoolStats(cpu_workers)
+        self._io: Optional[Executor] = None
+        self._cpu: Optional[Executor] = None
+        self._lock = threading.Lock()
+
+    @property
+    def io_pool(self) -> Executor:
+        with self._lock:
+            if self._io is None:
+                self._io = ThreadPoolExecutor(max_workers=self.io_workers, thread_name_prefix="blocking-io")
+            return self._io
+
+    @property
+    def cpu_pool(self) -> Executor:
+        with self._lock:
+            if self._cpu is None:
+                self._cpu = ProcessPoolExecutor(max_workers=self.cpu_workers, mp_context=worker_context())
+            return self._cpu
+
+    async def run_io(self, fn: Callable, *args, **kwargs) -> Any:
+        """Run blocking I/O on the thread pool."""
+        return await self._run(self.io_pool, self.io_stats, fn, args, kwargs)
+
+    async def run_cpu(self, fn: Callable, *args, **kwargs) -> Any:
+        """Run CPU-bound work on the process pool (``fn`` and its arguments must be picklable)."""
+        return await self._run(self.cpu_pool, self.cpu_stats, fn, args, kwargs)
+
+    async def _run(self, pool: Executor, stats: PoolStats, fn: Callable, args: tuple, kwargs: dict) -> Any:
+        loop = asyncio.get_running_loop()
+        call = functools.partial(_timed_call, fn, args, kwargs)
+        profile = current_profile()
+        if profile is not None and pool is self._io:
+            # Sample the worker thread and let stage timings find the profile there
+            call = functools.partial(contextvars.copy_context().run, profile.run_in_thread, call)
+        stats.submit()
+        submitted_at = time.time()
+        try:
+            started_at, result = await loop.run_in_executor(pool, call)
+        except BaseException:
+            stats.finish(time.time() - submitted_at, 0.0, ok=False)
+            raise
+        stats.finish(started_at - submitted_at, time.time() - started_at, ok=True)
+        return result
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        return {"io": self.io_stats.to_dict(), "cpu": self.cpu_stats.to_dict()}
+
+    def shutdown(self) -> None:
+        with self._lock:
+            for pool in (self._io, self._cpu):
+                if pool is not None:
+                    pool.shutdown(wait=False, cancel_futures=True)
+            self._io = self._cpu = None
+
+
+blocking_executor = BlockingExecutor(settings.IO_WORKERS, settings.DECODE_WORKERS)
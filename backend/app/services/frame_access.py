@@ -0,0 +1,282 @@
+"""Frame-level access to pixel data without decoding whole multi-frame objects"""
+
+import copy
+import os
+import struct
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from pydicom import dcmread
+from pydicom.dataset import Dataset
+from pydicom.encaps import encapsulate
+from pydicom.pixels import pixel_array
+from pydicom.uid import UID, ImplicitVRLittleEndian
+
+from app.config import settings
+
+
+ITEM_TAG = 0xFFFEE000
+SEQUENCE_DELIMITER_TAG = 0xFFFEE0DD
+PIXEL_DATA_TAG = 0x7FE00010
+
+# Start-of-codestream markers used to split fragments into frames when there is no offset table
+FRAME_START_MARKERS = (b"\xff\xd8", b"\xff\x4f")
+
+# Image Pixel module attributes a decoder needs to interpret one frame
+PIXEL_MODULE_KEYWORDS = (
+    "SamplesPerPixel",
+    "PhotometricInterpretation",
+    "PlanarConfiguration",
+    "Rows",
+    "Columns",
+    "BitsAllocated",
+    "BitsStored",
+    "HighBit",
+    "PixelRepresentation",
+)
+
+
+@dataclass
+class FrameTable:
+    """Location of every frame's bytes inside a stored DICOM file."""
+
+    transfer_syntax_uid: str
+    number_of_frames: int
+    encapsulated: bool
+    header: Dataset
+    # Per frame: list of (absolute file offset, length) spans to concatenate
+    spans: List[List[Tuple[int, int]]] = field(default_factory=list)
+
+
+class FrameAccessor:
+    """Seek to and read individual frames of stored DICOM files.
+
+    For native transfer syntaxes a frame's byte range is computed directly.
+    For encapsulated syntaxes the Extended or Basic Offset Table is used,
+    falling back to a single scan of the fragment items. The resulting
+    frame tables are cached per file so each file is scanned only once.
+    """
+
+    def __init__(self, max_tables: int = 1024):
+        self.max_tables = max_tables
+        self._tables: "OrderedDict[tuple, Optional[FrameTable]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get_table(self, file_path: Path) -> Optional[FrameTable]:
+        """Return the (cached) frame table, or None if frames cannot be located directly."""
+        stat = os.stat(file_path)
+        key = (str(file_path), stat.st_mtime_ns, stat.st_size)
+
+        with self._lock:
+            if key in self._tables:
+                self._tables.move_to_end(key)
+                self.hits += 1
+                return self._tables[key]
+            self.misses += 1
+
+        table = self._build_table(file_path)
+
+        with self._lock:
+            self._tables[key] = table
+            while len(self._tables) > self.max_tables:
+                self._tables.popitem(last=False)
+        return table
+
+    def invalidate(self, file_path: Optional[Path] = None) -> None:
+        """Drop cached tables for one file, or all of them."""
+        with self._lock:
+            if file_path is None:
+                self._tables.clear()
+                return
+            for key in [k for k in self._tables if k[0] == str(file_path)]:
+                del self._tables[key]
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"entries": len(self._tables), "hits": self.hits, "misses": self.misses}
+
+    def read_raw_frame(self, file_path: Path, frame: int) -> Optional[bytes]:
+        """Return one frame's bytes in the stored transfer syntax (1-based frame)."""
+        table = self.get_table(file_path)
+        if table is None:
+            return None
+        if frame < 1 or frame > len(table.spans):
+            return None
+
+        with open(file_path, "rb") as f:
+            return b"".join(self._read_span(f, offset, length) for offset, length in table.spans[frame - 1])
+
+    def read_decoded_frame(self, file_path: Path, frame: int) -> Optional[bytes]:
+        """Return one frame as uncompressed pixel bytes (1-based frame)."""
+        table = self.get_table(file_path)
+
+        if table is None:
+            # Layout we can't seek in (deflated, big endian, bit-packed...): let pydicom decode
+            ds = dcmread(file_path, stop_before_pixels=True)
+            number_of_frames = int(ds.NumberOfFrames) if "NumberOfFrames" in ds else 1
+            if frame < 1 or frame > number_of_frames:
+                return None
+            try:
+                return pixel_array(file_path, index=frame - 1).tobytes()
+            except (AttributeError, KeyError, ValueError):
+                return None
+
+        raw = self.read_raw_frame(file_path, frame)
+        if raw is None or not table.encapsulated:
+            return raw
+
+        # A fresh dataset per call: the cached header is shared between threads and must stay untouched
+        frame_ds = Dataset()
+        frame_ds.file_meta = copy.deepcopy(table.header.file_meta)
+        for keyword in PIXEL_MODULE_KEYWORDS:
+            if keyword in table.header:
+                setattr(frame_ds, keyword, table.header[keyword].value)
+        frame_ds.NumberOfFrames = 1
+        frame_ds.PixelData = encapsulate([raw])
+        frame_ds["PixelData"].VR = "OB"
+        return frame_ds.pixel_array.tobytes()
+
+    # ---------- Table construction ----------
+
+    def _build_table(self, file_path: Path) -> Optional[FrameTable]:
+        with open(file_path, "rb") as f:
+            header = dcmread(f, stop_before_pixels=True, defer_size=settings.BULKDATA_THRESHOLD)
+
+            tsyntax = UID(
+                header.file_meta.TransferSyntaxUID
+                if hasattr(header, "file_meta") and "TransferSyntaxUID" in header.file_meta
+                else ImplicitVRLittleEndian
+            )
+            if tsyntax.is_deflated or not tsyntax.is_little_endian:
+                return None
+
+            tag_bytes = f.read(4)
+            if len(tag_bytes) < 4:
+                return None
+            group, elem = struct.unpack("<HH", tag_bytes)
+            if (group << 16 | elem) != PIXEL_DATA_TAG:
+                return None
+
+            if tsyntax.is_implicit_VR:
+                (length,) = struct.unpack("<L", f.read(4))
+            else:
+                vr = f.read(2)
+                if vr in (b"OB", b"OW", b"UN"):
+                    f.read(2)
+                    (length,) = struct.unpack("<L", f.read(4))
+                else:
+                    (length,) = struct.unpack("<H", f.read(2))
+
+            number_of_frames = int(header.NumberOfFrames) if "NumberOfFrames" in header else 1
+            number_of_frames = max(number_of_frames, 1)
+            table = FrameTable(
+                transfer_syntax_uid=str(tsyntax),
+                number_of_frames=number_of_frames,
+                encapsulated=tsyntax.is_encapsulated,
+                header=header,
+            )
+
+            if tsyntax.is_encapsulated:
+                table.spans = self._encapsulated_spans(f, header, number_of_frames)
+            else:
+                frame_length = self._native_frame_length(header)
+                if frame_length is None or frame_length * number_of_frames > length:
+                    return None
+                value_offset = f.tell()
+                table.spans = [
+                    [(value_offset + i * frame_length, frame_length)]
+                    for i in range(number_of_frames)
+                ]
+
+        return table if table.spans else None
+
+    def _native_frame_length(self, header: Dataset) -> Optional[int]:
+        bits_allocated = int(header.BitsAllocated) if "BitsAllocated" in header else 0
+        if bits_allocated < 8 or bits_allocated % 8:
+            return None  # bit-packed data is not byte addressable per frame
+        if int(getattr(header, "PlanarConfiguration", 0) or 0) == 1:
+            return None  # planar data needs reshuffling into the interleaved layout
+        if str(getattr(header, "PhotometricInterpretation", "")) == "YBR_FULL_422":
+            return None
+        if "Rows" not in header or "Columns" not in header:
+            return None
+        samples = int(header.SamplesPerPixel) if "SamplesPerPixel" in header else 1
+        return int(header.Rows) * int(header.Columns) * samples * bits_allocated // 8
+
+    def _encapsulated_spans(self, f, header: Dataset, number_of_frames: int) -> List[List[Tuple[int, int]]]:
+        # Basic Offset Table item
+        group, elem, bot_length = struct.unpack("<HHL", f.read(8))
+        if (group << 16 | elem) != ITEM_TAG:
+            return []
+        bot = list(struct.unpack(f"<{bot_length // 4}L", f.read(bot_length))) if bot_length else []
+        first_fragment = f.tell()
+
+        # Extended Offset Table: one fragment per frame, offsets relative to the first fragment
+        if "ExtendedOffsetTable" in header and "ExtendedOffsetTableLengths" in header:
+            offsets = struct.unpack(f"<{number_of_frames}Q", header.ExtendedOffsetTable)
+            lengths = struct.unpack(f"<{number_of_frames}Q", header.ExtendedOffsetTableLengths)
+            return [
+                [(first_fragment + offset + 8, length)]
+                for offset, length in zip(offsets, lengths)
+            ]
+
+        # Single pass over the fragment items: (item offset relative to first fragment, value offset, length, marker)
+        fragments = []
+        while True:
+            item = f.read(8)
+            if len(item) < 8:
+                break
+            group, elem, length = struct.unpack("<HHL", item)
+            tag = group << 16 | elem
+            if tag == SEQUENCE_DELIMITER_TAG:
+                break
+            if tag != ITEM_TAG or length == 0xFFFFFFFF:
+                return []
+            value_offset = f.tell()
+            marker = f.read(2) if length >= 2 else b""
+            fragments.append((value_offset - 8 - first_fragment, value_offset, length, marker))
+            f.seek(value_offset + length)
+
+        if not fragments:
+            return []
+
+        if bot:
+            spans: List[List[Tuple[int, int]]] = [[] for _ in bot]
+            frame = 0
+            for relative, value_offset, length, _ in fragments:
+                while frame + 1 < len(bot) and relative >= bot[frame + 1]:
+                    frame += 1
+                spans[frame].append((value_offset, length))
+            return spans
+
+        if len(fragments) == number_of_frames:
+            return [[(value_offset, length)] for _, value_offset, length, _ in fragments]
+
+        if number_of_frames == 1:
+            return [[(value_offset, length) for _, value_offset, length, _ in fragments]]
+
+        # No offset table and several fragments per frame: split on codestream start markers
+        spans = []
+        for _, value_offset, length, marker in fragments:
+            if marker in FRAME_START_MARKERS or not spans:
+                spans.append([])
+            spans[-1].append((value_offset, length))
+        return spans if len(spans) == number_of_frames else []
+
+    @staticmethod
+    def _read_span(f, offset: int, length: int) -> bytes:
+        f.seek(offset)
+        return f.read(length)
+
+
+frame_accessor = FrameAccessor()
+
+
+def decode_frame(file_path: Path, frame: int) -> Optional[bytes]:
+    """Picklable entry point for decoding a frame in a worker process."""
+    return frame_accessor.read_decoded_frame(file_path, frame)
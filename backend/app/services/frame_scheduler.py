@@ -0,0 +1,437 @@
+"""Priority scheduling of frame decodes and read-ahead around the viewer's position"""
+
+import asyncio
+import heapq
+import itertools
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Mapping, Optional, Set, Tuple
+
+from app.config import settings
+from app.services.cache import dicom_cache
+from app.services.dicom_parser import DICOMParserService
+from app.services.executor import blocking_executor
+from app.services.lifecycle import storage_lifecycle
+from app.services.metadata_index import metadata_index
+from app.services.storage import instance_store
+
+# Frames behind the scroll direction count as this many times further away
+BEHIND_WEIGHT = 2.0
+# Read-ahead yields to a requested frame at the same distance
+READ_AHEAD_OFFSET = 0.5
+# Other series of the study come after every frame of the series in view
+OTHER_SERIES_PRIORITY = 1e6
+
+MAX_SERIES = 256  # series frame orders kept
+MAX_VIEWERS = 1024  # viewport hints kept
+MAX_WARMED = 8192  # read-ahead frames remembered until they are requested
+MAX_PENDING = 4096  # queued read-ahead entries before stale ones are dropped
+
+
+@dataclass(frozen=True)
+class ViewportHint:
+    """Where a viewer is in a series: a 0-based position in the series' frame order and the scroll direction."""
+
+    index: int
+    direction: int = 1
+
+    @classmethod
+    def from_headers(cls, headers: Mapping[str, str]) -> Optional["ViewportHint"]:
+        """Parse ``X-Viewport-Index`` and ``X-Scroll-Direction`` (a signed number); None without a valid index."""
+        try:
+            index = int(headers.get("x-viewport-index", ""))
+        except ValueError:
+            return None
+        try:
+            direction = -1 if float(headers.get("x-scroll-direction", 1)) < 0 else 1
+        except ValueError:
+            direction = 1
+        return cls(max(index, 0), direction)
+
+    def distance(self, position: int) -> float:
+        delta = position - self.index
+        return abs(delta) * (BEHIND_WEIGHT if delta * self.direction < 0 else 1.0)
+
+
+def viewer_id(headers: Mapping[str, str], client_host: Optional[str]) -> str:
+    """Whose hints a request carries: ``X-Viewer-Id`` when the client sends one, else its address."""
+    return headers.get("x-viewer-id") or client_host or ""
+
+
+@dataclass
+class SeriesFrames:
+    """Display order of a series' frames: instances by instance number, then their frames."""
+
+    study_uid: str
+    series_uid: str
+    frames: List[Tuple[str, int, str]] = field(default_factory=list)  # (SOP UID, frame, stored file path)
+    positions: Dict[Tuple[str, int], int] = field(default_factory=dict)
+
+
+class _Waiter:
+    __slots__ = ("priority", "future")
+
+    def __init__(self, priority: float):
+        self.priority = priority
+        self.future: Optional[asyncio.Future] = None
+
+
+class PriorityGate:
+    """Admit at most ``slots`` holders at once; waiters are let in lowest priority value first.
+
+    Runs on the event loop: no locking.
+    """
+
+    def __init__(self, slots: int):
+        self.slots = slots
+        self.active = 0
+        self.waiting = 0
+        self._heap: List[Tuple[float, int, _Waiter]] = []
+        self._seq = itertools.count()
+
+    async def acquire(self, waiter: _Waiter) -> None:
+        if self.active < self.slots and not self.waiting:
+            self.active += 1
+            return
+        waiter.future = asyncio.get_running_loop().create_future()
+        self.waiting += 1
+        heapq.heappush(self._heap, (waiter.priority, next(self._seq), waiter))
+        try:
+            await waiter.future
+        except asyncio.CancelledError:
+            if waiter.future.cancelled():
+                self.waiting -= 1
+            else:
+                self.release()  # let in just as it was cancelled: pass the slot on
+            raise
+
+    def promote(self, waiter: _Waiter, priority: float) -> None:
+        """Move a queued waiter up; its old heap entry is skipped once it is let in."""
+        if priority < waiter.priority and waiter.future is not None and not waiter.future.done():
+            waiter.priority = priority
+            heapq.heappush(self._heap, (priority, next(self._seq), waiter))
+
+    def release(self) -> None:
+        while self._heap:
+            _, _, waiter = heapq.heappop(self._heap)
+            if waiter.future.done():
+                continue  # cancelled, or an entry left behind by promote()
+            self.waiting -= 1
+            waiter.future.set_result(None)  # the slot passes straight to the waiter
+            return
+        self.active -= 1
+
+    def reset(self) -> None:
+        self.active = self.waiting = 0
+        self._heap.clear()
+
+
+class _ReadAhead:
+    __slots__ = ("plan", "generation", "study_uid", "file_path", "key", "priority")
+
+    def __init__(self, plan: tuple, generation: int, study_uid: str, file_path: str, key: Tuple[str, int], priority: float):
+        self.plan = plan
+        self.generation = generation
+        self.study_uid = study_uid
+        self.file_path = file_path
+        self.key = key
+        self.priority = priority
+
+
+class FrameScheduler:
+    """Decode frames in order of distance from what the viewer shows, and warm the frame cache ahead of it.
+
+    Every frame decode waits for one of ``slots`` places, taken lowest
+    priority value first: the distance of the frame from the viewer's last
+    hinted position, with frames behind the scroll direction counting
+    double. Requests for a frame that is already being decoded share that
+    decode (and raise its priority). Opening a series, or requesting one of
+    its frames, queues the ``ahead``/``behind`` frames around the viewer's
+    position and the first ``other_series_frames`` frames of the study's
+    other series. ``workers`` of those read-ahead decodes run at a time, so
+    speculative work never takes every slot. A newer position from the same
+    viewer replaces what was queued for the old one.
+    """
+
+    def __init__(self, slots: int, ahead: int, behind: int, other_series_frames: int, workers: int):
+        self.slots = slots
+        self.ahead = ahead
+        self.behind = behind
+        self.other_series_frames = other_series_frames
+        self.workers = workers
+        self.parser = DICOMParserService()
+        self.gate = PriorityGate(slots)
+        self.counters = {"requests": 0, "joined": 0, "prefetched": 0, "prefetch_hits": 0, "stale": 0, "failures": 0}
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._running: Dict[Tuple[str, int], Tuple[asyncio.Task, _Waiter]] = {}
+        self._hints: "OrderedDict[Tuple[str, str], ViewportHint]" = OrderedDict()
+        self._plans: "OrderedDict[tuple, int]" = OrderedDict()
+        self._generations = itertools.count(1)
+        self._pending: List[Tuple[float, int, _ReadAhead]] = []
+        self._queued: Dict[Tuple[str, int], _ReadAhead] = {}
+        self._warmed: "OrderedDict[Tuple[str, int], None]" = OrderedDict()
+        self._seq = itertools.count()
+        self._tasks: Set[asyncio.Task] = set()
+        # Series orders are invalidated from ingest threads
+        self._series: "OrderedDict[str, SeriesFrames]" = OrderedDict()
+        self._study_series: Dict[str, List[str]] = {}
+        self._lock = threading.Lock()
+
+    @property
+    def read_ahead(self) -> bool:
+        return self.workers > 0 and (self.ahead > 0 or self.behind > 0 or self.other_series_frames > 0)
+
+    # ---------- Request path ----------
+
+    async def open_series(self, viewer: str, study_uid: str, series_uid: str, hint: Optional[ViewportHint] = None) -> None:
+        """Warm the frames a viewer opening a series will ask for first."""
+        if not self.read_ahead or storage_lifecycle.is_cold(study_uid):
+            return
+        self._bind_loop()
+        series = await self._series_frames(study_uid, series_uid)
+        if series is None:
+            return
+        hint = self._hint(viewer, series_uid, hint) or ViewportHint(0)
+        await self._plan(viewer, series, hint, current=True)
+
+    async def on_frame(
+        self,
+        viewer: str,
+        study_uid: str,
+        series_uid: str,
+        sop_uid: str,
+        frame: int,
+        hint: Optional[ViewportHint] = None,
+        read_ahead: bool = True,
+    ) -> float:
+        """Record a frame request and its viewport hint; returns the priority to decode the frame at.
+
+        Without a hint from this viewer the frame is served in arrival order
+        and read-ahead starts from it.
+        """
+        self._bind_loop()
+        self.counters["requests"] += 1
+        hint = self._hint(viewer, series_uid, hint)
+        if hint is None and not (read_ahead and self.read_ahead):
+            return 0.0
+        series = await self._series_frames(study_uid, series_uid)
+        position = series.positions.get((sop_uid, frame)) if series is not None else None
+        if position is None:
+            return 0.0
+        if read_ahead and self.read_ahead:
+            await self._plan(viewer, series, hint or ViewportHint(position))
+        return hint.distance(position) if hint is not None else 0.0
+
+    async def get_pixel_data(self, file_path: Path, sop_uid: str, frame: int, priority: float = 0.0) -> Optional[bytes]:
+        """A decoded frame from the cache, or decoded once its turn at the gate comes."""
+        self._bind_loop()
+        key = (sop_uid, frame)
+        pixel_data = dicom_cache.get_frame(sop_uid, frame)
+        if pixel_data is not None:
+            if key in self._warmed:
+                del self._warmed[key]
+                self.counters["prefetch_hits"] += 1
+            return pixel_data
+        return await self._decode(file_path, sop_uid, frame, priority)
+
+    # ---------- Decoding ----------
+
+    async def _decode(self, file_path: Path, sop_uid: str, frame: int, priority: float) -> Optional[bytes]:
+        key = (sop_uid, frame)
+        running = self._running.get(key)
+        if running is None:
+            waiter = _Waiter(priority)
+            task = asyncio.ensure_future(self._run(file_path, sop_uid, frame, waiter))
+            running = self._running[key] = (task, waiter)
+            task.add_done_callback(lambda done: self._finished(key, done))
+        else:
+            self.counters["joined"] += 1
+            self.gate.promote(running[1], priority)
+        # A cancelled request leaves the decode running for the others and the cache
+        return await asyncio.shield(running[0])
+
+    async def _run(self, file_path: Path, sop_uid: str, frame: int, waiter: _Waiter) -> Optional[bytes]:
+        await self.gate.acquire(waiter)
+        try:
+            return await self.parser.get_pixel_data_async(file_path, frame, sop_uid)
+        finally:
+            self.gate.release()
+
+    def _finished(self, key: Tuple[str, int], task: asyncio.Task) -> None:
+        if self._running.get(key, (None,))[0] is task:
+            del self._running[key]
+        if not task.cancelled():
+            task.exception()  # retrieved: every awaiting request may have gone away
+
+    # ---------- Read-ahead ----------
+
+    async def _plan(self, viewer: str, series: SeriesFrames, hint: ViewportHint, current: bool = False) -> None:
+        """Queue the read-ahead for a viewer's position, replacing what was queued for its last one.
+
+        ``current`` includes the frame at the position itself, which a frame request is already fetching.
+        """
+        plan = (viewer, series.series_uid)
+        generation = next(self._generations)
+        self._plans[plan] = generation
+        self._plans.move_to_end(plan)
+        while len(self._plans) > MAX_VIEWERS:
+            self._plans.popitem(last=False)
+
+        steps = [hint.index] if current else []
+        steps += [hint.index + step * hint.direction for step in range(1, self.ahead + 1)]
+        steps += [hint.index - step * hint.direction for step in range(1, self.behind + 1)]
+        for position in steps:
+            if 0 <= position < len(series.frames):
+                self._queue(plan, generation, series, position, hint.distance(position) + READ_AHEAD_OFFSET)
+
+        if self.other_series_frames:
+            for n, series_uid in enumerate(await self._other_series(series.study_uid, series.series_uid)):
+                other = await self._series_frames(series.study_uid, series_uid)
+                if other is None:
+                    continue
+                for position in range(min(self.other_series_frames, len(other.frames))):
+                    self._queue(plan, generation, other, position, OTHER_SERIES_PRIORITY * (n + 1) + position)
+
+        if len(self._pending) > MAX_PENDING:
+            self._pending = [entry for entry in self._pending if self._is_current(entry[2])]
+            heapq.heapify(self._pending)
+        self._start_workers()
+
+    def _queue(self, plan: tuple, generation: int, series: SeriesFrames, position: int, priority: float) -> None:
+        sop_uid, frame, file_path = series.frames[position]
+        key = (sop_uid, frame)
+        if key in self._running or dicom_cache.has_frame(sop_uid, frame):
+            return
+        queued = self._queued.get(key)
+        if queued is not None and self._is_current(queued) and queued.priority <= priority:
+            return
+        job = _ReadAhead(plan, generation, series.study_uid, file_path, key, priority)
+        self._queued[key] = job
+        heapq.heappush(self._pending, (priority, next(self._seq), job))
+
+    def _is_current(self, job: _ReadAhead) -> bool:
+        return self._queued.get(job.key) is job and self._plans.get(job.plan) == job.generation
+
+    def _start_workers(self) -> None:
+        while len(self._tasks) < self.workers and self._pending:
+            task = asyncio.ensure_future(self._drain())
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _drain(self) -> None:
+        while self._pending:
+            _, _, job = heapq.heappop(self._pending)
+            if not self._is_current(job):
+                if self._queued.get(job.key) is job:
+                    del self._queued[job.key]
+                    self.counters["stale"] += 1
+                continue
+            del self._queued[job.key]
+            sop_uid, frame = job.key
+            if job.key in self._running or dicom_cache.has_frame(sop_uid, frame) or storage_lifecycle.is_cold(job.study_uid):
+                continue
+            try:
+                pixel_data = await self._decode(instance_store.path(job.file_path), sop_uid, frame, job.priority)
+            except Exception:
+                self.counters["failures"] += 1
+                continue
+            if pixel_data is not None:
+                self.counters["prefetched"] += 1
+                self._warmed[job.key] = None
+                while len(self._warmed) > MAX_WARMED:
+                    self._warmed.popitem(last=False)
+
+    # ---------- Series order ----------
+
+    async def _series_frames(self, study_uid: str, series_uid: str) -> Optional[SeriesFrames]:
+        with self._lock:
+            series = self._series.get(series_uid)
+            if series is not None:
+                self._series.move_to_end(series_uid)
+                return series if series.study_uid == study_uid else None
+
+        series = await blocking_executor.run_io(self._load_series, study_uid, series_uid)
+        if series is None:
+            return None
+        with self._lock:
+            self._series[series_uid] = series
+            while len(self._series) > MAX_SERIES:
+                self._series.popitem(last=False)
+        return series
+
+    @staticmethod
+    def _load_series(study_uid: str, series_uid: str) -> Optional[SeriesFrames]:
+        instances = metadata_index.list_instances(study_uid, series_uid)
+        if not instances:
+            return None
+        series = SeriesFrames(study_uid, series_uid)
+        for instance in instances:
+            for frame in range(1, (instance.get("number_of_frames") or 1) + 1):
+                series.positions[(instance["sop_instance_uid"], frame)] = len(series.frames)
+                series.frames.append((instance["sop_instance_uid"], frame, instance["file_path"]))
+        return series
+
+    async def _other_series(self, study_uid: str, series_uid: str) -> List[str]:
+        with self._lock:
+            series_uids = self._study_series.get(study_uid)
+        if series_uids is None:
+            rows = await blocking_executor.run_io(metadata_index.list_series, study_uid)
+            series_uids = [row["series_instance_uid"] for row in rows]
+            with self._lock:
+                if len(self._study_series) >= MAX_SERIES:
+                    self._study_series.clear()
+                self._study_series[study_uid] = series_uids
+        return [uid for uid in series_uids if uid != series_uid]
+
+    def invalidate_series(self, series_keys: Iterable[Tuple[str, str]]) -> None:
+        """Forget the frame order of series whose instances changed."""
+        with self._lock:
+            for study_uid, series_uid in set(series_keys):
+                self._series.pop(series_uid, None)
+                self._study_series.pop(study_uid, None)
+
+    # ---------- Helpers ----------
+
+    def _hint(self, viewer: str, series_uid: str, hint: Optional[ViewportHint]) -> Optional[ViewportHint]:
+        """The viewer's latest hint for a series, updated with this one."""
+        key = (viewer, series_uid)
+        if hint is None:
+            return self._hints.get(key)
+        self._hints[key] = hint
+        self._hints.move_to_end(key)
+        while len(self._hints) > MAX_VIEWERS:
+            self._hints.popitem(last=False)
+        return hint
+
+    def _bind_loop(self) -> None:
+        """Drop loop-bound state left by an event loop that is gone (tests, benchmarks)."""
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop:
+            self._loop = loop
+            self.gate.reset()
+            self._running.clear()
+            self._tasks.clear()
+            self._pending.clear()
+            self._queued.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            **self.counters,
+            "slots": self.slots,
+            "active": self.gate.active,
+            "waiting": self.gate.waiting,
+            "read_ahead_queued": len(self._queued),
+            "read_ahead_workers": len(self._tasks),
+            "viewers": len(self._hints),
+        }
+
+
+frame_scheduler = FrameScheduler(
+    settings.FRAME_DECODE_SLOTS,
+    settings.FRAME_PREFETCH_AHEAD,
+    settings.FRAME_PREFETCH_BEHIND,
+    settings.FRAME_PREFETCH_OTHER_SERIES,
+    settings.FRAME_PREFETCH_WORKERS,
+)
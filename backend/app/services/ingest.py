@@ -0,0 +1,322 @@
+"""Streaming, bounded-memory ingestion of uploaded DICOM files"""
+
+import hashlib
+import time
+import uuid
+from pathlib import Path
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+
+try:
+    import python_multipart as multipart
+    from python_multipart.exceptions import FormParserError
+    from python_multipart.multipart import parse_options_header
+except ModuleNotFoundError:  # python-multipart < 0.0.13
+    import multipart
+    from multipart.exceptions import FormParserError
+    from multipart.multipart import parse_options_header
+
+from app.config import settings
+from app.services.cache import dicom_cache
+from app.services.dicom_parser import DICOMParserService
+from app.services.executor import blocking_executor
+from app.services.frame_scheduler import frame_scheduler
+from app.services.metadata_documents import metadata_documents
+from app.services.metadata_index import metadata_index
+from app.services.metrics import ingest_bytes, ingest_instances, ingest_seconds
+from app.services.pyramid import pyramid_service
+from app.services.renderer import render_service
+from app.services.storage import InstanceStore, file_digest, instance_store
+from app.services.volume import volume_service
+
+
+class IngestError(Exception):
+    """Raised when an uploaded object cannot be stored."""
+
+
+class StagedFile:
+    """An uploaded file part written to the staging directory."""
+
+    def __init__(self, filename: str, path: Path):
+        self.filename = filename
+        self.path = path
+        self.size = 0
+        self.digest: Optional[str] = None  # SHA-256, computed as the part streams in
+        self.error: Optional[str] = None
+
+
+class MultipartStager:
+    """Stream the file parts of a multipart/form-data body straight to disk.
+
+    Each part is written chunk by chunk to its own file in ``staging_dir``, so
+    memory use is bounded by the size of the chunks the server hands us.
+    """
+
+    def __init__(self, content_type: str, staging_dir: Path, max_file_size: int):
+        _, params = parse_options_header(content_type)
+        if b"boundary" not in params:
+            raise IngestError("Missing boundary in multipart body")
+        self.boundary = params[b"boundary"]
+        self.staging_dir = staging_dir
+        self.max_file_size = max_file_size
+        self.files: List[StagedFile] = []
+        self._current: Optional[StagedFile] = None
+        self._handle = None
+        self._hash = None
+        self._header_field = b""
+        self._header_value = b""
+        self._disposition = b""
+
+    def on_part_begin(self) -> None:
+        self._disposition = b""
+
+    def on_header_field(self, data: bytes, start: int, end: int) -> None:
+        self._header_field += data[start:end]
+
+    def on_header_value(self, data: bytes, start: int, end: int) -> None:
+        self._header_value += data[start:end]
+
+    def on_header_end(self) -> None:
+        if self._header_field.lower() == b"content-disposition":
+            self._disposition = self._header_value
+        self._header_field = b""
+        self._header_value = b""
+
+    def on_headers_finished(self) -> None:
+        _, options = parse_options_header(self._disposition)
+        if b"filename" not in options:
+            self._current = None  # plain form field, ignored
+            return
+        filename = options[b"filename"].decode("utf-8", errors="replace")
+        staged = StagedFile(filename, self.staging_dir / f"{uuid.uuid4().hex}.part")
+        self._handle = open(staged.path, "wb")
+        self._hash = hashlib.sha256()
+        self._current = staged
+        self.files.append(staged)
+
+    def on_part_data(self, data: bytes, start: int, end: int) -> None:
+        staged = self._current
+        if staged is None or staged.error:
+            return
+        staged.size += end - start
+        if staged.size > self.max_file_size:
+            staged.error = f"File exceeds maximum upload size of {self.max_file_size} bytes"
+            self._close_current()
+            staged.path.unlink(missing_ok=True)
+            return
+        self._handle.write(data[start:end])
+        self._hash.update(data[start:end])
+
+    def on_part_end(self) -> None:
+        if self._current is not None and not self._current.error:
+            self._current.digest = self._hash.hexdigest()
+        self._close_current()
+        self._current = None
+
+    def _close_current(self) -> None:
+        if self._handle is not None:
+            self._handle.close()
+            self._handle = None
+
+    async def stage(self, stream: AsyncIterator[bytes]) -> List[StagedFile]:
+        """Consume the request body, returning the staged file parts."""
+        callbacks = {
+            "on_part_begin": self.on_part_begin,
+            "on_part_data": self.on_part_data,
+            "on_part_end": self.on_part_end,
+            "on_header_field": self.on_header_field,
+            "on_header_value": self.on_header_value,
+            "on_header_end": self.on_header_end,
+            "on_headers_finished": self.on_headers_finished,
+        }
+        parser = multipart.MultipartParser(self.boundary, callbacks)
+        try:
+            async for chunk in stream:
+                # Part data goes straight to staging files: keep those writes off the event loop
+                await blocking_executor.run_io(parser.write, chunk)
+            await blocking_executor.run_io(parser.finalize)
+        except BaseException as exc:
+            self._close_current()
+            for staged in self.files:
+                staged.path.unlink(missing_ok=True)
+            if isinstance(exc, FormParserError):
+                raise IngestError(f"Malformed multipart body: {exc}")
+            raise
+        return self.files
+
+
+def find_duplicate(staged: StagedFile) -> Optional[Dict[str, Any]]:
+    """Metadata of the stored instance with the same content as a staged file, if any.
+
+    Answered from the index by checksum, so a re-sent instance is recognised
+    without parsing it or touching the archive.
+    """
+    if staged.digest is None:
+        return None
+    existing = metadata_index.find_by_content_hash(staged.digest)
+    if existing is None or not instance_store.exists(existing.pop("file_path")):
+        return None
+    return existing
+
+
+def store_staged_file(
+    staged_path: Path, store: InstanceStore, digest: Optional[str] = None
+) -> Tuple[Dict[str, Any], Path, str]:
+    """Parse the header of a staged file and move it into the instance store.
+    
+    Returns the extracted metadata, the path relative to the store root and
+    the instance's DICOMweb JSON, all from a single header read. Kept free of
+    shared state so it can run in a worker process.
+    """
+    try:
+        metadata, dicomweb_json = _read_instance(staged_path)
+    except IngestError:
+        staged_path.unlink(missing_ok=True)
+        raise
+
+    relative_path, metadata["content_hash"] = store.put(staged_path, metadata, digest)
+    return metadata, relative_path, dicomweb_json
+
+
+def read_stored_file(relative_path: str, store: InstanceStore) -> Tuple[Dict[str, Any], Path, str]:
+    """Parse the header of a file that is already in the instance store, to index it where it is.
+
+    Returns the same as :func:`store_staged_file`; runs in a worker process too.
+    """
+    path = store.path(relative_path)
+    metadata, dicomweb_json = _read_instance(path)
+    metadata["content_hash"] = store.recorded_digest(relative_path) or file_digest(path)
+    return metadata, Path(relative_path), dicomweb_json
+
+
+def _read_instance(path: Path) -> Tuple[Dict[str, Any], str]:
+    """Metadata and DICOMweb JSON of a DICOM file, from a single header read."""
+    try:
+        parser = DICOMParserService()
+        ds = parser.read_header(path)
+        metadata = parser._extract_metadata(ds)
+        dicomweb_json = parser.dataset_to_dicomweb_json(ds)
+    except Exception:
+        raise IngestError("Invalid DICOM file")
+
+    if not (metadata["study_instance_uid"] and metadata["series_instance_uid"] and metadata["sop_instance_uid"]):
+        raise IngestError("Missing Study, Series or SOP Instance UID")
+    return metadata, dicomweb_json
+
+
+def moved_from(metadata: Dict[str, Any], location: Optional[Dict[str, Any]]) -> Optional[Tuple[str, str, str]]:
+    """The ``(study, series, sop)`` an instance was indexed under, when it was re-sent under other UIDs."""
+    if location is None:
+        return None
+    old = (location["study_instance_uid"], location["series_instance_uid"])
+    if old == (metadata["study_instance_uid"], metadata["series_instance_uid"]):
+        return None
+    return (*old, metadata["sop_instance_uid"])
+
+
+def index_stored(batch: List[Tuple[Dict[str, Any], Path, str]]) -> None:
+    """Record stored instances in the index in one transaction and refresh what derives from them.
+
+    ``batch`` holds the results of :func:`store_staged_file`.
+    """
+    if not batch:
+        return
+    previous = metadata_index.get_locations(metadata["sop_instance_uid"] for metadata, _, _ in batch)
+    replaced = metadata_index.add_instances([(metadata, relative_path) for metadata, relative_path, _ in batch])
+    instance_store.remove(replaced)
+    moved = [moved_from(metadata, previous.get(metadata["sop_instance_uid"])) for metadata, _, _ in batch]
+    moved = [key for key in moved if key is not None]
+    metadata_documents.remove_instances(moved)
+    metadata_documents.add_instances([(metadata, dicomweb_json) for metadata, _, dicomweb_json in batch])
+    touched = {(metadata["study_instance_uid"], metadata["series_instance_uid"]) for metadata, _, _ in batch}
+    touched.update((study_uid, series_uid) for study_uid, series_uid, _ in moved)
+    volume_service.invalidate_series(touched)
+    frame_scheduler.invalidate_series(touched)
+    render_service.schedule_series_thumbnails(touched)
+    pyramid_service.schedule(metadata for metadata, _, _ in batch)
+    for metadata, _, _ in batch:
+        dicom_cache.invalidate(metadata["sop_instance_uid"])
+
+
+class IngestService:
+    """Move staged uploads into the archive and record them in the index."""
+
+    def __init__(self, storage_path: Path):
+        self.storage_path = storage_path
+        self.staging_dir = storage_path / ".staging"
+        self.staging_dir.mkdir(parents=True, exist_ok=True)
+
+    async def receive(self, content_type: str, stream: AsyncIterator[bytes]) -> List[StagedFile]:
+        """Stream an upload request body into staging files."""
+        stager = MultipartStager(content_type, self.staging_dir, settings.MAX_UPLOAD_SIZE)
+        return await stager.stage(stream)
+
+    def commit(self, staged: StagedFile) -> Tuple[Dict[str, Any], str, Optional[Tuple[str, str, str]]]:
+        """Parse the header of a staged file, move it into place and index it.
+
+        Also returns where the instance was indexed before, if it moved series (see :func:`moved_from`).
+        """
+        metadata, relative_path, dicomweb_json = store_staged_file(staged.path, instance_store, staged.digest)
+        previous = metadata_index.get_location(metadata["sop_instance_uid"])
+        instance_store.remove(metadata_index.add_instance(metadata, relative_path))
+        dicom_cache.invalidate(metadata["sop_instance_uid"])
+        return metadata, dicomweb_json, moved_from(metadata, previous)
+
+    def commit_all(self, staged_files: List[StagedFile]) -> Dict[str, Any]:
+        """Commit staged uploads, returning the upload endpoint's summary."""
+        started = time.perf_counter()
+        results = []
+        errors = []
+        documents = []
+        moved = []
+        duplicates = 0
+
+        for staged in staged_files:
+            if staged.error:
+                errors.append({"filename": staged.filename, "error": staged.error})
+                continue
+            metadata = find_duplicate(staged)
+            if metadata is not None:
+                staged.path.unlink(missing_ok=True)
+                duplicates += 1
+            else:
+                try:
+                    metadata, dicomweb_json, old_key = self.commit(staged)
+                except Exception as e:
+                    errors.append({"filename": staged.filename, "error": str(e)})
+                    continue
+                documents.append((metadata, dicomweb_json))
+                if old_key is not None:
+                    moved.append(old_key)
+            results.append({
+                "filename": staged.filename,
+                "study_uid": metadata["study_instance_uid"],
+                "series_uid": metadata["series_instance_uid"],
+                "sop_uid": metadata["sop_instance_uid"],
+                "metadata": metadata,
+            })
+
+        metadata_documents.remove_instances(moved)
+        metadata_documents.add_instances(documents)
+        touched = {(metadata["study_instance_uid"], metadata["series_instance_uid"]) for metadata, _ in documents}
+        touched.update((study_uid, series_uid) for study_uid, series_uid, _ in moved)
+        volume_service.invalidate_series(touched)
+        frame_scheduler.invalidate_series(touched)
+        render_service.schedule_series_thumbnails(touched)
+        pyramid_service.schedule(metadata for metadata, _ in documents)
+
+        ingest_instances.labels("upload", "stored").inc(len(documents))
+        ingest_instances.labels("upload", "duplicate").inc(duplicates)
+        ingest_instances.labels("upload", "failed").inc(len(errors))
+        ingest_bytes.labels("upload").inc(sum(staged.size for staged in staged_files))
+        ingest_seconds.labels("upload").observe(time.perf_counter() - started)
+
+        return {
+            "uploaded": len(results),
+            "duplicates": duplicates,
+            "failed": len(errors),
+            "results": results,
+            "errors": errors,
+        }
+
+
+ingest_service = IngestService(settings.STORAGE_PATH)
@@ -0,0 +1,159 @@
+"""Background ingestion pipeline for large folder uploads"""
+
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import Executor, ProcessPoolExecutor, as_completed
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+from app.config import settings
+from app.services.executor import worker_context
+from app.services.ingest import StagedFile, find_duplicate, index_stored, store_staged_file
+from app.services.metrics import ingest_bytes, ingest_instances, ingest_seconds
+from app.services.storage import instance_store
+
+
+class IngestJob:
+    """Progress of one background ingestion."""
+
+    def __init__(self, staged_files: List[StagedFile]):
+        self.id = uuid.uuid4().hex
+        self.staged_files = staged_files
+        self.status = "pending"
+        self.total = len(staged_files)
+        self.processed = 0
+        self.uploaded = 0
+        self.failed = 0
+        self.duplicates = 0
+        self.errors: List[Dict[str, str]] = []
+        self.study_uids: set = set()
+        self.created_at = time.time()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+
+    def to_dict(self) -> Dict[str, Any]:
+        elapsed = (self.finished_at or time.time()) - self.started_at if self.started_at else 0.0
+        return {
+            "job_id": self.id,
+            "status": self.status,
+            "total": self.total,
+            "processed": self.processed,
+            "uploaded": self.uploaded,
+            "failed": self.failed,
+            "duplicates": self.duplicates,
+            "progress": round(self.processed / self.total, 4) if self.total else 1.0,
+            "files_per_second": round(self.processed / elapsed, 2) if elapsed > 0 else None,
+            "study_uids": sorted(self.study_uids),
+            "errors": self.errors,
+        }
+
+
+class IngestPipeline:
+    """Parse, validate and store staged files on a worker pool.
+
+    Header parsing and the rename into place run in worker processes so a
+    large folder scales with cores; a coordinator thread per job collects
+    results and writes them to the metadata index in batches.
+    """
+
+    def __init__(self, storage_path: Path, workers: int, batch_size: int, max_jobs: int = 100):
+        self.storage_path = storage_path
+        self.workers = workers
+        self.batch_size = batch_size
+        self.max_jobs = max_jobs
+        self._executor: Optional[Executor] = None
+        self._jobs: "OrderedDict[str, IngestJob]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def executor(self) -> Executor:
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=worker_context())
+            return self._executor
+
+    def submit(self, staged_files: List[StagedFile]) -> IngestJob:
+        """Start ingesting staged files in the background."""
+        job = IngestJob(staged_files)
+        with self._lock:
+            self._jobs[job.id] = job
+            while len(self._jobs) > self.max_jobs:
+                self._jobs.popitem(last=False)
+        threading.Thread(target=self._run, args=(job,), name=f"ingest-{job.id[:8]}", daemon=True).start()
+        return job
+
+    def get_job(self, job_id: str) -> Optional[IngestJob]:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def _run(self, job: IngestJob) -> None:
+        job.status = "running"
+        job.started_at = time.time()
+        batch = []
+
+        try:
+            futures = {}
+            for staged in job.staged_files:
+                if staged.error:
+                    self._record_error(job, staged.filename, staged.error)
+                    continue
+                duplicate = find_duplicate(staged)
+                if duplicate is not None:
+                    # Content already archived: nothing to parse, store or index
+                    staged.path.unlink(missing_ok=True)
+                    job.study_uids.add(duplicate["study_instance_uid"])
+                    job.duplicates += 1
+                    job.uploaded += 1
+                    job.processed += 1
+                    continue
+                futures[self.executor.submit(store_staged_file, staged.path, instance_store, staged.digest)] = staged
+
+            for future in as_completed(futures):
+                staged = futures[future]
+                try:
+                    metadata, relative_path, dicomweb_json = future.result()
+                except Exception as e:
+                    self._record_error(job, staged.filename, str(e))
+                    continue
+                batch.append((metadata, relative_path, dicomweb_json))
+                if len(batch) >= self.batch_size:
+                    self._flush(job, batch)
+                    batch = []
+
+            self._flush(job, batch)
+            job.status = "completed"
+        except Exception as e:
+            job.status = "failed"
+            job.errors.append({"filename": None, "error": str(e)})
+        finally:
+            job.finished_at = time.time()
+            stored = job.uploaded - job.duplicates
+            ingest_instances.labels("folder", "stored").inc(stored)
+            ingest_instances.labels("folder", "duplicate").inc(job.duplicates)
+            ingest_instances.labels("folder", "failed").inc(job.failed)
+            ingest_bytes.labels("folder").inc(sum(staged.size for staged in job.staged_files))
+            ingest_seconds.labels("folder").observe(job.finished_at - job.started_at)
+
+    def _flush(self, job: IngestJob, batch: List[tuple]) -> None:
+        if not batch:
+            return
+        index_stored(batch)
+        job.study_uids.update(metadata["study_instance_uid"] for metadata, _, _ in batch)
+        job.uploaded += len(batch)
+        job.processed += len(batch)
+
+    def _record_error(self, job: IngestJob, filename: str, error: str) -> None:
+        job.errors.append({"filename": filename, "error": error})
+        job.failed += 1
+        job.processed += 1
+
+    def shutdown(self) -> None:
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False, cancel_futures=True)
+                self._executor = None
+
+
+ingest_pipeline = IngestPipeline(settings.STORAGE_PATH, settings.INGEST_WORKERS, settings.INGEST_BATCH_SIZE)
@@ -0,0 +1,308 @@
+"""Storage lifecycle: cold tier for idle studies, read-through restore and background reclaim of deletions"""
+
+import gzip
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, List, Optional, Set
+
+from app.config import settings
+from app.services.cache import dicom_cache
+from app.services.executor import blocking_executor
+from app.services.metadata_documents import metadata_documents
+from app.services.metadata_index import metadata_index
+from app.services.pyramid import pyramid_service
+from app.services.renderer import render_service
+from app.services.storage import InstanceStore, instance_store, is_valid_uid
+from app.services.volume import volume_service
+
+COLD_SUFFIX = ".gz"
+COPY_CHUNK_SIZE = 1024 * 1024
+SWEEP_BATCH = 100
+LOCK_STRIPES = 256
+
+# How often buffered access times are written to the index and tombstones re-checked
+FLUSH_INTERVAL = 30.0
+
+
+class StorageLifecycle:
+    """Move studies between the hot store and a compressed cold directory, and reclaim deleted ones.
+
+    Requests only record an access time in memory and check an in-memory set
+    of cold studies, so hot studies pay nothing extra. A background thread
+    writes access times to the index, moves studies idle for longer than
+    ``cold_after`` seconds to ``cold_root`` (gzip, byte-for-byte lossless,
+    so content hashes still hold), and deletes the files of tombstoned
+    studies. Reading a cold study restores all of its files to the hot store.
+
+    Metadata documents and series thumbnails stay hot, so browsing and
+    metadata requests never wake a cold study; volume and pyramid caches are
+    dropped, as they are rebuilt from the restored files on demand.
+    """
+
+    def __init__(self, store: InstanceStore, cold_root: Optional[Path], cold_after: float, interval: float):
+        self.store = store
+        self.cold_root = cold_root
+        self.cold_after = cold_after
+        self.interval = interval
+        self.counters = {"archived": 0, "restored": 0, "reclaimed": 0, "restore_seconds": 0.0}
+        self._cold: Set[str] = set()
+        self._accessed: Dict[str, float] = {}
+        self._study_locks = [threading.Lock() for _ in range(LOCK_STRIPES)]  # serialize moves of one study
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._pool: Optional[ThreadPoolExecutor] = None
+
+    def start(self) -> None:
+        self._cold = set(metadata_index.list_studies_in_tier("cold"))
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="storage-lifecycle", daemon=True)
+        self._thread.start()
+
+    def shutdown(self) -> None:
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush_access()
+        with self._lock:
+            if self._pool is not None:
+                self._pool.shutdown(wait=True)
+                self._pool = None
+
+    # ---------- Request path ----------
+
+    def touch(self, study_uid: str) -> None:
+        """Record an access; written to the index by the background thread."""
+        self._accessed[study_uid] = time.time()
+
+    def is_cold(self, study_uid: str) -> bool:
+        return study_uid in self._cold
+
+    async def ensure_hot(self, study_uid: str) -> None:
+        """Record an access and restore the study first if it is in the cold tier."""
+        self._accessed[study_uid] = time.time()
+        if study_uid in self._cold:
+            await blocking_executor.run_io(self.restore_study, study_uid)
+
+    def delete_study(self, study_uid: str) -> bool:
+        """Tombstone a study: gone from the index at once, files reclaimed in the background.
+
+        Returns False if the study is not in the index: only indexed files are ever reclaimed.
+        """
+        dicom_cache.invalidate_many(metadata_index.list_sop_uids(study_uid))
+        if not metadata_index.tombstone_study(study_uid):
+            return False
+        self._cold.discard(study_uid)
+        self._accessed.pop(study_uid, None)
+        self._wake.set()
+        return True
+
+    # ---------- Tier moves ----------
+
+    def cold_path(self, relative_path: str) -> Path:
+        return self.cold_root / f"{relative_path}{COLD_SUFFIX}"
+
+    def archive_study(self, study_uid: str) -> bool:
+        """Move a study's files to the cold tier; False if it was accessed meanwhile or has no files."""
+        if self.cold_root is None:
+            return False
+        with self._study_lock(study_uid):
+            started = time.time()
+            lifecycle = metadata_index.get_study_lifecycle(study_uid)
+            if lifecycle is None or lifecycle["tier"] != "hot":
+                return False
+
+            # Keep what browsing needs hot, so listing a cold study does not restore it
+            series_uids = [series["series_instance_uid"] for series in metadata_index.list_series(study_uid)]
+            for series_uid in series_uids:
+                metadata_documents.get_series(study_uid, series_uid)
+                try:
+                    render_service.series_thumbnail(study_uid, series_uid)
+                except Exception:
+                    pass  # previews are best effort
+
+            file_paths = [path for path in metadata_index.list_file_paths(study_uid) if self.store.exists(path)]
+            if not file_paths:
+                return False
+            list(self._executor().map(self._compress, file_paths))
+
+            metadata_index.set_study_tier(study_uid, "cold")
+            self._cold.add(study_uid)
+            if self._accessed.get(study_uid, 0.0) >= started:
+                # A request arrived while compressing: keep the study hot
+                self._cold.discard(study_uid)
+                metadata_index.set_study_tier(study_uid, "hot")
+                for relative_path in file_paths:
+                    self.cold_path(relative_path).unlink(missing_ok=True)
+                return False
+
+            dicom_cache.invalidate_many(metadata_index.list_sop_uids(study_uid))
+            self.store.remove(file_paths)
+            volume_service.remove_study(study_uid)
+            pyramid_service.remove_study(study_uid)
+            self.counters["archived"] += 1
+            return True
+
+    def restore_study(self, study_uid: str) -> int:
+        """Bring a cold study's files back to the hot store; returns the number restored."""
+        with self._study_lock(study_uid):
+            if study_uid not in self._cold:
+                return 0  # restored by a concurrent request
+            started = time.perf_counter()
+            file_paths = metadata_index.list_file_paths(study_uid)
+            restored = sum(self._executor().map(self._decompress, file_paths))
+            metadata_index.set_study_tier(study_uid, "hot")
+            self._cold.discard(study_uid)
+            metadata_documents.invalidate_partial(study_uid)
+            self.counters["restored"] += 1
+            self.counters["restore_seconds"] += time.perf_counter() - started
+            return restored
+
+    def _compress(self, relative_path: str) -> None:
+        source = self.store.path(relative_path)
+        target = self.cold_path(relative_path)
+        target.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = target.with_name(f".{target.name}.{threading.get_ident()}.tmp")
+        with open(source, "rb") as src, gzip.open(tmp_path, "wb", compresslevel=settings.COLD_COMPRESSION_LEVEL) as dst:
+            shutil.copyfileobj(src, dst, COPY_CHUNK_SIZE)
+        shutil.copystat(source, tmp_path)
+        tmp_path.replace(target)
+
+    def _decompress(self, relative_path: str) -> bool:
+        source = self.cold_path(relative_path)
+        target = self.store.path(relative_path)
+        if target.exists():
+            source.unlink(missing_ok=True)  # re-sent while cold
+            return False
+        if not source.exists():
+            return False
+        target.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = target.with_name(f".{target.name}.{threading.get_ident()}.tmp")
+        with gzip.open(source, "rb") as src, open(tmp_path, "wb") as dst:
+            shutil.copyfileobj(src, dst, COPY_CHUNK_SIZE)
+        # Keep the original mtime: thumbnails, checksum memos and frame tables key on it
+        shutil.copystat(source, tmp_path)
+        tmp_path.replace(target)
+        source.unlink()
+        return True
+
+    # ---------- Background work ----------
+
+    def flush_access(self) -> None:
+        accessed, self._accessed = self._accessed, {}
+        if accessed:
+            metadata_index.record_access(accessed)
+
+    def reclaim(self) -> int:
+        """Delete the files of tombstoned studies; returns the number of studies reclaimed."""
+        reclaimed = 0
+        while not self._stop.is_set():
+            tombstones = metadata_index.list_tombstones()
+            if not tombstones:
+                break
+            for tombstone in tombstones:
+                self._reclaim(tombstone["study_instance_uid"], tombstone["file_paths"])
+                metadata_index.remove_tombstone(tombstone["id"])
+                reclaimed += 1
+        self.counters["reclaimed"] += reclaimed
+        return reclaimed
+
+    def _reclaim(self, study_uid: str, file_paths: List[str]) -> None:
+        with self._study_lock(study_uid):
+            # A study re-sent after deletion may point at the same content-addressed objects
+            keep = metadata_index.referenced_paths(file_paths)
+            self.store.remove(path for path in file_paths if path not in keep)
+            if self.cold_root is not None:
+                for path in file_paths:
+                    if path not in keep:
+                        self.cold_path(path).unlink(missing_ok=True)
+
+            if metadata_index.get_study(study_uid) is None and is_valid_uid(study_uid):
+                metadata_documents.remove_study(study_uid)
+                render_service.remove_study(study_uid)
+                volume_service.remove_study(study_uid)
+                pyramid_service.remove_study(study_uid)
+                # What is left of <study>/<series>/<sop>.dcm directories once their files are gone
+                for root in (self.store.root, self.cold_root):
+                    if root is not None:
+                        self._remove_study_dirs(root / study_uid)
+
+    @staticmethod
+    def _remove_study_dirs(study_dir: Path) -> None:
+        """Remove a study's directories of the hierarchical layout, only if no file is left in them."""
+        if not study_dir.is_dir():
+            return
+        for series_dir in study_dir.iterdir():
+            try:
+                series_dir.rmdir()
+            except OSError:
+                pass  # not empty (files of another study version or out of band) or not a directory
+        try:
+            study_dir.rmdir()
+        except OSError:
+            pass
+
+    def sweep(self) -> int:
+        """Move studies idle for longer than ``cold_after`` to the cold tier."""
+        if self.cold_root is None:
+            return 0
+        archived = 0
+        cutoff = time.time() - self.cold_after
+        skipped: Set[str] = set()
+        while not self._stop.is_set():
+            candidates = [uid for uid in metadata_index.idle_studies(cutoff, SWEEP_BATCH + len(skipped)) if uid not in skipped]
+            if not candidates:
+                break
+            for study_uid in candidates:
+                if self._stop.is_set():
+                    break
+                try:
+                    moved = self.archive_study(study_uid)
+                except OSError:
+                    moved = False
+                if moved:
+                    archived += 1
+                else:
+                    skipped.add(study_uid)
+        return archived
+
+    def _run(self) -> None:
+        next_sweep = time.monotonic()
+        while not self._stop.is_set():
+            self._wake.wait(min(FLUSH_INTERVAL, self.interval))
+            self._wake.clear()
+            try:
+                self.flush_access()
+                self.reclaim()
+                if time.monotonic() >= next_sweep:
+                    next_sweep = time.monotonic() + self.interval
+                    self.sweep()
+            except Exception:
+                pass  # retried on the next round; tombstones and tiers are persistent
+
+    def _study_lock(self, study_uid: str) -> threading.Lock:
+        return self._study_locks[hash(study_uid) % LOCK_STRIPES]
+
+    def _executor(self) -> ThreadPoolExecutor:
+        with self._lock:
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(max_workers=settings.LIFECYCLE_WORKERS, thread_name_prefix="lifecycle")
+            return self._pool
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            **self.counters,
+            "cold_studies": len(self._cold),
+            "pending_tombstones": len(metadata_index.list_tombstones(limit=1000)),
+        }
+
+
+storage_lifecycle = StorageLifecycle(
+    instance_store, settings.COLD_STORAGE_PATH, settings.COLD_AFTER_DAYS * 86400, settings.LIFECYCLE_INTERVAL
+)
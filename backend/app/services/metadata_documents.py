@@ -0,0 +1,265 @@
+"""Precomputed, pre-compressed DICOMweb series metadata documents"""
+
+import gzip
+import hashlib
+import os
+import shutil
+import threading
+import time
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+try:
+    import brotli
+except ImportError:  # brotli is optional; gzip variants are always produced
+    brotli = None
+
+from app.config import settings
+from app.services.dicom_parser import DICOMParserService
+from app.services.metadata_index import metadata_index
+from app.services.storage import instance_store
+
+
+# Content-Encoding -> file suffix, in server preference order
+ENCODINGS = (("br", ".br"), ("gzip", ".gz"), ("identity", ""))
+
+# Brotli quality of documents rebuilt on the request path, and of their background recompression
+FAST_BROTLI_QUALITY = 4
+FINAL_BROTLI_QUALITY = 9
+LOCK_STRIPES = 256
+
+
+class SeriesDocument:
+    """Location of a built series metadata document and its variants."""
+
+    def __init__(self, directory: Path, etag: Optional[str] = None):
+        self.directory = directory
+        self.path = directory / "series.json"
+        self.etag_path = directory / "series.etag"
+        self.partial_path = directory / "series.partial"  # built while some of the files were cold
+        self._etag = etag
+
+    @property
+    def etag(self) -> str:
+        if self._etag is None:
+            self._etag = self.etag_path.read_text()
+        return self._etag
+
+    def variant(self, encoding: str) -> Optional[Path]:
+        suffix = dict(ENCODINGS)[encoding]
+        path = self.path.with_name(self.path.name + suffix)
+        return path if path.exists() else None
+
+    def negotiate(self, accept_encoding: Optional[str]) -> Tuple[str, Path]:
+        """Pick the best stored variant the client accepts."""
+        accepted = {
+            token.split(";")[0].strip().lower()
+            for token in (accept_encoding or "").split(",")
+            if token.strip() and not token.replace(" ", "").endswith(";q=0")
+        }
+        for encoding, _ in ENCODINGS:
+            if encoding == "identity" or encoding in accepted or "*" in accepted:
+                path = self.variant(encoding)
+                if path is not None:
+                    return encoding, path
+        return "identity", self.path
+
+
+class MetadataDocumentStore:
+    """Series-level DICOMweb metadata built once at ingest.
+
+    Each instance's DICOMweb JSON is kept as a fragment; the series document
+    is the fragments joined in instance order and written in identity, gzip
+    and (when available) brotli variants, with a content-derived ETag.
+    Adding or removing instances only rewrites the fragments involved and
+    marks the series stale: its next read re-joins it with a fast brotli
+    quality, and once the series has been quiet for ``rebuild_delay`` a
+    background thread rebuilds it at full quality. An ingest batch therefore
+    never pays for re-joining a whole series.
+    """
+
+    def __init__(self, root: Path, rebuild_delay: float):
+        self.root = root
+        self.rebuild_delay = rebuild_delay
+        self.parser = DICOMParserService()
+        self._lock = threading.Lock()
+        self._series_locks = [threading.Lock() for _ in range(LOCK_STRIPES)]  # one rebuild per series at a time
+        self._stale: Set[Tuple[str, str]] = set()  # fragments changed since the document was joined
+        self._pending: Dict[Tuple[str, str], float] = {}  # series -> last change, awaiting the full rebuild
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        """Start the background rebuilds of quiet series."""
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="metadata-documents", daemon=True)
+        self._thread.start()
+
+    def shutdown(self) -> None:
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _series_dir(self, study_uid: str, series_uid: str) -> Path:
+        return self.root / study_uid / series_uid
+
+    def _fragment_path(self, study_uid: str, series_uid: str, sop_uid: str) -> Path:
+        return self._series_dir(study_uid, series_uid) / "instances" / f"{sop_uid}.json"
+
+    def _series_lock(self, study_uid: str, series_uid: str) -> threading.Lock:
+        return self._series_locks[hash((study_uid, series_uid)) % LOCK_STRIPES]
+
+    # ---------- Writes ----------
+
+    def put_fragment(self, study_uid: str, series_uid: str, sop_uid: str, dicomweb_json: str) -> None:
+        """Store one instance's DICOMweb JSON (call ``invalidate`` afterwards)."""
+        path = self._fragment_path(study_uid, series_uid, sop_uid)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._atomic_write(path, dicomweb_json.encode())
+
+    def add_instances(self, items: Iterable[Tuple[Dict, str]]) -> None:
+        """Store ``(metadata, dicomweb_json)`` fragments and mark the touched series stale."""
+        touched = set()
+        for metadata, dicomweb_json in items:
+            key = (metadata["study_instance_uid"], metadata["series_instance_uid"])
+            self.put_fragment(*key, metadata["sop_instance_uid"], dicomweb_json)
+            touched.add(key)
+        self.invalidate(touched)
+
+    def remove_instance(self, study_uid: str, series_uid: str, sop_uid: str) -> None:
+        self._fragment_path(study_uid, series_uid, sop_uid).unlink(missing_ok=True)
+        self.invalidate([(study_uid, series_uid)])
+
+    def remove_instances(self, keys: Iterable[Tuple[str, str, str]]) -> None:
+        """Drop ``(study, series, sop)`` fragments and mark the touched series stale."""
+        touched = set()
+        for study_uid, series_uid, sop_uid in keys:
+            self._fragment_path(study_uid, series_uid, sop_uid).unlink(missing_ok=True)
+            touched.add((study_uid, series_uid))
+        self.invalidate(touched)
+
+    def remove_study(self, study_uid: str) -> None:
+        shutil.rmtree(self.root / study_uid, ignore_errors=True)
+
+    def invalidate(self, series_keys: Iterable[Tuple[str, str]]) -> None:
+        """Mark ``(study, series)`` documents stale: rebuilt on their next read, then in full once quiet."""
+        series_keys = set(series_keys)
+        if not series_keys:
+            return
+        for study_uid, series_uid in series_keys:
+            # Without its validator a document is rebuilt before it is served, across restarts too
+            SeriesDocument(self._series_dir(study_uid, series_uid)).etag_path.unlink(missing_ok=True)
+        now = time.monotonic()
+        with self._lock:
+            self._stale.update(series_keys)
+            self._pending.update(dict.fromkeys(series_keys, now))
+        self._wake.set()
+
+    def invalidate_partial(self, study_uid: str) -> None:
+        """Mark the study's documents built while its files were in the cold tier stale."""
+        study_dir = self.root / study_uid
+        if study_dir.is_dir():
+            self.invalidate(
+                (study_uid, series_dir.name)
+                for series_dir in study_dir.iterdir()
+                if SeriesDocument(series_dir).partial_path.exists()
+            )
+
+    def rebuild_series(
+        self, study_uid: str, series_uid: str, quality: int = FINAL_BROTLI_QUALITY
+    ) -> Optional[SeriesDocument]:
+        """Re-join a series document from its fragments in index order."""
+        key = (study_uid, series_uid)
+        with self._series_lock(study_uid, series_uid):
+            with self._lock:
+                self._stale.discard(key)  # changes from here on mark it stale again
+            document = SeriesDocument(self._series_dir(study_uid, series_uid))
+            fragments: List[bytes] = []
+            partial = False
+
+            for instance in metadata_index.list_instances(study_uid, series_uid):
+                sop_uid = instance["sop_instance_uid"]
+                fragment_path = self._fragment_path(study_uid, series_uid, sop_uid)
+                if not fragment_path.exists():
+                    file_path = instance_store.path(instance["file_path"])
+                    if not file_path.exists():
+                        partial = True  # cold: completed by invalidate_partial once the study is restored
+                        continue
+                    # Instance indexed before documents existed: convert it once
+                    dicomweb_json = self.parser.to_dicomweb_json(file_path, sop_uid)
+                    self.put_fragment(study_uid, series_uid, sop_uid, dicomweb_json)
+                fragments.append(fragment_path.read_bytes())
+
+            if not fragments and not partial:
+                shutil.rmtree(document.directory, ignore_errors=True)
+                return None
+
+            body = b"[" + b",".join(fragments) + b"]"
+            document.directory.mkdir(parents=True, exist_ok=True)
+            self._atomic_write(document.path, body)
+            self._atomic_write(document.path.with_name("series.json.gz"), gzip.compress(body, 6))
+            if brotli is not None:
+                self._atomic_write(
+                    document.path.with_name("series.json.br"),
+                    brotli.compress(body, quality=quality, mode=brotli.MODE_TEXT),
+                )
+            if partial:
+                self._atomic_write(document.partial_path, b"")
+            else:
+                document.partial_path.unlink(missing_ok=True)
+            # ETag last: a document is only served once its validator exists
+            etag = f'"{hashlib.sha1(body).hexdigest()}"'
+            self._atomic_write(document.etag_path, etag.encode())
+
+        if quality < FINAL_BROTLI_QUALITY:
+            with self._lock:
+                self._pending.setdefault(key, time.monotonic())
+            self._wake.set()
+        return SeriesDocument(document.directory, etag)
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            now = time.monotonic()
+            with self._lock:
+                due = [key for key, changed in self._pending.items() if now - changed >= self.rebuild_delay]
+                for key in due:
+                    del self._pending[key]
+                wait = min(
+                    (changed + self.rebuild_delay - now for changed in self._pending.values()), default=None
+                )
+            for study_uid, series_uid in due:
+                if self._stop.is_set():
+                    return
+                try:
+                    self.rebuild_series(study_uid, series_uid)
+                except Exception:
+                    pass  # served as built on the request path; retried on its next change
+            self._wake.wait(wait)
+            self._wake.clear()
+
+    # ---------- Reads ----------
+
+    def get_series(self, study_uid: str, series_uid: str) -> Optional[SeriesDocument]:
+        """Return the series document, rebuilding it first when it is stale or was never built."""
+        document = SeriesDocument(self._series_dir(study_uid, series_uid))
+        with self._lock:
+            stale = (study_uid, series_uid) in self._stale
+        if not stale:
+            try:
+                return SeriesDocument(document.directory, document.etag_path.read_text())
+            except FileNotFoundError:
+                pass
+        return self.rebuild_series(study_uid, series_uid, FAST_BROTLI_QUALITY)
+
+    @staticmethod
+    def _atomic_write(path: Path, data: bytes) -> None:
+        tmp_path = path.with_name(f".{path.name}.{threading.get_ident()}.tmp")
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+
+metadata_documents = MetadataDocumentStore(settings.STORAGE_PATH / ".metadata", settings.METADATA_REBUILD_DELAY)
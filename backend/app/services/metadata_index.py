@@ -0,0 +1,682 @@
+"""Persistent study/series/instance metadata index backed by SQLite"""
+
+import json
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Dict, Any, List, Optional, Iterable, Tuple
+
+from app.config import settings
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS studies (
+    study_instance_uid TEXT PRIMARY KEY,
+    patient_name TEXT,
+    patient_id TEXT,
+    patient_birth_date TEXT,
+    patient_sex TEXT,
+    study_date TEXT,
+    study_time TEXT,
+    study_description TEXT,
+    accession_number TEXT,
+    modality TEXT,
+    series_count INTEGER NOT NULL DEFAULT 0,
+    instance_count INTEGER NOT NULL DEFAULT 0
+);
+
+CREATE TABLE IF NOT EXISTS series (
+    series_instance_uid TEXT PRIMARY KEY,
+    study_instance_uid TEXT NOT NULL,
+    modality TEXT,
+    series_date TEXT,
+    series_description TEXT,
+    series_number INTEGER,
+    instance_count INTEGER NOT NULL DEFAULT 0
+);
+
+CREATE TABLE IF NOT EXISTS instances (
+    sop_instance_uid TEXT PRIMARY KEY,
+    series_instance_uid TEXT NOT NULL,
+    study_instance_uid TEXT NOT NULL,
+    sop_class_uid TEXT,
+    instance_number INTEGER,
+    number_of_frames INTEGER,
+    transfer_syntax_uid TEXT,
+    file_path TEXT NOT NULL,
+    metadata TEXT NOT NULL,
+    content_hash TEXT
+);
+
+CREATE INDEX IF NOT EXISTS ix_series_study ON series (study_instance_uid);
+CREATE INDEX IF NOT EXISTS ix_instances_series ON instances (series_instance_uid, instance_number);
+CREATE INDEX IF NOT EXISTS ix_instances_study ON instances (study_instance_uid);
+CREATE INDEX IF NOT EXISTS ix_studies_patient_id ON studies (patient_id);
+CREATE INDEX IF NOT EXISTS ix_studies_study_date ON studies (study_date);
+
+-- QIDO-RS matching keys; equality and wildcard prefixes (GLOB 'ABC*') are index range scans
+CREATE INDEX IF NOT EXISTS ix_studies_date_time ON studies (study_date, study_time, study_instance_uid);
+CREATE INDEX IF NOT EXISTS ix_studies_patient_name ON studies (patient_name);
+CREATE INDEX IF NOT EXISTS ix_studies_accession ON studies (accession_number);
+CREATE INDEX IF NOT EXISTS ix_series_modality ON series (modality, study_instance_uid);
+CREATE INDEX IF NOT EXISTS ix_instances_sop_class ON instances (sop_class_uid);
+
+-- Aggregate counts are maintained incrementally so listings never COUNT(*)
+CREATE TRIGGER IF NOT EXISTS tr_instances_insert AFTER INSERT ON instances BEGIN
+    UPDATE series SET instance_count = instance_count + 1
+        WHERE series_instance_uid = NEW.series_instance_uid;
+    UPDATE studies SET instance_count = instance_count + 1
+        WHERE study_instance_uid = NEW.study_instance_uid;
+END;
+
+CREATE TRIGGER IF NOT EXISTS tr_instances_delete AFTER DELETE ON instances BEGIN
+    UPDATE series SET instance_count = instance_count - 1
+        WHERE series_instance_uid = OLD.series_instance_uid;
+    UPDATE studies SET instance_count = instance_count - 1
+        WHERE study_instance_uid = OLD.study_instance_uid;
+END;
+
+-- Instances re-sent under corrected Study or Series UIDs move between parents
+CREATE TRIGGER IF NOT EXISTS tr_instances_move AFTER UPDATE OF series_instance_uid, study_instance_uid ON instances
+WHEN OLD.series_instance_uid != NEW.series_instance_uid OR OLD.study_instance_uid != NEW.study_instance_uid BEGIN
+    UPDATE series SET instance_count = instance_count - 1
+        WHERE series_instance_uid = OLD.series_instance_uid;
+    UPDATE studies SET instance_count = instance_count - 1
+        WHERE study_instance_uid = OLD.study_instance_uid;
+    UPDATE series SET instance_count = instance_count + 1
+        WHERE series_instance_uid = NEW.series_instance_uid;
+    UPDATE studies SET instance_count = instance_count + 1
+        WHERE study_instance_uid = NEW.study_instance_uid;
+END;
+
+CREATE TRIGGER IF NOT EXISTS tr_series_insert AFTER INSERT ON series BEGIN
+    UPDATE studies SET series_count = series_count + 1
+        WHERE study_instance_uid = NEW.study_instance_uid;
+END;
+
+CREATE TRIGGER IF NOT EXISTS tr_series_delete AFTER DELETE ON series BEGIN
+    UPDATE studies SET series_count = series_count - 1
+        WHERE study_instance_uid = OLD.study_instance_uid;
+END;
+
+CREATE TRIGGER IF NOT EXISTS tr_series_move AFTER UPDATE OF study_instance_uid ON series
+WHEN OLD.study_instance_uid != NEW.study_instance_uid BEGIN
+    UPDATE studies SET series_count = series_count - 1
+        WHERE study_instance_uid = OLD.study_instance_uid;
+    UPDATE studies SET series_count = series_count + 1
+        WHERE study_instance_uid = NEW.study_instance_uid;
+END;
+
+-- Storage lifecycle: storage tier and last access of each study (unix seconds)
+CREATE TABLE IF NOT EXISTS study_lifecycle (
+    study_instance_uid TEXT PRIMARY KEY,
+    tier TEXT NOT NULL DEFAULT 'hot',
+    last_accessed REAL NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS ix_study_lifecycle_idle ON study_lifecycle (tier, last_accessed);
+
+CREATE TRIGGER IF NOT EXISTS tr_studies_insert AFTER INSERT ON studies BEGIN
+    INSERT OR IGNORE INTO study_lifecycle (study_instance_uid, last_accessed)
+        VALUES (NEW.study_instance_uid, (julianday('now') - 2440587.5) * 86400.0);
+END;
+
+CREATE TRIGGER IF NOT EXISTS tr_studies_delete AFTER DELETE ON studies BEGIN
+    DELETE FROM study_lifecycle WHERE study_instance_uid = OLD.study_instance_uid;
+END;
+
+-- Deleted studies whose files are still to be reclaimed
+CREATE TABLE IF NOT EXISTS tombstones (
+    id INTEGER PRIMARY KEY,
+    study_instance_uid TEXT NOT NULL,
+    file_paths TEXT NOT NULL,
+    deleted_at REAL NOT NULL
+);
+
+-- What the archive reconciler last saw on disk (paths relative to the store root)
+CREATE TABLE IF NOT EXISTS archive_dirs (
+    path TEXT PRIMARY KEY,
+    mtime_ns INTEGER NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS archive_files (
+    path TEXT PRIMARY KEY,
+    dir TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS ix_archive_files_dir ON archive_files (dir);
+"""
+
+STUDY_COLUMNS = (
+    "patient_name", "patient_id", "patient_birth_date", "patient_sex",
+    "study_date", "study_time", "study_description", "accession_number", "modality",
+)
+
+SERIES_COLUMNS = ("modality", "series_date", "series_description", "series_number")
+
+
+def _like_escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+class MetadataIndex:
+    """Embedded index of parsed DICOM metadata.
+
+    Ingest writes each instance's ``_extract_metadata`` output here, and the
+    listing and QIDO endpoints answer from it instead of walking storage.
+    """
+
+    def __init__(self, db_path: Path):
+        self.db_path = db_path
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(str(db_path), check_same_thread=False, isolation_level=None)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(SCHEMA)
+        self._migrate()
+
+    def _migrate(self) -> None:
+        """Bring an index created by an earlier version up to the current schema."""
+        columns = {row["name"] for row in self._conn.execute("PRAGMA table_info(instances)")}
+        if "content_hash" not in columns:
+            self._conn.execute("ALTER TABLE instances ADD COLUMN content_hash TEXT")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS ix_instances_content_hash ON instances (content_hash)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS ix_instances_file_path ON instances (file_path)")
+        # Studies indexed before lifecycle tracking count as accessed now
+        self._conn.execute(
+            "INSERT OR IGNORE INTO study_lifecycle (study_instance_uid, last_accessed)"
+            " SELECT study_instance_uid, ? FROM studies",
+            (time.time(),),
+        )
+
+    # ---------- Writes ----------
+
+    def add_instance(self, metadata: Dict[str, Any], file_path: Path) -> List[str]:
+        """Insert or update a single instance."""
+        return self.add_instances([(metadata, file_path)])
+
+    def add_instances(self, items: Iterable[tuple]) -> List[str]:
+        """Insert or update a batch of ``(metadata, file_path)`` pairs in one transaction.
+
+        Returns the paths that updated instances no longer point at.
+        """
+        replaced = []
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                for metadata, file_path in items:
+                    previous = self._upsert(metadata, file_path)
+                    if previous is not None and previous != str(file_path):
+                        replaced.append(previous)
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return replaced
+
+    def _upsert(self, metadata: Dict[str, Any], file_path: Path) -> Optional[str]:
+        previous = self._conn.execute(
+            "SELECT file_path, study_instance_uid, series_instance_uid FROM instances WHERE sop_instance_uid = ?",
+            (metadata["sop_instance_uid"],),
+        ).fetchone()
+        study_uid = metadata["study_instance_uid"]
+        series_uid = metadata["series_instance_uid"]
+
+        # Attributes of the latest instance win, so corrections to patient or study details are picked up
+        study_values = [metadata.get(c) for c in STUDY_COLUMNS]
+        self._conn.execute(
+            f"""
+            INSERT INTO studies (study_instance_uid, {", ".join(STUDY_COLUMNS)})
+            VALUES (?, {", ".join("?" for _ in STUDY_COLUMNS)})
+            ON CONFLICT (study_instance_uid) DO UPDATE SET
+            {", ".join(f"{c} = COALESCE(excluded.{c}, studies.{c})" for c in STUDY_COLUMNS)}
+            """,
+            [study_uid, *study_values],
+        )
+
+        series_values = [metadata.get(c) for c in SERIES_COLUMNS]
+        self._conn.execute(
+            f"""
+            INSERT INTO series (series_instance_uid, study_instance_uid, {", ".join(SERIES_COLUMNS)})
+            VALUES (?, ?, {", ".join("?" for _ in SERIES_COLUMNS)})
+            ON CONFLICT (series_instance_uid) DO UPDATE SET
+            study_instance_uid = excluded.study_instance_uid,
+            {", ".join(f"{c} = COALESCE(excluded.{c}, series.{c})" for c in SERIES_COLUMNS)}
+            """,
+            [series_uid, study_uid, *series_values],
+        )
+
+        self._conn.execute(
+            """
+            INSERT INTO instances (
+                sop_instance_uid, series_instance_uid, study_instance_uid, sop_class_uid,
+                instance_number, number_of_frames, transfer_syntax_uid, file_path, metadata, content_hash
+            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (sop_instance_uid) DO UPDATE SET
+                series_instance_uid = excluded.series_instance_uid,
+                study_instance_uid = excluded.study_instance_uid,
+                sop_class_uid = excluded.sop_class_uid,
+                instance_number = excluded.instance_number,
+                number_of_frames = excluded.number_of_frames,
+                transfer_syntax_uid = excluded.transfer_syntax_uid,
+                file_path = excluded.file_path,
+                metadata = excluded.metadata,
+                content_hash = excluded.content_hash
+            """,
+            [
+                metadata["sop_instance_uid"],
+                series_uid,
+                study_uid,
+                metadata.get("sop_class_uid"),
+                metadata.get("instance_number"),
+                metadata.get("number_of_frames"),
+                metadata.get("transfer_syntax_uid"),
+                str(file_path),
+                json.dumps(metadata),
+                metadata.get("content_hash"),
+            ],
+        )
+        if previous is not None and (previous["study_instance_uid"], previous["series_instance_uid"]) != (study_uid, series_uid):
+            self._prune(previous["study_instance_uid"], previous["series_instance_uid"])
+        return previous["file_path"] if previous else None
+
+    def _prune(self, study_uid: str, series_uid: str) -> None:
+        """Drop a series, and then its study, once no instance is left in it."""
+        self._conn.execute(
+            "DELETE FROM series WHERE series_instance_uid = ? AND instance_count <= 0", (series_uid,)
+        )
+        self._conn.execute(
+            "DELETE FROM studies WHERE study_instance_uid = ? AND instance_count <= 0"
+            " AND NOT EXISTS (SELECT 1 FROM series WHERE study_instance_uid = ?)",
+            (study_uid, study_uid),
+        )
+
+    def relocate_instances(self, moves: Iterable[Tuple[str, str, str]]) -> set:
+        """Repoint instances from ``(old_path, new_path, content_hash)`` in one transaction.
+
+        Returns the old paths that were indexed.
+        """
+        moved = set()
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                for old_path, new_path, content_hash in moves:
+                    cur = self._conn.execute(
+                        "UPDATE instances SET file_path = ?, content_hash = ? WHERE file_path = ?",
+                        (new_path, content_hash, old_path),
+                    )
+                    if cur.rowcount:
+                        moved.add(old_path)
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return moved
+
+    def remove_study(self, study_uid: str) -> bool:
+        """Remove a study with all of its series and instances."""
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                self._conn.execute("DELETE FROM instances WHERE study_instance_uid = ?", (study_uid,))
+                self._conn.execute("DELETE FROM series WHERE study_instance_uid = ?", (study_uid,))
+                cur = self._conn.execute("DELETE FROM studies WHERE study_instance_uid = ?", (study_uid,))
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+            return cur.rowcount > 0
+
+    def tombstone_study(self, study_uid: str) -> bool:
+        """Remove a study from the index and record its files for later reclaim, atomically.
+
+        Returns False, and records nothing, for a study that is not indexed.
+        """
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                file_paths = [
+                    row[0] for row in self._conn.execute(
+                        "SELECT file_path FROM instances WHERE study_instance_uid = ?", (study_uid,)
+                    )
+                ]
+                self._conn.execute("DELETE FROM instances WHERE study_instance_uid = ?", (study_uid,))
+                self._conn.execute("DELETE FROM series WHERE study_instance_uid = ?", (study_uid,))
+                cur = self._conn.execute("DELETE FROM studies WHERE study_instance_uid = ?", (study_uid,))
+                if cur.rowcount > 0:
+                    self._conn.execute(
+                        "INSERT INTO tombstones (study_instance_uid, file_paths, deleted_at) VALUES (?, ?, ?)",
+                        (study_uid, json.dumps(file_paths), time.time()),
+                    )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+            return cur.rowcount > 0
+
+    def list_tombstones(self, limit: int = 100) -> List[Dict[str, Any]]:
+        rows = self._query(
+            "SELECT id, study_instance_uid, file_paths, deleted_at FROM tombstones ORDER BY id LIMIT ?", (limit,)
+        )
+        return [{**dict(row), "file_paths": json.loads(row["file_paths"])} for row in rows]
+
+    def remove_tombstone(self, tombstone_id: int) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM tombstones WHERE id = ?", (tombstone_id,))
+
+    def record_access(self, accessed: Dict[str, float]) -> None:
+        """Advance the last access time of studies in one transaction."""
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                self._conn.executemany(
+                    "UPDATE study_lifecycle SET last_accessed = MAX(last_accessed, ?) WHERE study_instance_uid = ?",
+                    [(accessed_at, study_uid) for study_uid, accessed_at in accessed.items()],
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def set_study_tier(self, study_uid: str, tier: str) -> None:
+        with self._lock:
+            self._conn.execute("UPDATE study_lifecycle SET tier = ? WHERE study_instance_uid = ?", (tier, study_uid))
+
+    def get_study_lifecycle(self, study_uid: str) -> Optional[Dict[str, Any]]:
+        rows = self._query("SELECT tier, last_accessed FROM study_lifecycle WHERE study_instance_uid = ?", (study_uid,))
+        return dict(rows[0]) if rows else None
+
+    def list_studies_in_tier(self, tier: str) -> List[str]:
+        return [row[0] for row in self._query("SELECT study_instance_uid FROM study_lifecycle WHERE tier = ?", (tier,))]
+
+    def idle_studies(self, cutoff: float, limit: int = 100) -> List[str]:
+        """Hot studies last accessed before ``cutoff``, least recently used first."""
+        rows = self._query(
+            "SELECT study_instance_uid FROM study_lifecycle WHERE tier = 'hot' AND last_accessed < ?"
+            " ORDER BY last_accessed LIMIT ?",
+            (cutoff, limit),
+        )
+        return [row[0] for row in rows]
+
+    def referenced_paths(self, file_paths: Iterable[str]) -> set:
+        """The subset of ``file_paths`` that instances point at."""
+        referenced = set()
+        paths = list(file_paths)
+        for start in range(0, len(paths), 500):
+            chunk = paths[start:start + 500]
+            rows = self._query(
+                f"SELECT file_path FROM instances WHERE file_path IN ({', '.join('?' for _ in chunk)})", chunk
+            )
+            referenced.update(row[0] for row in rows)
+        return referenced
+
+    def remove_instance(self, sop_uid: str) -> bool:
+        """Remove one instance, dropping its series/study once they are empty."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT series_instance_uid, study_instance_uid FROM instances WHERE sop_instance_uid = ?",
+                (sop_uid,),
+            ).fetchone()
+            if row is None:
+                return False
+            self._conn.execute("BEGIN")
+            try:
+                self._conn.execute("DELETE FROM instances WHERE sop_instance_uid = ?", (sop_uid,))
+                self._conn.execute(
+                    "DELETE FROM series WHERE series_instance_uid = ? AND instance_count <= 0",
+                    (row["series_instance_uid"],),
+                )
+                self._conn.execute(
+                    "DELETE FROM studies WHERE study_instance_uid = ? AND instance_count <= 0",
+                    (row["study_instance_uid"],),
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+            return True
+
+    def remove_files(self, file_paths: Iterable[str]) -> List[Dict[str, str]]:
+        """Remove the instances stored at ``file_paths``, dropping series/studies left empty.
+
+        Instances of cold-tier studies stay: their files are in the cold store.
+        Returns the UIDs of the removed instances.
+        """
+        removed: List[Dict[str, str]] = []
+        paths = list(file_paths)
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                for start in range(0, len(paths), 500):
+                    chunk = paths[start:start + 500]
+                    rows = self._conn.execute(
+                        "SELECT sop_instance_uid, series_instance_uid, study_instance_uid FROM instances"
+                        f" WHERE file_path IN ({', '.join('?' for _ in chunk)}) AND study_instance_uid NOT IN"
+                        " (SELECT study_instance_uid FROM study_lifecycle WHERE tier = 'cold')",
+                        chunk,
+                    ).fetchall()
+                    removed.extend(dict(row) for row in rows)
+                self._conn.executemany(
+                    "DELETE FROM instances WHERE sop_instance_uid = ?", [(row["sop_instance_uid"],) for row in removed]
+                )
+                self._conn.executemany(
+                    "DELETE FROM series WHERE series_instance_uid = ? AND instance_count <= 0",
+                    [(series_uid,) for series_uid in {row["series_instance_uid"] for row in removed}],
+                )
+                self._conn.executemany(
+                    "DELETE FROM studies WHERE study_instance_uid = ? AND instance_count <= 0",
+                    [(study_uid,) for study_uid in {row["study_instance_uid"] for row in removed}],
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return removed
+
+    # ---------- Archive reconciliation state ----------
+
+    def archive_dirs(self) -> Dict[str, int]:
+        """Directory mtimes recorded by the last reconciliation."""
+        return {row[0]: row[1] for row in self._query("SELECT path, mtime_ns FROM archive_dirs")}
+
+    def archive_files(self, dirs: Iterable[str]) -> Dict[str, Tuple[int, int]]:
+        """Recorded ``(size, mtime_ns)`` of the files in some directories, by path."""
+        files: Dict[str, Tuple[int, int]] = {}
+        dirs = list(dirs)
+        for start in range(0, len(dirs), 500):
+            chunk = dirs[start:start + 500]
+            rows = self._query(
+                f"SELECT path, size, mtime_ns FROM archive_files WHERE dir IN ({', '.join('?' for _ in chunk)})", chunk
+            )
+            files.update((row[0], (row[1], row[2])) for row in rows)
+        return files
+
+    def update_archive_state(
+        self,
+        dirs: Dict[str, int],
+        removed_dirs: Iterable[str],
+        files: Iterable[Tuple[str, str, int, int]],
+        removed_files: Iterable[str],
+    ) -> None:
+        """Record scanned directories and ``(path, dir, size, mtime_ns)`` of files, in one transaction."""
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                self._conn.executemany("DELETE FROM archive_dirs WHERE path = ?", [(path,) for path in removed_dirs])
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO archive_dirs (path, mtime_ns) VALUES (?, ?)", list(dirs.items())
+                )
+                self._conn.executemany("DELETE FROM archive_files WHERE path = ?", [(path,) for path in removed_files])
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO archive_files (path, dir, size, mtime_ns) VALUES (?, ?, ?, ?)", list(files)
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def tombstoned_paths(self) -> set:
+        """Files of deleted studies that are not reclaimed yet."""
+        return {path for row in self._query("SELECT file_paths FROM tombstones") for path in json.loads(row[0])}
+
+    # ---------- Reads ----------
+
+    def _query(self, sql: str, params: Iterable[Any] = ()) -> List[sqlite3.Row]:
+        with self._lock:
+            return self._conn.execute(sql, list(params)).fetchall()
+
+    def query(self, sql: str, params: Iterable[Any] = ()) -> List[sqlite3.Row]:
+        """Run a read query built outside the index (the QIDO-RS engine)."""
+        return self._query(sql, params)
+
+    def search_studies(
+        self,
+        patient_id: Optional[str] = None,
+        patient_name: Optional[str] = None,
+        study_date: Optional[str] = None,
+        limit: int = 100,
+        offset: int = 0,
+    ) -> List[Dict[str, Any]]:
+        """Return one page of studies, filtered and paginated in SQL."""
+        where = []
+        params: List[Any] = []
+        if patient_id:
+            where.append("patient_id LIKE ? ESCAPE '\\'")
+            params.append(f"%{_like_escape(patient_id)}%")
+        if patient_name:
+            where.append("patient_name LIKE ? ESCAPE '\\'")
+            params.append(f"%{_like_escape(patient_name)}%")
+        if study_date:
+            where.append("study_date = ?")
+            params.append(study_date)
+
+        sql = """
+            SELECT s.*,
+                (SELECT GROUP_CONCAT(DISTINCT modality) FROM series
+                    WHERE series.study_instance_uid = s.study_instance_uid) AS modalities
+            FROM studies s
+        """
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY study_date DESC, study_time DESC, study_instance_uid LIMIT ? OFFSET ?"
+        params.extend([limit, offset])
+
+        return [self._study_row(row) for row in self._query(sql, params)]
+
+    def get_study(self, study_uid: str) -> Optional[Dict[str, Any]]:
+        rows = self._query(
+            """
+            SELECT s.*,
+                (SELECT GROUP_CONCAT(DISTINCT modality) FROM series
+                    WHERE series.study_instance_uid = s.study_instance_uid) AS modalities
+            FROM studies s WHERE study_instance_uid = ?
+            """,
+            (study_uid,),
+        )
+        return self._study_row(rows[0]) if rows else None
+
+    def list_series(
+        self,
+        study_uid: str,
+        modality: Optional[str] = None,
+        series_number: Optional[int] = None,
+    ) -> List[Dict[str, Any]]:
+        """Return the series of a study sorted by series number."""
+        sql = "SELECT * FROM series WHERE study_instance_uid = ?"
+        params: List[Any] = [study_uid]
+        if modality:
+            sql += " AND modality = ?"
+            params.append(modality)
+        if series_number is not None:
+            sql += " AND series_number = ?"
+            params.append(series_number)
+        sql += " ORDER BY COALESCE(series_number, 0), series_instance_uid"
+        return [dict(row) for row in self._query(sql, params)]
+
+    def get_series(self, series_uid: str) -> Optional[Dict[str, Any]]:
+        rows = self._query("SELECT * FROM series WHERE series_instance_uid = ?", (series_uid,))
+        return dict(rows[0]) if rows else None
+
+    def list_instances(self, study_uid: str, series_uid: Optional[str] = None) -> List[Dict[str, Any]]:
+        """Return instance metadata of a study or series sorted by instance number."""
+        sql = "SELECT metadata, file_path FROM instances WHERE study_instance_uid = ?"
+        params: List[Any] = [study_uid]
+        if series_uid:
+            sql += " AND series_instance_uid = ?"
+            params.append(series_uid)
+        sql += " ORDER BY series_instance_uid, COALESCE(instance_number, 0), sop_instance_uid"
+        return [self._instance_row(row) for row in self._query(sql, params)]
+
+    def list_sop_uids(self, study_uid: str, series_uid: Optional[str] = None) -> List[str]:
+        sql = "SELECT sop_instance_uid FROM instances WHERE study_instance_uid = ?"
+        params: List[Any] = [study_uid]
+        if series_uid:
+            sql += " AND series_instance_uid = ?"
+            params.append(series_uid)
+        return [row[0] for row in self._query(sql, params)]
+
+    def get_instance(self, sop_uid: str) -> Optional[Dict[str, Any]]:
+        rows = self._query(
+            "SELECT metadata, file_path FROM instances WHERE sop_instance_uid = ?", (sop_uid,)
+        )
+        return self._instance_row(rows[0]) if rows else None
+
+    def get_location(self, sop_uid: str) -> Optional[Dict[str, Any]]:
+        """Where an instance is stored, without decoding its metadata."""
+        rows = self._query(
+            "SELECT study_instance_uid, series_instance_uid, file_path, content_hash"
+            " FROM instances WHERE sop_instance_uid = ?",
+            (sop_uid,),
+        )
+        return dict(rows[0]) if rows else None
+
+    def get_locations(self, sop_uids: Iterable[str]) -> Dict[str, Dict[str, Any]]:
+        """``get_location`` of many instances, keyed by SOP Instance UID (unknown ones are left out)."""
+        sop_uids = list(sop_uids)
+        locations = {}
+        for start in range(0, len(sop_uids), 500):
+            chunk = sop_uids[start:start + 500]
+            rows = self._query(
+                "SELECT sop_instance_uid, study_instance_uid, series_instance_uid, file_path, content_hash"
+                f" FROM instances WHERE sop_instance_uid IN ({', '.join('?' for _ in chunk)})",
+                chunk,
+            )
+            locations.update((row["sop_instance_uid"], dict(row)) for row in rows)
+        return locations
+
+    def find_by_content_hash(self, content_hash: str) -> Optional[Dict[str, Any]]:
+        """The instance stored with exactly this content, if any."""
+        rows = self._query(
+            "SELECT metadata, file_path FROM instances WHERE content_hash = ? LIMIT 1", (content_hash,)
+        )
+        return self._instance_row(rows[0]) if rows else None
+
+    def list_file_paths(self, study_uid: str) -> List[str]:
+        return [row[0] for row in self._query("SELECT file_path FROM instances WHERE study_instance_uid = ?", (study_uid,))]
+
+    def count_instances(self) -> int:
+        return self._query("SELECT COUNT(*) FROM instances")[0][0]
+
+    def _study_row(self, row: sqlite3.Row) -> Dict[str, Any]:
+        study = dict(row)
+        modalities = study.pop("modalities", None)
+        study["modalities_in_study"] = sorted(set(modalities.split(","))) if modalities else []
+        return study
+
+    def _instance_row(self, row: sqlite3.Row) -> Dict[str, Any]:
+        metadata = json.loads(row["metadata"])
+        metadata["file_path"] = row["file_path"]
+        return metadata
+
+    # ---------- Maintenance ----------
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+metadata_index = MetadataIndex(settings.INDEX_PATH or settings.STORAGE_PATH / "index.sqlite3")
@@ -0,0 +1,443 @@
+"""In-process Prometheus metrics: counters, gauges, histograms and the text exposition format"""
+
+import abc
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Sequence, Tuple
+
+# Seconds; request latencies and the finer-grained parser stages
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+STAGE_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+
+# (metric name, type, help, [(labels, value)])
+Family = Tuple[str, str, str, List[Tuple[Dict[str, str], float]]]
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape(str(value))}"' for key, value in labels.items()) + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class _Metric(abc.ABC):
+    """A metric family; ``labels()`` returns the child for one label combination.
+
+    Children are created once and reused, so hot paths can bind them up front
+    and pay only for a lock and an add per observation.
+    """
+
+    kind = ""
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._children: Dict[Tuple[str, ...], Any] = {}
+        self._lock = threading.Lock()
+        if not self.labelnames:
+            self._default = self.labels()
+
+    def labels(self, *values: str):
+        key = tuple(str(value) for value in values)
+        child = self._children.get(key)
+        if child is None:
+            if len(key) != len(self.labelnames):
+                raise ValueError(f"{self.name} expects labels {self.labelnames}")
+            with self._lock:
+                child = self._children.setdefault(key, self._new_child())
+        return child
+
+    @abc.abstractmethod
+    def _new_child(self) -> Any:
+        """A fresh child for one label combination."""
+
+    def _samples(self) -> Iterator[Tuple[str, Dict[str, str], float]]:
+        for key, child in list(self._children.items()):
+            labels = dict(zip(self.labelnames, key))
+            yield from child.samples(self.name, labels)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for name, labels, value in self._samples():
+            lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+        return lines
+
+
+class _Value:
+    def __init__(self):
+        self.value = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1.0) -> None:
+        with self._lock:
+            self.value += amount
+
+    def dec(self, amount: float = 1.0) -> None:
+        with self._lock:
+            self.value -= amount
+
+    def set(self, value: float) -> None:
+        self.value = value
+
+    def samples(self, name: str, labels: Dict[str, str]):
+        yield name, labels, self.value
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def _new_child(self) -> _Value:
+        return _Value()
+
+    def inc(self, amount: float = 1.0) -> None:
+        self._default.inc(amount)
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def _new_child(self) -> _Value:
+        return _Value()
+
+    def inc(self, amount: float = 1.0) -> None:
+        self._default.inc(amount)
+
+    def dec(self, amount: float = 1.0) -> None:
+        self._default.dec(amount)
+
+    def set(self, value: float) -> None:
+        self._default.set(value)
+
+
+class _HistogramValue:
+    def __init__(self, bounds: Tuple[float, ...]):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)  # per bucket, the last one is +Inf
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float) -> None:
+        index = bisect_left(self.bounds, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    @contextmanager
+    def time(self) -> Iterator[None]:
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started)
+
+    def samples(self, name: str, labels: Dict[str, str]):
+        with self._lock:
+            counts, total = list(self.counts), self.sum
+        cumulative = 0
+        for bound, count in zip((*self.bounds, float("inf")), counts):
+            cumulative += count
+            yield f"{name}_bucket", {**labels, "le": _format_value(bound)}, cumulative
+        yield f"{name}_sum", labels, total
+        yield f"{name}_count", labels, cumulative
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, help, labelnames)
+
+    def _new_child(self) -> _HistogramValue:
+        return _HistogramValue(self.buckets)
+
+    def observe(self, value: float) -> None:
+        self._default.observe(value)
+
+    def time(self):
+        return self._default.time()
+
+
+class MetricsRegistry:
+    """Metrics of this process, rendered in the Prometheus text format.
+
+    Collectors are called at scrape time for values other services already
+    keep (cache and pool counters), so those cost nothing per request. Work
+    done in the decode and ingest process pools is measured from this side.
+    """
+
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+        self._collectors: List[Callable[[], Iterable[Family]]] = []
+        self._lock = threading.Lock()
+
+    def _register(self, metric: _Metric) -> Any:
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None:
+                return existing
+            self._metrics[metric.name] = metric
+            return metric
+
+    def counter(self, name: str, help: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self._register(Counter(name, help, labelnames))
+
+    def gauge(self, name: str, help: str, labelnames: Sequence[str] = ()) -> Gauge:
+        return self._register(Gauge(name, help, labelnames))
+
+    def histogram(
+        self, name: str, help: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS
+    ) -> Histogram:
+        return self._register(Histogram(name, help, labelnames, buckets))
+
+    def add_collector(self, collector: Callable[[], Iterable[Family]]) -> None:
+        self._collectors.append(collector)
+
+    def render(self) -> str:
+        lines: List[str] = []
+        for metric in list(self._metrics.values()):
+            lines.extend(metric.render())
+        for collector in self._collectors:
+            for name, kind, help, samples in collector():
+                lines.append(f"# HELP {name} {help}")
+                lines.append(f"# TYPE {name} {kind}")
+                for labels, value in samples:
+                    lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = MetricsRegistry()
+
+# Parser hot paths: dcmread, pixel reads and decoding, DICOM JSON conversion and image/frame encoding
+parser_stage_seconds = metrics.histogram(
+    "dicom_parser_stage_seconds", "Time spent in DICOM parsing, decoding and serialization stages", ["stage"],
+    buckets=STAGE_BUCKETS,
+)
+
+# Ingest throughput by entry point (upload, folder, dimse) and outcome (stored, duplicate, failed)
+ingest_instances = metrics.counter("dicom_ingest_instances_total", "Instances received for ingest", ["source", "outcome"])
+ingest_bytes = metrics.counter("dicom_ingest_bytes_total", "Bytes of instances received for ingest", ["source"])
+ingest_seconds = metrics.histogram(
+    "dicom_ingest_batch_seconds", "Time to commit one upload request, folder job or DIMSE association", ["source"]
+)
+
+
+def _cache_families() -> Iterator[Family]:
+    from app.services.cache import dicom_cache
+    from app.services.frame_access import frame_accessor
+    from app.services.reformat import reformat_service
+
+    caches = dict(dicom_cache.stats())
+    caches["frame_tables"] = frame_accessor.stats()
+    caches["volumes"] = reformat_service.stats()
+
+    lookups, ratios, sizes, evictions = [], [], [], []
+    for cache, stats in caches.items():
+        lookups.append(({"cache": cache, "result": "hit"}, stats["hits"]))
+        lookups.append(({"cache": cache, "result": "miss"}, stats["misses"]))
+        total = stats["hits"] + stats["misses"]
+        ratios.append(({"cache": cache}, stats["hits"] / total if total else 0.0))
+        sizes.append(({"cache": cache}, stats["entries"]))
+        evictions.append(({"cache": cache}, stats.get("evictions", 0)))
+    yield "dicom_cache_lookups_total", "counter", "Cache lookups by result", lookups
+    yield "dicom_cache_hit_ratio", "gauge", "Hits over lookups since start", ratios
+    yield "dicom_cache_entries", "gauge", "Entries held", sizes
+    yield "dicom_cache_evictions_total", "counter", "Entries evicted to stay within budget", evictions
+    yield "dicom_cache_bytes", "gauge", "Bytes held by byte-budgeted caches", [
+        ({"cache": cache}, stats["bytes"]) for cache, stats in caches.items() if "bytes" in stats
+    ]
+
+
+def _executor_families() -> Iterator[Family]:
+    from app.services.executor import blocking_executor
+
+    pools = blocking_executor.stats()
+    yield "executor_tasks_total", "counter", "Tasks completed by blocking pool", [
+        ({"pool": pool}, stats["completed"]) for pool, stats in pools.items()
+    ]
+    yield "executor_tasks_in_flight", "gauge", "Tasks submitted and not yet finished", [
+        ({"pool": pool}, stats["in_flight"]) for pool, stats in pools.items()
+    ]
+    yield "executor_queue_depth", "gauge", "Tasks waiting for a worker", [
+        ({"pool": pool}, stats["queue_depth"]) for pool, stats in pools.items()
+    ]
+
+
+def _lifecycle_families() -> Iterator[Family]:
+    from app.services.lifecycle import storage_lifecycle
+
+    stats = storage_lifecycle.stats()
+    yield "storage_cold_studies", "gauge", "Studies in the cold tier", [({}, stats["cold_studies"])]
+    yield "storage_pending_tombstones", "gauge", "Deleted studies whose files are not reclaimed yet", [
+        ({}, stats["pending_tombstones"])
+    ]
+    yield "storage_lifecycle_studies_total", "counter", "Studies moved or reclaimed by the storage lifecycle", [
+        ({"action": action}, stats[action]) for action in ("archived", "restored", "reclaimed")
+    ]
+    yield "storage_restore_seconds_total", "counter", "Time spent restoring cold studies", [
+        ({}, stats["restore_seconds"])
+    ]
+
+
+def _frame_scheduler_families() -> Iterator[Family]:
+    from app.services.frame_scheduler import frame_scheduler
+
+    stats = frame_scheduler.stats()
+    yield "frame_decodes_active", "gauge", "Frame decodes holding a scheduler slot", [({}, stats["active"])]
+    yield "frame_decodes_waiting", "gauge", "Frame decodes waiting for a scheduler slot", [({}, stats["waiting"])]
+    yield "frame_decodes_joined_total", "counter", "Frame requests that shared a decode already running", [
+        ({}, stats["joined"])
+    ]
+    yield "frame_prefetch_total", "counter", "Read-ahead frames by outcome", [
+        ({"outcome": "decoded"}, stats["prefetched"]),
+        ({"outcome": "used"}, stats["prefetch_hits"]),
+        ({"outcome": "stale"}, stats["stale"]),
+        ({"outcome": "failed"}, stats["failures"]),
+    ]
+
+
+def _scp_families() -> Iterator[Family]:
+    from app.services.storage_scp import storage_scp
+
+    stats = storage_scp.stats()
+    yield "dicom_scp_active_associations", "gauge", "Open associations of the Storage SCP", [({}, len(stats["active"]))]
+    yield "dicom_scp_pending_index_updates", "gauge", "Received instances waiting for their index batch", [
+        ({}, stats["pending_index_updates"])
+    ]
+
+
+def _pacs_families() -> Iterator[Family]:
+    from app.services.pacs_proxy import pacs_proxy
+
+    stats = pacs_proxy.stats()
+    if not stats["enabled"]:
+        return
+    yield "pacs_find_queries_total", "counter", "C-FIND queries by cache result", [
+        ({"result": "hit"}, stats["find_hits"]), ({"result": "miss"}, stats["find_misses"])
+    ]
+    yield "pacs_retrieves_total", "counter", "Studies retrieved from the PACS", [
+        ({"reason": "on_demand"}, stats["retrieves"]), ({"reason": "prefetch"}, stats["prefetches"])
+    ]
+    yield "pacs_joined_requests_total", "counter", "Queries and retrieves that joined one already running", [
+        ({}, stats["joined"])
+    ]
+    yield "pacs_retrieved_instances_total", "counter", "Instances received from the PACS", [
+        ({}, stats["retrieved_instances"])
+    ]
+    yield "pacs_failures_total", "counter", "Failed or partially failed PACS operations", [({}, stats["failures"])]
+    yield "pacs_in_flight", "gauge", "Queries and retrieves running", [({}, stats["in_flight"])]
+
+
+def _reconciler_families() -> Iterator[Family]:
+    from app.services.reconciler import archive_reconciler
+
+    stats = archive_reconciler.stats()
+    yield "archive_reconcile_passes_total", "counter", "Reconciliations of the index with the archive", [
+        ({}, stats["passes"])
+    ]
+    yield "archive_reconcile_files_total", "counter", "Files reconciled with the index by outcome", [
+        ({"outcome": outcome}, stats[outcome]) for outcome in ("indexed", "adopted", "removed", "failed")
+    ]
+    yield "archive_reconcile_seconds_total", "counter", "Time spent reconciling the index with the archive", [
+        ({}, stats["seconds"])
+    ]
+    yield "archive_watched_dirs", "gauge", "Archive directories watched for changes", [({}, stats["watched_dirs"])]
+
+
+metrics.add_collector(_cache_families)
+metrics.add_collector(_executor_families)
+metrics.add_collector(_frame_scheduler_families)
+metrics.add_collector(_lifecycle_families)
+metrics.add_collector(_scp_families)
+metrics.add_collector(_pacs_families)
+metrics.add_collector(_reconciler_families)
+
+
+class MetricsMiddleware:
+    """Per-route latency, request and response bytes, and in-flight requests.
+
+    A plain ASGI middleware rather than ``BaseHTTPMiddleware``, so streamed
+    responses pass through untouched. Requests are labelled with the route
+    template (``/studies/{study_uid}``) to keep label cardinality bounded.
+    """
+
+    def __init__(self, app, registry: MetricsRegistry = metrics):
+        self.app = app
+        self.latency = registry.histogram(
+            "http_request_duration_seconds", "Request latency until the last response byte", ["method", "route"]
+        )
+        self.requests = registry.counter("http_requests_total", "Requests handled", ["method", "route", "status"])
+        self.request_bytes = registry.counter("http_request_bytes_total", "Request body bytes received", ["method", "route"])
+        self.response_bytes = registry.counter("http_response_bytes_total", "Response body bytes sent", ["method", "route"])
+        self.in_flight = registry.gauge("http_requests_in_flight", "Requests being handled", ["method"])
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        method = scope["method"]
+        in_flight = self.in_flight.labels(method)
+        received = 0
+        sent = 0
+        status = 500
+
+        async def counting_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+            return message
+
+        async def counting_send(message):
+            nonlocal sent, status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            elif message["type"] == "http.response.body":
+                sent += len(message.get("body", b""))
+            await send(message)
+
+        in_flight.inc()
+        started = time.perf_counter()
+        try:
+            await self.app(scope, counting_receive, counting_send)
+        finally:
+            elapsed = time.perf_counter() - started
+            in_flight.dec()
+            route = _route_template(scope)
+            self.latency.labels(method, route).observe(elapsed)
+            self.requests.labels(method, route, status).inc()
+            if received:
+                self.request_bytes.labels(method, route).inc(received)
+            self.response_bytes.labels(method, route).inc(sent)
+
+
+def _route_template(scope) -> str:
+    route = scope.get("route")
+    template = getattr(route, "path_format", None) or getattr(route, "path", None)
+    if template is None:
+        return "<unmatched>"
+    # Some FastAPI versions give routes of included routers a template relative
+    # to the router prefix; recover the prefix from the concrete request path
+    try:
+        concrete = template.format(**scope.get("path_params", {}))
+    except (KeyError, IndexError, ValueError):
+        return template
+    path = scope["path"]
+    if concrete != path and path.endswith(concrete):
+        return path[: len(path) - len(concrete)] + template
+    return template
@@ -0,0 +1,475 @@
+"""Caching query/retrieve proxy to a remote PACS, with prefetch of related studies"""
+
+import asyncio
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
+from datetime import date
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+from pydicom.dataset import Dataset
+from pydicom.datadict import dictionary_VR
+from pydicom.multival import MultiValue
+from pydicom.uid import (
+    JPEG2000,
+    DeflatedExplicitVRLittleEndian,
+    JPEG2000Lossless,
+    JPEGBaseline8Bit,
+    JPEGExtended12Bit,
+    JPEGLosslessSV1,
+    JPEGLSLossless,
+    JPEGLSNearLossless,
+    RLELossless,
+)
+from pynetdicom import AE, DEFAULT_TRANSFER_SYNTAXES, StoragePresentationContexts, build_role
+from pynetdicom.sop_class import (
+    StudyRootQueryRetrieveInformationModelFind,
+    StudyRootQueryRetrieveInformationModelGet,
+    StudyRootQueryRetrieveInformationModelMove,
+)
+
+from app.config import settings
+from app.services.metadata_index import metadata_index
+from app.services.qido import NUMERIC_VRS, QidoQuery, qido_engine
+from app.services.storage_scp import storage_scp
+
+QUERY_LEVELS = {"study": "STUDY", "series": "SERIES", "instance": "IMAGE"}
+UID_KEYWORDS = ("StudyInstanceUID", "SeriesInstanceUID", "SOPInstanceUID")
+
+# C-FIND/C-GET/C-MOVE response statuses (PS3.4 C.4)
+STATUS_SUCCESS = 0x0000
+STATUS_PENDING = (0xFF00, 0xFF01)
+STATUS_WARNING = 0xB000
+
+MAX_CACHED_QUERIES = 1000
+
+# An acceptor picks one transfer syntax per presentation context, so a C-GET
+# proposes each compressed syntax in a context of its own for every SOP class
+# the study holds; the PACS can then send instances as they are stored.
+COMPRESSED_SYNTAXES = (
+    JPEGBaseline8Bit,
+    JPEGExtended12Bit,
+    JPEGLosslessSV1,
+    JPEGLSLossless,
+    JPEGLSNearLossless,
+    JPEG2000Lossless,
+    JPEG2000,
+    RLELossless,
+    DeflatedExplicitVRLittleEndian,
+)
+MAX_PRESENTATION_CONTEXTS = 127  # one is the C-GET model itself
+
+
+class PacsError(Exception):
+    """Raised when the PACS cannot be reached or refuses a query or retrieve."""
+
+
+@dataclass(frozen=True)
+class PrefetchRule:
+    """Which of a patient's other studies to fetch when one of their studies is opened."""
+
+    priors: int = 2  # most recent studies before the opened one
+    modalities: Tuple[str, ...] = ()  # only studies with one of these modalities (any when empty)
+    max_age_days: Optional[int] = None  # only studies at most this much older than the opened one
+
+    @classmethod
+    def from_dict(cls, rule: Dict[str, Any]) -> "PrefetchRule":
+        return cls(
+            priors=int(rule.get("priors", 2)),
+            modalities=tuple(rule.get("modalities") or ()),
+            max_age_days=rule.get("max_age_days"),
+        )
+
+    def select(self, study: Dict[str, Any], candidates: List[Dataset]) -> List[str]:
+        """UIDs of the candidate studies this rule asks for, newest first."""
+        opened = study.get("study_date") or ""
+        picked = []
+        for ds in sorted(candidates, key=lambda ds: str(ds.get("StudyDate") or ""), reverse=True):
+            study_date = str(ds.get("StudyDate") or "")
+            if opened and study_date > opened:
+                continue  # a later study, not a prior
+            if self.modalities and not set(_values(ds.get("ModalitiesInStudy"))) & set(self.modalities):
+                continue
+            if self.max_age_days is not None and opened and study_date:
+                if (_parse_date(opened) - _parse_date(study_date)).days > self.max_age_days:
+                    continue
+            picked.append(str(ds.StudyInstanceUID))
+            if len(picked) >= self.priors:
+                break
+        return picked
+
+
+def _values(value: Any) -> List[str]:
+    if value is None or value == "":
+        return []
+    if isinstance(value, (list, tuple, MultiValue)):
+        return [str(v) for v in value]
+    return [str(value)]
+
+
+def _parse_date(value: str) -> date:
+    return date(int(value[:4]), int(value[4:6]), int(value[6:8]))
+
+
+class PacsProxy:
+    """Fall through to a remote PACS for studies that are not archived locally.
+
+    C-FIND results are cached for ``find_ttl`` seconds, which also keeps
+    repeated requests for studies the PACS does not have from reaching it.
+    Identical queries and retrieves that are already running are joined
+    rather than sent again. Retrieved instances go through the Storage SCP's
+    receive path (C-GET on our own association, or C-MOVE to our SCP), so
+    they are stored and indexed like any other.
+
+    When a study is opened, the prefetch rules pick the patient's related
+    studies and retrieve them in the background on a separate, smaller pool.
+    """
+
+    def __init__(
+        self,
+        host: str,
+        port: int,
+        called_ae: str,
+        calling_ae: str,
+        retrieve_method: str = "get",
+        move_destination: str = "",
+        timeout: float = 30.0,
+        find_ttl: float = 300.0,
+        rules: Iterable[PrefetchRule] = (),
+        retrieve_workers: int = 4,
+        prefetch_workers: int = 1,
+    ):
+        if retrieve_method not in ("get", "move"):
+            raise ValueError(f"Unknown retrieve method {retrieve_method}")
+        self.host = host
+        self.port = port
+        self.called_ae = called_ae
+        self.calling_ae = calling_ae
+        self.retrieve_method = retrieve_method
+        self.move_destination = move_destination or calling_ae
+        self.timeout = timeout
+        self.find_ttl = find_ttl
+        self.rules = list(rules)
+        self.retrieve_workers = retrieve_workers
+        self.prefetch_workers = prefetch_workers
+        self.counters = {
+            "find_hits": 0,
+            "find_misses": 0,
+            "retrieves": 0,
+            "prefetches": 0,
+            "joined": 0,
+            "retrieved_instances": 0,
+            "failures": 0,
+        }
+        self._find_cache: "OrderedDict[tuple, Tuple[float, List[Dataset]]]" = OrderedDict()
+        self._in_flight: Dict[tuple, Future] = {}
+        self._prefetched: Dict[str, float] = {}
+        self._lock = threading.RLock()
+        self._pools: Dict[str, ThreadPoolExecutor] = {}
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.host)
+
+    def shutdown(self) -> None:
+        with self._lock:
+            pools, self._pools = self._pools, {}
+        for pool in pools.values():
+            pool.shutdown(wait=False, cancel_futures=True)
+
+    # ---------- Request path ----------
+
+    async def ensure_local(self, study_uid: str) -> None:
+        """Retrieve a study first if it is not archived locally, then schedule its prefetch.
+
+        Raises PacsError if the retrieve fails; a study the PACS does not
+        have either is left for the caller to report as missing.
+        """
+        if not self.enabled:
+            return
+        if metadata_index.get_study(study_uid) is None:
+            await asyncio.wrap_future(self.submit_retrieve(study_uid))
+        self.schedule_prefetch(study_uid)
+
+    def search(
+        self,
+        level: str,
+        params: Iterable[Tuple[str, str]],
+        study_uid: Optional[str] = None,
+        series_uid: Optional[str] = None,
+    ) -> List[Dict[str, Any]]:
+        """Run a QIDO-RS query against the PACS; results are shaped like the local engine's."""
+        query = qido_engine.parse(level, params, study_uid, series_uid)
+        results = [self._to_json(query, ds) for ds in self.find(level, self._identifier(query))]
+        return results[: query.limit]
+
+    # ---------- C-FIND ----------
+
+    def find(self, level: str, identifier: Dataset) -> List[Dataset]:
+        """C-FIND responses for an identifier, from the cache while they are fresh."""
+        key = (level, tuple(sorted((elem.keyword, str(elem.value)) for elem in identifier)))
+        now = time.monotonic()
+        with self._lock:
+            cached = self._find_cache.get(key)
+            if cached is not None and cached[0] > now:
+                self._find_cache.move_to_end(key)
+                self.counters["find_hits"] += 1
+                return cached[1]
+            self.counters["find_misses"] += 1
+
+        results = self._single_flight(("find", key), lambda: self._c_find(identifier)).result()
+        with self._lock:
+            self._find_cache[key] = (time.monotonic() + self.find_ttl, results)
+            self._find_cache.move_to_end(key)
+            while len(self._find_cache) > MAX_CACHED_QUERIES:
+                self._find_cache.popitem(last=False)
+        return results
+
+    def _identifier(self, query: QidoQuery) -> Dataset:
+        """The C-FIND identifier for a parsed QIDO-RS query: matching keys plus return keys."""
+        identifier = Dataset()
+        identifier.QueryRetrieveLevel = QUERY_LEVELS[query.level]
+        matched = {attribute.keyword: value for attribute, value in query.matches}
+        keywords = [attribute.keyword for attribute in query.returned]
+        keywords += UID_KEYWORDS[: list(QUERY_LEVELS).index(query.level) + 1]
+        for keyword in dict.fromkeys(keywords):
+            if keyword == "TransferSyntaxUID":
+                continue  # file meta, not queryable
+            value = matched.get(keyword, "")
+            if value and dictionary_VR(keyword) in NUMERIC_VRS and dictionary_VR(keyword) != "IS":
+                value = int(value)
+            setattr(identifier, keyword, value if value != "" else None)
+        return identifier
+
+    def _to_json(self, query: QidoQuery, ds: Dataset) -> Dict[str, Any]:
+        row: Dict[str, Any] = {}
+        for n, attribute in enumerate(query.returned):
+            values = _values(ds.get(attribute.keyword))
+            row[f"c{n}"] = ",".join(values) if attribute.keyword == "ModalitiesInStudy" else (values[0] if values else None)
+        for n, keyword in enumerate(UID_KEYWORDS):
+            row[f"r{n}"] = str(ds.get(keyword) or "")
+        result = qido_engine.to_json(query.level, query.returned, row)
+        result["00080056"] = {"vr": "CS", "Value": ["NEARLINE"]}  # InstanceAvailability: retrieved on first use
+        return dict(sorted(result.items()))
+
+    def _c_find(self, identifier: Dataset) -> List[Dataset]:
+        ae = self._ae()
+        ae.add_requested_context(StudyRootQueryRetrieveInformationModelFind)
+        assoc = self._associate(ae)
+        results = []
+        try:
+            for status, ds in assoc.send_c_find(identifier, StudyRootQueryRetrieveInformationModelFind):
+                if not status:
+                    raise PacsError("PACS did not answer the C-FIND")
+                if status.Status in STATUS_PENDING:
+                    if ds is not None:
+                        results.append(ds)
+                elif status.Status != STATUS_SUCCESS:
+                    raise PacsError(f"C-FIND failed with status 0x{status.Status:04X}")
+        finally:
+            if assoc.is_established:
+                assoc.release()
+        return results
+
+    # ---------- C-GET / C-MOVE ----------
+
+    def submit_retrieve(self, study_uid: str, prefetch: bool = False) -> Future:
+        """Retrieve a study in the background, joining a retrieve of it that is already running."""
+        pool = self._pool("prefetch" if prefetch else "retrieve")
+        return self._single_flight(("retrieve", study_uid), lambda: self.retrieve_study(study_uid, prefetch), pool)
+
+    def retrieve_study(self, study_uid: str, prefetch: bool = False) -> int:
+        """Bring a study into the local archive; returns the number of instances received.
+
+        Returns 0 without retrieving when the PACS does not have the study.
+        """
+        query = Dataset()
+        query.QueryRetrieveLevel = "STUDY"
+        query.StudyInstanceUID = study_uid
+        if not self.find("study", query):
+            return 0
+
+        self.counters["prefetches" if prefetch else "retrieves"] += 1
+        storage_scp.prepare()
+        ae = self._ae()
+        if self.retrieve_method == "move":
+            if not storage_scp.running:
+                raise PacsError("C-MOVE needs the Storage SCP to be running (SCP_ENABLED)")
+            ae.add_requested_context(StudyRootQueryRetrieveInformationModelMove)
+            assoc = self._associate(ae)
+            responses = lambda: assoc.send_c_move(query, self.move_destination, StudyRootQueryRetrieveInformationModelMove)
+        else:
+            # C-GET returns the instances on this association, so the PACS needs no route back to us
+            ae.add_requested_context(StudyRootQueryRetrieveInformationModelGet)
+            sop_classes = self._storage_classes(study_uid)
+            if sop_classes:
+                for sop_class in sop_classes:
+                    ae.add_requested_context(sop_class, DEFAULT_TRANSFER_SYNTAXES)
+                    for transfer_syntax in COMPRESSED_SYNTAXES:
+                        ae.add_requested_context(sop_class, transfer_syntax)
+            else:
+                sop_classes = [context.abstract_syntax for context in StoragePresentationContexts]
+                for sop_class in sop_classes:
+                    ae.add_requested_context(sop_class, DEFAULT_TRANSFER_SYNTAXES)
+            roles = [build_role(sop_class, scp_role=True) for sop_class in sop_classes]
+            assoc = self._associate(ae, ext_neg=roles, evt_handlers=storage_scp.handlers())
+            responses = lambda: assoc.send_c_get(query, StudyRootQueryRetrieveInformationModelGet)
+
+        completed = failed = 0
+        try:
+            for status, _ in responses():
+                if not status:
+                    raise PacsError(f"PACS did not answer the C-{self.retrieve_method.upper()}")
+                if status.Status in STATUS_PENDING:
+                    continue
+                completed = int(status.get("NumberOfCompletedSuboperations") or 0)
+                failed = int(status.get("NumberOfFailedSuboperations") or 0)
+                if status.Status not in (STATUS_SUCCESS, STATUS_WARNING) and not completed:
+                    raise PacsError(f"C-{self.retrieve_method.upper()} failed with status 0x{status.Status:04X}")
+        except PacsError:
+            self.counters["failures"] += 1
+            raise
+        finally:
+            if assoc.is_established:
+                assoc.release()
+
+        # Received instances are answered before they are indexed; wait for the batch
+        storage_scp.flush()
+        self.counters["retrieved_instances"] += completed
+        if failed:
+            self.counters["failures"] += 1
+        return completed
+
+    def _storage_classes(self, study_uid: str) -> List[str]:
+        """SOP classes in a study, from an IMAGE-level C-FIND, to propose for its C-GET.
+
+        Empty when the PACS does not return SOP Class UIDs or the study holds
+        too many classes for a context per compressed syntax; the caller then
+        proposes the common storage classes, uncompressed only.
+        """
+        query = Dataset()
+        query.QueryRetrieveLevel = "IMAGE"
+        query.StudyInstanceUID = study_uid
+        query.SeriesInstanceUID = None
+        query.SOPInstanceUID = None
+        query.SOPClassUID = None
+        sop_classes = list(dict.fromkeys(str(ds.SOPClassUID) for ds in self.find("instance", query) if ds.get("SOPClassUID")))
+        if len(sop_classes) * (len(COMPRESSED_SYNTAXES) + 1) > MAX_PRESENTATION_CONTEXTS:
+            return []
+        return sop_classes
+
+    # ---------- Prefetch ----------
+
+    def schedule_prefetch(self, study_uid: str) -> None:
+        """Prefetch the studies the rules ask for when a study is opened (at most once per ``find_ttl``)."""
+        if not self.rules:
+            return
+        now = time.monotonic()
+        with self._lock:
+            if self._prefetched.get(study_uid, 0.0) > now:
+                return
+            if len(self._prefetched) >= MAX_CACHED_QUERIES:
+                self._prefetched = {uid: until for uid, until in self._prefetched.items() if until > now}
+            self._prefetched[study_uid] = now + self.find_ttl
+        self._pool("prefetch").submit(self._prefetch, study_uid)
+
+    def related_studies(self, study_uid: str) -> List[str]:
+        """UIDs of the studies the prefetch rules select for an opened study."""
+        study = metadata_index.get_study(study_uid)
+        if study is None or not study.get("patient_id"):
+            return []
+        query = Dataset()
+        query.QueryRetrieveLevel = "STUDY"
+        query.PatientID = study["patient_id"]
+        query.StudyInstanceUID = None
+        query.StudyDate = None
+        query.ModalitiesInStudy = None
+        candidates = [ds for ds in self.find("study", query) if str(ds.get("StudyInstanceUID")) != study_uid]
+        selected: List[str] = []
+        for rule in self.rules:
+            selected.extend(rule.select(study, candidates))
+        return list(dict.fromkeys(selected))
+
+    def _prefetch(self, study_uid: str) -> None:
+        try:
+            for related_uid in self.related_studies(study_uid):
+                if metadata_index.get_study(related_uid) is None:
+                    self.submit_retrieve(related_uid, prefetch=True)
+        except PacsError:
+            self.counters["failures"] += 1
+
+    # ---------- Helpers ----------
+
+    def _ae(self) -> AE:
+        ae = AE(ae_title=self.calling_ae)
+        ae.acse_timeout = ae.dimse_timeout = ae.network_timeout = ae.connection_timeout = self.timeout
+        ae.maximum_pdu_size = 0
+        return ae
+
+    def _associate(self, ae: AE, **kwargs):
+        assoc = ae.associate(self.host, self.port, ae_title=self.called_ae, **kwargs)
+        if not assoc.is_established:
+            raise PacsError(f"Association with {self.called_ae} at {self.host}:{self.port} was rejected or timed out")
+        return assoc
+
+    def _pool(self, name: str) -> ThreadPoolExecutor:
+        with self._lock:
+            if name not in self._pools:
+                workers = self.prefetch_workers if name == "prefetch" else self.retrieve_workers
+                self._pools[name] = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f"pacs-{name}")
+            return self._pools[name]
+
+    def _single_flight(self, key: tuple, call: Callable[[], Any], pool: Optional[ThreadPoolExecutor] = None) -> Future:
+        """One running call per key: later callers get the running call's future.
+
+        Without a pool the first caller runs ``call`` on its own thread.
+        """
+        with self._lock:
+            future = self._in_flight.get(key)
+            if future is not None:
+                self.counters["joined"] += 1
+                return future
+            if pool is not None:
+                future = pool.submit(call)
+                self._in_flight[key] = future
+                future.add_done_callback(lambda _: self._forget(key))
+                return future
+            future = self._in_flight[key] = Future()
+
+        try:
+            future.set_result(call())
+        except BaseException as e:
+            future.set_exception(e)
+        finally:
+            self._forget(key)
+        return future
+
+    def _forget(self, key: tuple) -> None:
+        with self._lock:
+            self._in_flight.pop(key, None)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                **self.counters,
+                "enabled": self.enabled,
+                "in_flight": len(self._in_flight),
+                "cached_queries": len(self._find_cache),
+            }
+
+
+pacs_proxy = PacsProxy(
+    settings.PACS_HOST,
+    settings.PACS_PORT,
+    settings.PACS_AE_TITLE,
+    settings.LOCAL_AE_TITLE,
+    retrieve_method=settings.PACS_RETRIEVE_METHOD,
+    move_destination=settings.PACS_MOVE_DESTINATION,
+    timeout=settings.PACS_TIMEOUT,
+    find_ttl=settings.PACS_FIND_TTL,
+    rules=[PrefetchRule.from_dict(rule) for rule in settings.PACS_PREFETCH_RULES],
+    retrieve_workers=settings.PACS_RETRIEVE_WORKERS,
+    prefetch_workers=settings.PACS_PREFETCH_WORKERS,
+)
@@ -0,0 +1,286 @@
+"""Opt-in sampling profiles of single requests, kept in a bounded on-disk ring"""
+
+import contextvars
+import hmac
+import json
+import os
+import sys
+import threading
+import time
+import uuid
+from collections import Counter as Tally
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterator, List, Optional
+from urllib.parse import parse_qsl, urlencode
+
+from app.config import settings
+from app.services.metrics import parser_stage_seconds
+
+PROFILE_HEADER = b"x-profile"
+PROFILE_PARAM = "profile"
+
+_active: "contextvars.ContextVar[Optional[RequestProfile]]" = contextvars.ContextVar("request_profile", default=None)
+
+# Bound once so timing a stage costs a bisect and an add
+_STAGE_SECONDS: Dict[str, Any] = {}
+
+
+def current_profile() -> Optional["RequestProfile"]:
+    return _active.get()
+
+
+@contextmanager
+def timed_stage(stage: str) -> Iterator[None]:
+    """Time a parsing, decoding or serialization stage.
+
+    Always feeds the stage histogram of ``/metrics``; also adds to the
+    profile of the current request when it is being profiled.
+    """
+    histogram = _STAGE_SECONDS.get(stage)
+    if histogram is None:
+        histogram = _STAGE_SECONDS.setdefault(stage, parser_stage_seconds.labels(stage))
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        histogram.observe(elapsed)
+        profile = _active.get()
+        if profile is not None:
+            profile.add_stage(stage, elapsed)
+
+
+def _frame_name(code) -> str:
+    parts = Path(code.co_filename).parts
+    return f"{code.co_name} ({'/'.join(parts[-2:])}:{code.co_firstlineno})"
+
+
+class RequestProfile:
+    """Stack samples and stage timings of one request.
+
+    A sampler thread walks the stacks of the event loop thread and of any
+    I/O pool thread currently running work for this request. Samples of the
+    event loop include whatever else it was running at the time; work on the
+    decode process pool shows up in the stage timings only.
+    """
+
+    def __init__(self, method: str, path: str, query: str, interval: float):
+        self.id = f"{int(time.time() * 1000):013d}-{uuid.uuid4().hex[:8]}"
+        self.method = method
+        self.path = path
+        self.query = query
+        self.interval = interval
+        self.started_at = time.time()
+        self.duration = 0.0
+        self.status: Optional[int] = None
+        self.samples = 0
+        self._stacks: Dict[str, Tally] = {"event_loop": Tally(), "io": Tally()}
+        self._stages: Dict[str, List[float]] = {}
+        self._threads: Dict[int, str] = {threading.get_ident(): "event_loop"}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._sampler = threading.Thread(target=self._sample, name=f"profile-{self.id}", daemon=True)
+
+    def start(self) -> None:
+        self._started = time.perf_counter()
+        self._sampler.start()
+
+    def stop(self) -> None:
+        self.duration = time.perf_counter() - self._started
+        self._stop.set()
+        self._sampler.join()
+
+    def add_stage(self, stage: str, seconds: float) -> None:
+        with self._lock:
+            entry = self._stages.setdefault(stage, [0, 0.0])
+            entry[0] += 1
+            entry[1] += seconds
+
+    def run_in_thread(self, fn: Callable, *args) -> Any:
+        """Run ``fn`` on the calling (pool) thread with that thread being sampled."""
+        ident = threading.get_ident()
+        with self._lock:
+            self._threads[ident] = "io"
+        try:
+            return fn(*args)
+        finally:
+            with self._lock:
+                self._threads.pop(ident, None)
+
+    def _sample(self) -> None:
+        while not self._stop.wait(self.interval):
+            frames = sys._current_frames()
+            with self._lock:
+                threads = list(self._threads.items())
+            for ident, role in threads:
+                frame = frames.get(ident)
+                if frame is None:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(_frame_name(frame.f_code))
+                    frame = frame.f_back
+                self._stacks[role]["\n".join(reversed(stack))] += 1
+            self.samples += 1
+
+    def report(self) -> Dict[str, Any]:
+        duration_ms = self.duration * 1000
+        stages = {
+            stage: {
+                "calls": count,
+                "ms": round(seconds * 1000, 3),
+                "share": round(seconds / self.duration, 4) if self.duration else 0.0,
+            }
+            for stage, (count, seconds) in sorted(self._stages.items())
+        }
+        return {
+            "id": self.id,
+            "method": self.method,
+            "path": self.path,
+            "query": self.query,
+            "status": self.status,
+            "started_at": self.started_at,
+            "duration_ms": round(duration_ms, 3),
+            "sample_interval_ms": self.interval * 1000,
+            "samples": self.samples,
+            "stages": stages,
+            "call_tree": {role: _call_tree(stacks) for role, stacks in self._stacks.items()},
+        }
+
+
+def _call_tree(stacks: Tally, min_share: float = 0.005) -> List[Dict[str, Any]]:
+    """Merge sampled stacks into a tree, dropping branches below ``min_share`` of the samples."""
+    root: Dict[str, Any] = {"children": {}}
+    total = sum(stacks.values())
+    for stack, count in stacks.items():
+        node = root
+        for name in stack.split("\n"):
+            node = node["children"].setdefault(name, {"samples": 0, "children": {}})
+            node["samples"] += count
+
+    def emit(children: Dict[str, Any]) -> List[Dict[str, Any]]:
+        nodes = []
+        for name, node in sorted(children.items(), key=lambda item: -item[1]["samples"]):
+            if node["samples"] < max(1, total * min_share):
+                continue
+            nodes.append({
+                "name": name,
+                "samples": node["samples"],
+                "share": round(node["samples"] / total, 4),
+                "children": emit(node["children"]),
+            })
+        return nodes
+
+    return emit(root["children"])
+
+
+class ProfileStore:
+    """The newest ``max_reports`` profile reports, one JSON file each."""
+
+    def __init__(self, root: Path, max_reports: int):
+        self.root = root
+        self.max_reports = max_reports
+        self._lock = threading.Lock()
+
+    def save(self, report: Dict[str, Any]) -> None:
+        self.root.mkdir(parents=True, exist_ok=True)
+        path = self.root / f"{report['id']}.json"
+        tmp_path = path.with_suffix(".tmp")
+        tmp_path.write_text(json.dumps(report))
+        os.replace(tmp_path, path)
+        with self._lock:
+            for old in self._paths()[: -self.max_reports]:
+                old.unlink(missing_ok=True)
+
+    def list(self) -> List[Dict[str, Any]]:
+        """Summaries of the stored reports, newest first."""
+        summaries = []
+        for path in reversed(self._paths()):
+            try:
+                report = json.loads(path.read_text())
+            except (OSError, ValueError):
+                continue
+            summaries.append({
+                key: report[key] for key in ("id", "method", "path", "query", "status", "started_at", "duration_ms", "stages")
+            })
+        return summaries
+
+    def get(self, profile_id: str) -> Optional[Dict[str, Any]]:
+        path = self.root / f"{Path(profile_id).name}.json"
+        try:
+            return json.loads(path.read_text())
+        except (OSError, ValueError):
+            return None
+
+    def _paths(self) -> List[Path]:
+        # Ids start with a zero-padded millisecond timestamp, so names sort by age
+        return sorted(self.root.glob("*.json")) if self.root.exists() else []
+
+
+profile_store = ProfileStore(settings.STORAGE_PATH / ".profiles", settings.PROFILE_MAX_REPORTS)
+
+
+def is_authorized(token: Optional[str]) -> bool:
+    """Whether a caller-supplied token unlocks profiling (never while no token is configured)."""
+    if not settings.PROFILING_TOKEN or not token:
+        return False
+    return hmac.compare_digest(token.encode(), settings.PROFILING_TOKEN.encode())
+
+
+def _requested_token(scope) -> Optional[str]:
+    for name, value in scope["headers"]:
+        if name == PROFILE_HEADER:
+            return value.decode("latin-1")
+    query = scope.get("query_string", b"")
+    if PROFILE_PARAM.encode() in query:
+        for name, value in parse_qsl(query.decode("latin-1")):
+            if name == PROFILE_PARAM:
+                return value
+    return None
+
+
+def _query_without_token(scope) -> str:
+    """The query string as recorded in reports, minus the profiling token."""
+    query = scope.get("query_string", b"").decode("latin-1")
+    if PROFILE_PARAM not in query:
+        return query
+    return urlencode([(name, value) for name, value in parse_qsl(query, keep_blank_values=True) if name != PROFILE_PARAM])
+
+
+class ProfilingMiddleware:
+    """Profile requests that carry a valid ``X-Profile`` header or ``?profile=`` token.
+
+    Only installed while ``PROFILING_TOKEN`` is set. Other requests pay for a
+    scan of the header list; profiled ones get an ``X-Profile-Id`` header
+    naming their report under ``/profiles``.
+    """
+
+    def __init__(self, app, store: ProfileStore = profile_store):
+        self.app = app
+        self.store = store
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not is_authorized(_requested_token(scope)):
+            await self.app(scope, receive, send)
+            return
+
+        profile = RequestProfile(
+            scope["method"], scope["path"], _query_without_token(scope), settings.PROFILE_SAMPLE_INTERVAL_MS / 1000
+        )
+
+        async def tagged_send(message):
+            if message["type"] == "http.response.start":
+                profile.status = message["status"]
+                message = {**message, "headers": [*message.get("headers", []), (b"x-profile-id", profile.id.encode())]}
+            await send(message)
+
+        token = _active.set(profile)
+        profile.start()
+        try:
+            await self.app(scope, receive, tagged_send)
+        finally:
+            profile.stop()
+            _active.reset(token)
+            from app.services.executor import blocking_executor  # the executor itself looks up the active profile
+            await blocking_executor.run_io(self.store.save, profile.report())
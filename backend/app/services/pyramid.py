@@ -0,0 +1,134 @@
+"""Downsampled resolution levels of frames for progressive display"""
+
+import os
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Dict, Iterable, Optional
+
+import numpy as np
+
+from app.config import settings
+from app.services.dicom_parser import DICOMParserService
+from app.services.frame_access import frame_accessor
+from app.services.metadata_index import metadata_index
+from app.services.renderer import pixel_values
+from app.services.storage import instance_store
+
+
+# Levels stop once the longest side is at most this many pixels
+SMALLEST_LEVEL_SIZE = 64
+LOCK_STRIPES = 256
+
+
+def level_count(rows: int, columns: int) -> int:
+    """Number of levels below full resolution (level 0) for a frame size."""
+    levels = 0
+    while max(rows, columns) > SMALLEST_LEVEL_SIZE:
+        rows, columns = -(-rows // 2), -(-columns // 2)
+        levels += 1
+    return levels
+
+
+def downsample(pixels: np.ndarray) -> np.ndarray:
+    """Halve a (rows, columns[, samples]) array with a 2x2 box filter, keeping its dtype."""
+    rows, columns = pixels.shape[:2]
+    if rows % 2 or columns % 2:
+        pad = [(0, rows % 2), (0, columns % 2)] + [(0, 0)] * (pixels.ndim - 2)
+        pixels = np.pad(pixels, pad, mode="edge")
+    rows, columns = pixels.shape[:2]
+    blocks = pixels.reshape(rows // 2, 2, columns // 2, 2, *pixels.shape[2:])
+    mean = blocks.mean(axis=(1, 3), dtype=np.float32)
+    return np.rint(mean).astype(pixels.dtype)
+
+
+class PyramidService:
+    """Build and store a frame's resolution pyramid (1/2, 1/4, 1/8 ...).
+
+    All levels of a frame come from a single decode, each computed from the
+    previous one, and are stored as raw pixel files per study and instance
+    so they can be sent without further work.
+    """
+
+    def __init__(self, root: Path):
+        self.root = root
+        self.parser = DICOMParserService()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="pyramids")
+        self._frame_locks = [threading.Lock() for _ in range(LOCK_STRIPES)]  # one build per frame at a time
+
+    def _level_path(self, metadata: Dict[str, Any], frame: int, level: int) -> Path:
+        return self.root / metadata["study_instance_uid"] / metadata["sop_instance_uid"] / f"{frame}_{level}.raw"
+
+    def _frame_lock(self, sop_uid: str, frame: int) -> threading.Lock:
+        return self._frame_locks[hash((sop_uid, frame)) % LOCK_STRIPES]
+
+    def get_level(self, metadata: Dict[str, Any], frame: int, level: int, use_cache: bool = True) -> Optional[Path]:
+        """Path of a frame's pixels at ``level`` (>= 1), building the pyramid if needed.
+
+        Returns None if the frame or level does not exist.
+        """
+        rows, columns = metadata.get("rows"), metadata.get("columns")
+        if not rows or not columns or not 1 <= level <= level_count(rows, columns):
+            return None
+        if not 1 <= frame <= (metadata.get("number_of_frames") or 1):
+            return None
+
+        path = self._level_path(metadata, frame, level)
+        source = instance_store.path(metadata["file_path"])
+        with self._frame_lock(metadata["sop_instance_uid"], frame):
+            if not self._is_fresh(path, source):
+                if not self._build(metadata, frame, use_cache):
+                    return None
+        return path
+
+    def schedule(self, instances: Iterable[Dict[str, Any]]) -> None:
+        """Build pyramids for large images in the background after ingest."""
+        for metadata in instances:
+            rows, columns = metadata.get("rows") or 0, metadata.get("columns") or 0
+            if max(rows, columns) >= settings.PYRAMID_INGEST_MIN_SIZE:
+                self._executor.submit(self._build_all, metadata["sop_instance_uid"])
+
+    def remove_study(self, study_uid: str) -> None:
+        shutil.rmtree(self.root / study_uid, ignore_errors=True)
+
+    def _build_all(self, sop_uid: str) -> None:
+        metadata = metadata_index.get_instance(sop_uid)
+        if metadata is None:
+            return
+        try:
+            for frame in range(1, (metadata.get("number_of_frames") or 1) + 1):
+                self.get_level(metadata, frame, 1, use_cache=False)
+        except Exception:
+            pass  # built on demand instead
+
+    @staticmethod
+    def _is_fresh(path: Path, source: Path) -> bool:
+        try:
+            return path.stat().st_mtime_ns >= source.stat().st_mtime_ns
+        except FileNotFoundError:
+            return False
+
+    def _build(self, metadata: Dict[str, Any], frame: int, use_cache: bool) -> bool:
+        source = instance_store.checked_path(metadata["file_path"], metadata.get("content_hash"))
+        if use_cache:
+            pixel_data = self.parser.get_pixel_data(source, frame, metadata["sop_instance_uid"])
+        else:
+            pixel_data = frame_accessor.read_decoded_frame(source, frame)
+        if pixel_data is None:
+            return False
+
+        rows, columns = metadata["rows"], metadata["columns"]
+        pixels = pixel_values(pixel_data, metadata)
+
+        for level in range(1, level_count(rows, columns) + 1):
+            pixels = downsample(pixels)
+            path = self._level_path(metadata, frame, level)
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = path.with_name(f".{path.name}.{threading.get_ident()}.tmp")
+            tmp_path.write_bytes(pixels.tobytes())
+            os.replace(tmp_path, path)
+        return True
+
+
+pyramid_service = PyramidService(settings.STORAGE_PATH / ".pyramids")
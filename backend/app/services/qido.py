@@ -0,0 +1,357 @@
+"""QIDO-RS query engine over the metadata index"""
+
+import re
+from dataclasses import dataclass
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from app.config import settings
+from app.services.metadata_index import _like_escape, metadata_index
+
+
+LEVELS = ("study", "series", "instance")
+
+MAX_LIMIT = 1000
+
+
+class QidoError(ValueError):
+    """Malformed QIDO-RS query."""
+
+
+@dataclass(frozen=True)
+class Attribute:
+    keyword: str
+    tag: str
+    vr: str
+    level: str
+    column: str  # SQL expression in the joined query (s = studies, se = series, i = instances)
+    default: bool = True  # returned without being asked for via includefield
+
+
+MODALITIES_IN_STUDY = (
+    "(SELECT GROUP_CONCAT(DISTINCT m.modality) FROM series m WHERE m.study_instance_uid = s.study_instance_uid)"
+)
+
+ATTRIBUTES = [
+    # Study level
+    Attribute("StudyInstanceUID", "0020000D", "UI", "study", "s.study_instance_uid"),
+    Attribute("StudyDate", "00080020", "DA", "study", "s.study_date"),
+    Attribute("StudyTime", "00080030", "TM", "study", "s.study_time"),
+    Attribute("AccessionNumber", "00080050", "SH", "study", "s.accession_number"),
+    Attribute("ModalitiesInStudy", "00080061", "CS", "study", MODALITIES_IN_STUDY),
+    Attribute("StudyDescription", "00081030", "LO", "study", "s.study_description"),
+    Attribute("PatientName", "00100010", "PN", "study", "s.patient_name"),
+    Attribute("PatientID", "00100020", "LO", "study", "s.patient_id"),
+    Attribute("PatientBirthDate", "00100030", "DA", "study", "s.patient_birth_date"),
+    Attribute("PatientSex", "00100040", "CS", "study", "s.patient_sex"),
+    Attribute("NumberOfStudyRelatedSeries", "00201206", "IS", "study", "s.series_count"),
+    Attribute("NumberOfStudyRelatedInstances", "00201208", "IS", "study", "s.instance_count"),
+    # Series level
+    Attribute("SeriesInstanceUID", "0020000E", "UI", "series", "se.series_instance_uid"),
+    Attribute("Modality", "00080060", "CS", "series", "se.modality"),
+    Attribute("SeriesDate", "00080021", "DA", "series", "se.series_date", default=False),
+    Attribute("SeriesDescription", "0008103E", "LO", "series", "se.series_description"),
+    Attribute("SeriesNumber", "00200011", "IS", "series", "se.series_number"),
+    Attribute("NumberOfSeriesRelatedInstances", "00201209", "IS", "series", "se.instance_count"),
+    # Instance level
+    Attribute("SOPClassUID", "00080016", "UI", "instance", "i.sop_class_uid"),
+    Attribute("SOPInstanceUID", "00080018", "UI", "instance", "i.sop_instance_uid"),
+    Attribute("InstanceNumber", "00200013", "IS", "instance", "i.instance_number"),
+    Attribute("NumberOfFrames", "00280008", "IS", "instance", "i.number_of_frames"),
+    Attribute("Rows", "00280010", "US", "instance", "json_extract(i.metadata, '$.rows')"),
+    Attribute("Columns", "00280011", "US", "instance", "json_extract(i.metadata, '$.columns')"),
+    Attribute("TransferSyntaxUID", "00020010", "UI", "instance", "i.transfer_syntax_uid", default=False),
+]
+
+BY_NAME = {a.keyword: a for a in ATTRIBUTES}
+BY_NAME.update({a.tag: a for a in ATTRIBUTES})
+
+# FROM clause and default sort order per level
+FROM_CLAUSES = {
+    "study": "studies s",
+    "series": "series se JOIN studies s ON s.study_instance_uid = se.study_instance_uid",
+    "instance": (
+        "instances i JOIN series se ON se.series_instance_uid = i.series_instance_uid"
+        " JOIN studies s ON s.study_instance_uid = i.study_instance_uid"
+    ),
+}
+KEY_COLUMNS = {"study": "s.study_instance_uid", "series": "se.series_instance_uid", "instance": "i.sop_instance_uid"}
+DEFAULT_ORDER = {
+    "study": "s.study_date DESC, s.study_time DESC, s.study_instance_uid",
+    "series": "s.study_instance_uid, COALESCE(se.series_number, 0), se.series_instance_uid",
+    "instance": "i.series_instance_uid, COALESCE(i.instance_number, 0), i.sop_instance_uid",
+}
+
+DATE_TIME_VRS = ("DA", "TM", "DT")
+NUMERIC_VRS = ("IS", "US", "UL", "SS", "SL")
+DATE_RANGE = re.compile(r"^([0-9.]*)-([0-9.]*)$")
+
+
+def _glob_pattern(value: str) -> str:
+    """DICOM wildcards (* and ?) as a SQLite GLOB pattern; GLOB is case-sensitive like DICOM matching."""
+    return value.replace("[", "[[]")
+
+
+@dataclass
+class QidoQuery:
+    """A parsed QIDO-RS request."""
+
+    level: str
+    matches: List[Tuple[Attribute, str]]
+    returned: List[Attribute]
+    fuzzy: bool = False
+    limit: int = 100
+    offset: int = 0
+    order_by: Optional[str] = None
+
+
+class QidoEngine:
+    """Translate QIDO-RS query parameters into one indexed SQL query per request.
+
+    Matching follows PS3.4 C.2.2.2: single value, UID list, wildcard
+    (``*``/``?``), range (``from-to`` for dates and times) and universal
+    (empty value) matching. Higher-level attributes can be matched at lower
+    levels through the join. Sorting and pagination happen in SQL.
+    """
+
+    def search(
+        self,
+        level: str,
+        params: Iterable[Tuple[str, str]],
+        study_uid: Optional[str] = None,
+        series_uid: Optional[str] = None,
+    ) -> List[Dict[str, Any]]:
+        """Run a query and return DICOM JSON results."""
+        query = self.parse(level, params, study_uid, series_uid)
+
+        where: List[str] = []
+        values: List[Any] = []
+        for attribute, value in query.matches:
+            self._match(attribute, value, query.fuzzy, where, values)
+
+        # Filter and paginate on keys first so per-row subqueries only run for the returned page
+        key_column = KEY_COLUMNS[level]
+        order = query.order_by or DEFAULT_ORDER[level]
+        page = f"SELECT {key_column} FROM {FROM_CLAUSES[level]}"
+        if where:
+            page += " WHERE " + " AND ".join(where)
+        page += f" ORDER BY {order} LIMIT ? OFFSET ?"
+        values.extend([query.limit, query.offset])
+
+        columns = ", ".join(f"{a.column} AS c{n}" for n, a in enumerate(query.returned))
+        sql = (
+            f"SELECT {columns}, {self._retrieve_columns(level)} FROM {FROM_CLAUSES[level]}"
+            f" WHERE {key_column} IN ({page}) ORDER BY {order}"
+        )
+        rows = metadata_index.query(sql, values)
+        return [self.to_json(level, query.returned, row) for row in rows]
+
+    def parse(
+        self,
+        level: str,
+        params: Iterable[Tuple[str, str]],
+        study_uid: Optional[str] = None,
+        series_uid: Optional[str] = None,
+    ) -> QidoQuery:
+        """Validate query parameters and work out the matching keys and returned attributes."""
+        if level not in LEVELS:
+            raise QidoError(f"Unknown query level {level}")
+
+        matches: List[Tuple[Attribute, str]] = []
+        include: List[Attribute] = []
+        include_all = False
+        fuzzy = False
+        limit, offset = 100, 0
+        order_by: Optional[str] = None
+
+        for key, value in params:
+            if key == "limit":
+                limit = self._int_param(key, value, 1, MAX_LIMIT)
+            elif key == "offset":
+                offset = self._int_param(key, value, 0, None)
+            elif key == "fuzzymatching":
+                fuzzy = value.lower() == "true"
+            elif key == "orderby":
+                order_by = self._order_by(level, value)
+            elif key == "includefield":
+                for name in filter(None, (part.strip() for part in value.split(","))):
+                    if name == "all":
+                        include_all = True
+                    elif self._attribute(level, name) is not None:
+                        include.append(self._attribute(level, name))
+            else:
+                attribute = self._attribute(level, key)
+                if attribute is not None:
+                    matches.append((attribute, value))
+
+        if study_uid is not None:
+            matches.append((BY_NAME["StudyInstanceUID"], study_uid))
+        if series_uid is not None:
+            matches.append((BY_NAME["SeriesInstanceUID"], series_uid))
+
+        returned = self._returned_attributes(level, matches, include, include_all, study_uid, series_uid)
+        return QidoQuery(level, matches, returned, fuzzy, limit, offset, order_by)
+
+    # ---------- Parameter handling ----------
+
+    @staticmethod
+    def _int_param(key: str, value: str, low: int, high: Optional[int]) -> int:
+        try:
+            number = int(value)
+        except ValueError:
+            raise QidoError(f"{key} must be an integer")
+        if number < low or (high is not None and number > high):
+            raise QidoError(f"{key} must be between {low} and {high}" if high else f"{key} must be at least {low}")
+        return number
+
+    @staticmethod
+    def _attribute(level: str, name: str) -> Optional[Attribute]:
+        attribute = BY_NAME.get(name) or BY_NAME.get(name.upper())
+        if attribute is None or LEVELS.index(attribute.level) > LEVELS.index(level):
+            return None
+        return attribute
+
+    def _order_by(self, level: str, value: str) -> str:
+        terms = []
+        for name in filter(None, (part.strip() for part in value.split(","))):
+            descending = name.startswith("-")
+            attribute = self._attribute(level, name.lstrip("-+"))
+            if attribute is None or attribute.keyword == "ModalitiesInStudy":
+                raise QidoError(f"Cannot sort by {name}")
+            terms.append(f"{attribute.column} {'DESC' if descending else 'ASC'}")
+        if not terms:
+            raise QidoError("orderby needs at least one attribute")
+        return ", ".join(terms + [DEFAULT_ORDER[level]])
+
+    @staticmethod
+    def _returned_attributes(
+        level: str,
+        matches: List[Tuple[Attribute, str]],
+        include: List[Attribute],
+        include_all: bool,
+        study_uid: Optional[str],
+        series_uid: Optional[str],
+    ) -> List[Attribute]:
+        """Attributes in each result (PS3.18 Table 6.7.1-2).
+
+        The level's default attributes, plus those of the higher levels the
+        query is not scoped to, the matched keys and any includefields.
+        """
+        levels = {level}
+        if level != "study" and study_uid is None:
+            levels.add("study")
+        if level == "instance" and series_uid is None:
+            levels.add("series")
+        returned = [a for a in ATTRIBUTES if a.level in levels and (a.default or include_all)]
+        for attribute in [a for a, _ in matches] + include:
+            if attribute not in returned:
+                returned.append(attribute)
+        return returned
+
+    # ---------- Matching ----------
+
+    def _match(self, attribute: Attribute, value: str, fuzzy: bool, where: List[str], values: List[Any]) -> None:
+        if value in ("", "*"):
+            return  # universal matching
+
+        if attribute.keyword == "ModalitiesInStudy":
+            modalities = [v for v in value.replace(",", "\\").split("\\") if v]
+            where.append(
+                "EXISTS (SELECT 1 FROM series m WHERE m.study_instance_uid = s.study_instance_uid"
+                f" AND m.modality IN ({', '.join('?' for _ in modalities)}))"
+            )
+            values.extend(modalities)
+            return
+
+        if attribute.vr == "UI":
+            uids = [v for v in value.replace(",", "\\").split("\\") if v]
+            if len(uids) == 1:
+                where.append(f"{attribute.column} = ?")
+            else:
+                where.append(f"{attribute.column} IN ({', '.join('?' for _ in uids)})")
+            values.extend(uids)
+            return
+
+        if attribute.vr in DATE_TIME_VRS:
+            date_range = DATE_RANGE.match(value)
+            if date_range:
+                start, end = date_range.groups()
+                if not start and not end:
+                    raise QidoError(f"Invalid range for {attribute.keyword}")
+                if start:
+                    where.append(f"{attribute.column} >= ?")
+                    values.append(start)
+                if end:
+                    # A range end includes the whole of its last unit (e.g. "-1230" includes 12:30:59)
+                    where.append(f"{attribute.column} <= ?")
+                    values.append(end if attribute.vr == "DA" else end + "\uffff")
+                return
+            if attribute.vr == "TM":
+                where.append(f"{attribute.column} GLOB ?")
+                values.append(_glob_pattern(value) + "*")
+            else:
+                where.append(f"{attribute.column} = ?")
+                values.append(value)
+            return
+
+        if attribute.vr in NUMERIC_VRS:
+            try:
+                number = int(value)
+            except ValueError:
+                raise QidoError(f"{attribute.keyword} must be an integer")
+            where.append(f"{attribute.column} = ?")
+            values.append(number)
+            return
+
+        if attribute.vr == "PN" and fuzzy:
+            # Case-insensitive prefix match of any name component or word
+            term = _like_escape(value.rstrip("*")).replace("*", "%").replace("?", "_")
+            where.append(
+                f"({attribute.column} LIKE ? ESCAPE '\\' OR {attribute.column} LIKE ? ESCAPE '\\'"
+                f" OR {attribute.column} LIKE ? ESCAPE '\\')"
+            )
+            values.extend([f"{term}%", f"%^{term}%", f"% {term}%"])
+            return
+
+        if "*" in value or "?" in value:
+            where.append(f"{attribute.column} GLOB ?")
+            values.append(_glob_pattern(value))
+        else:
+            where.append(f"{attribute.column} = ?")
+            values.append(value)
+
+    # ---------- Results ----------
+
+    @staticmethod
+    def _retrieve_columns(level: str) -> str:
+        columns = {"study": ["s.study_instance_uid"], "series": ["s.study_instance_uid", "se.series_instance_uid"]}
+        columns["instance"] = columns["series"] + ["i.sop_instance_uid"]
+        return ", ".join(f"{c} AS r{n}" for n, c in enumerate(columns[level]))
+
+    @staticmethod
+    def to_json(level: str, returned: List[Attribute], row) -> Dict[str, Any]:
+        """One result: ``row`` maps ``c<n>`` to the value of ``returned[n]`` and ``r0``-``r2`` to the entity's UIDs."""
+        result: Dict[str, Any] = {}
+        for n, attribute in enumerate(returned):
+            value = row[f"c{n}"]
+            element: Dict[str, Any] = {"vr": attribute.vr}
+            if value not in (None, ""):
+                if attribute.vr == "PN":
+                    element["Value"] = [{"Alphabetic": value}]
+                elif attribute.keyword == "ModalitiesInStudy":
+                    element["Value"] = sorted(set(value.split(",")))
+                elif attribute.vr in NUMERIC_VRS:
+                    element["Value"] = [int(value)]
+                else:
+                    element["Value"] = [str(value)]
+            result[attribute.tag] = element
+
+        url = f"{settings.API_V1_PREFIX}/dicomweb/studies/{row['r0']}"
+        if level in ("series", "instance"):
+            url += f"/series/{row['r1']}"
+        if level == "instance":
+            url += f"/instances/{row['r2']}"
+        result["00081190"] = {"vr": "UR", "Value": [url]}
+        return dict(sorted(result.items()))
+
+
+qido_engine = QidoEngine()
@@ -0,0 +1,408 @@
+"""Reconciliation of the metadata index with the files actually in the archive"""
+
+import argparse
+import json
+import os
+import threading
+import time
+from concurrent.futures import as_completed
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+from app.config import settings
+from app.services.cache import dicom_cache
+from app.services.frame_scheduler import frame_scheduler
+from app.services.ingest import index_stored, read_stored_file
+from app.services.ingest_jobs import ingest_pipeline
+from app.services.metadata_documents import metadata_documents
+from app.services.metadata_index import metadata_index
+from app.services.metrics import ingest_instances
+from app.services.pyramid import pyramid_service
+from app.services.renderer import render_service
+from app.services.storage import InstanceStore, instance_store
+from app.services.volume import volume_service
+from app.services.watcher import DirectoryWatcher
+
+# A directory changed this recently may change again within the same mtime tick: rescan it next time
+RACY_WINDOW_NS = 2_000_000_000
+
+# Files parsed per round of worker submissions
+PARSE_WINDOW = 4096
+
+
+class ArchiveReconciler:
+    """Index files put into the store behind the app's back and forget those that disappeared.
+
+    The index records the mtime of every directory of the store's tree and
+    the size and mtime of every file, as last seen. Adding or removing an
+    entry changes its directory's mtime, so a pass only stats directories
+    and lists the leaf directories that changed; on an unchanged archive it
+    reads no file at all. New or changed files are parsed on the ingest
+    worker processes. Files the index already points at (written by the app
+    itself) are recorded without parsing, and files of deleted studies
+    awaiting reclaim are left alone. Instances whose file is gone are
+    removed from the index, except those of cold-tier studies, whose files
+    are meant to be away.
+
+    Every tree of the store is walked: under the content-addressed layout
+    that includes a ``<study>/<series>/<sop>.dcm`` tree next to
+    ``.objects``, whose files are indexed where they are until migrated.
+
+    Rewriting a file in place leaves its directory's mtime alone: inotify
+    reports it, and a ``full`` pass lists and stats every file.
+
+    While the app runs, inotify watches on the tree's directories queue the
+    ones that changed for a pass after ``settle`` seconds. Where inotify is
+    not available or runs out of watches, a pass runs every ``poll_interval``.
+    """
+
+    def __init__(self, store: InstanceStore, watch: str, settle: float, poll_interval: float, batch_size: int):
+        if watch not in ("inotify", "poll", "off"):
+            raise ValueError("ARCHIVE_WATCH must be one of inotify, poll, off")
+        self.store = store
+        self.watch = watch
+        self.settle = settle
+        self.poll_interval = poll_interval
+        self.batch_size = batch_size
+        self.trees = tuple(str(Path(tree)) for tree in store.trees)
+        self.mode = "off"
+        self.counters = {"passes": 0, "indexed": 0, "adopted": 0, "removed": 0, "failed": 0, "seconds": 0.0}
+        self.last: Optional[Dict[str, Any]] = None
+        self._lock = threading.Lock()  # one pass at a time
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._watcher: Optional[DirectoryWatcher] = None
+        self._pending: Dict[str, float] = {}
+
+    def start(self, reconcile: bool = True) -> None:
+        """Reconcile and then follow changes, in a background thread."""
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, args=(reconcile,), name="archive-reconciler", daemon=True)
+        self._thread.start()
+
+    def shutdown(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    # ---------- Passes ----------
+
+    def reconcile(self, full: bool = False, dirs: Optional[Iterable[str]] = None) -> Dict[str, Any]:
+        """Bring the index in line with the tree, or with some of its directories; returns a summary.
+
+        ``full`` lists every directory and stats every file instead of
+        trusting unchanged directory mtimes.
+        """
+        with self._lock:
+            summary, _ = self._reconcile(full, dirs)
+            return summary
+
+    def _reconcile(self, full: bool, dirs: Optional[Iterable[str]]) -> Tuple[Dict[str, Any], Set[str]]:
+        started = time.perf_counter()
+        summary = {
+            "full": full,
+            "dirs_scanned": 0,
+            "dirs_unchanged": 0,
+            "files_checked": 0,
+            "adopted": 0,
+            "indexed": 0,
+            "failed": 0,
+            "removed": 0,
+        }
+        known_dirs = metadata_index.archive_dirs()
+        children: Dict[str, Set[str]] = {}
+        for key in known_dirs:
+            if key not in self.trees:
+                children.setdefault(os.path.dirname(key) or ".", set()).add(key)
+
+        recorded_dirs: Dict[str, int] = {}
+        gone_dirs: Set[str] = set()
+        changed_leaves: List[str] = []
+        now_ns = time.time_ns()
+
+        def forget_dir(key: str) -> None:
+            gone_dirs.add(key)
+            for child in children.get(key, ()):
+                forget_dir(child)
+
+        # Partial passes list the directories they are given (a file rewritten in place leaves the
+        # directory's mtime alone) and descend only into new ones: the others report their own changes
+        forced = set() if dirs is None else set(dirs)
+        stack = list(self.trees) if dirs is None else list(forced)
+        while stack:
+            key = stack.pop()
+            depth = self._depth(key)
+            try:
+                mtime = os.stat(self.store.root / key).st_mtime_ns
+            except (FileNotFoundError, NotADirectoryError):
+                if key in known_dirs:
+                    forget_dir(key)
+                continue
+            changed = full or key in forced or known_dirs.get(key) != mtime
+            if changed:
+                recorded_dirs[key] = mtime if now_ns - mtime > RACY_WINDOW_NS else -1
+            if depth >= self.store.tree_depth:
+                if changed:
+                    summary["dirs_scanned"] += 1
+                    changed_leaves.append(key)
+                else:
+                    summary["dirs_unchanged"] += 1
+                continue
+
+            if changed:
+                summary["dirs_scanned"] += 1
+                try:
+                    with os.scandir(self.store.root / key) as entries:
+                        subdirs = {
+                            self._join(key, entry.name)
+                            for entry in entries
+                            if not entry.name.startswith(".") and entry.is_dir(follow_symlinks=False)
+                        }
+                except FileNotFoundError:
+                    subdirs = set()
+                for vanished in children.get(key, set()) - subdirs:
+                    forget_dir(vanished)
+            else:
+                summary["dirs_unchanged"] += 1
+                subdirs = children.get(key, set())
+            stack.extend(child for child in subdirs if dirs is None or child not in known_dirs)
+
+        # Leaf directories that changed: compare their files with what was recorded
+        recorded = metadata_index.archive_files(changed_leaves)
+        present: Dict[str, Tuple[str, int, int]] = {}
+        for leaf in changed_leaves:
+            try:
+                with os.scandir(self.store.root / leaf) as entries:
+                    for entry in entries:
+                        if entry.name.startswith(".") or not entry.name.endswith(".dcm"):
+                            continue  # partial copies and temporary files
+                        if not entry.is_file(follow_symlinks=False):
+                            continue
+                        stat = entry.stat(follow_symlinks=False)
+                        present[self._join(leaf, entry.name)] = (leaf, stat.st_size, stat.st_mtime_ns)
+                        if now_ns - stat.st_mtime_ns <= RACY_WINDOW_NS:
+                            recorded_dirs[leaf] = -1  # may still be written to
+            except FileNotFoundError:
+                forget_dir(leaf)
+        summary["files_checked"] = len(present)
+        missing = {path for path in recorded if path not in present}
+        missing.update(metadata_index.archive_files(gone_dirs))
+
+        candidates = [path for path, (_, size, mtime) in present.items() if recorded.get(path) != (size, mtime)]
+        if candidates:
+            self._index(candidates, recorded, summary)
+        if missing:
+            self._forget(list(missing), summary)
+
+        # Interrupted by shutdown: record nothing, so the next pass looks at the same files again
+        if not self._stop.is_set():
+            metadata_index.update_archive_state(
+                {key: mtime for key, mtime in recorded_dirs.items() if key not in gone_dirs},
+                gone_dirs,
+                [(path, *present[path]) for path in candidates],
+                missing,
+            )
+        discovered = {key for key in recorded_dirs if key not in known_dirs and key not in gone_dirs}
+
+        summary["seconds"] = round(time.perf_counter() - started, 3)
+        summary["finished_at"] = time.time()
+        for key in ("indexed", "adopted", "removed", "failed"):
+            self.counters[key] += summary[key]
+        self.counters["passes"] += 1
+        self.counters["seconds"] += summary["seconds"]
+        self.last = summary
+        return summary, discovered
+
+    # Keys are paths relative to the store root as the index records them ("." for the root itself)
+
+    def _depth(self, key: str) -> int:
+        """Directory levels between ``key`` and the tree it belongs to."""
+        if key in self.trees:
+            return 0
+        for tree in self.trees:
+            if tree != "." and key.startswith(f"{tree}/"):
+                return key.count("/") - tree.count("/")
+        return key.count("/") + 1  # under the root tree (dot-directories are never walked from it)
+
+    @staticmethod
+    def _join(key: str, name: str) -> str:
+        return name if key == "." else f"{key}/{name}"
+
+    def _index(self, candidates: List[str], recorded: Dict[str, Tuple[int, int]], summary: Dict[str, Any]) -> None:
+        """Parse new and changed files on the worker processes and index them in batches."""
+        referenced = metadata_index.referenced_paths(candidates)
+        tombstoned = metadata_index.tombstoned_paths()
+        to_parse = []
+        for path in candidates:
+            if path in tombstoned:
+                continue  # deleted, waiting to be reclaimed
+            if path in referenced and path not in recorded:
+                summary["adopted"] += 1  # stored by the app itself
+            else:
+                to_parse.append(path)
+
+        for start in range(0, len(to_parse), PARSE_WINDOW):
+            if self._stop.is_set():
+                break
+            futures = [
+                ingest_pipeline.executor.submit(read_stored_file, path, self.store)
+                for path in to_parse[start:start + PARSE_WINDOW]
+            ]
+            batch = []
+            for future in as_completed(futures):
+                try:
+                    batch.append(future.result())
+                except Exception:
+                    summary["failed"] += 1  # recorded anyway, so not retried until it changes
+                    continue
+                if len(batch) >= self.batch_size:
+                    summary["indexed"] += self._index_batch(batch)
+                    batch = []
+            summary["indexed"] += self._index_batch(batch)
+        ingest_instances.labels("reconcile", "stored").inc(summary["indexed"])
+        ingest_instances.labels("reconcile", "failed").inc(summary["failed"])
+
+    def _index_batch(self, batch: List[Tuple[Dict[str, Any], Path, str]]) -> int:
+        # A study deleted while its files were being parsed must not come back
+        tombstoned = metadata_index.tombstoned_paths()
+        batch = [item for item in batch if str(item[1]) not in tombstoned]
+        index_stored(batch)
+        return len(batch)
+
+    def _forget(self, missing: List[str], summary: Dict[str, Any]) -> None:
+        """Remove the instances whose files are gone, and everything derived from them."""
+        removed = metadata_index.remove_files(missing)
+        if not removed:
+            return
+        summary["removed"] += len(removed)
+        dicom_cache.invalidate_many(row["sop_instance_uid"] for row in removed)
+        metadata_documents.remove_instances(
+            (row["study_instance_uid"], row["series_instance_uid"], row["sop_instance_uid"]) for row in removed
+        )
+        touched = {(row["study_instance_uid"], row["series_instance_uid"]) for row in removed}
+        volume_service.invalidate_series(touched)
+        frame_scheduler.invalidate_series(touched)
+        render_service.schedule_series_thumbnails(
+            key for key in touched if metadata_index.get_series(key[1]) is not None
+        )
+        for study_uid in {study_uid for study_uid, _ in touched}:
+            if metadata_index.get_study(study_uid) is None:
+                metadata_documents.remove_study(study_uid)
+                render_service.remove_study(study_uid)
+                volume_service.remove_study(study_uid)
+                pyramid_service.remove_study(study_uid)
+
+    # ---------- Following changes ----------
+
+    def _run(self, reconcile: bool) -> None:
+        mode = self.watch
+        if mode == "inotify":
+            try:
+                self._watcher = DirectoryWatcher()
+                for tree in self.trees:
+                    (self.store.root / tree).mkdir(parents=True, exist_ok=True)
+                # Watch what is known before the first pass, so changes made during it are not lost
+                self._add_watches([*self.trees, *metadata_index.archive_dirs()])
+            except OSError:
+                self._close_watcher()
+                mode = "poll"
+        self.mode = mode
+
+        if reconcile:
+            self._safe_pass(None)
+        if self.mode == "inotify":
+            self._follow()
+        elif self.mode == "poll":
+            while not self._stop.wait(self.poll_interval):
+                self._safe_pass(None)
+        self._close_watcher()
+
+    def _follow(self) -> None:
+        while not self._stop.is_set():
+            now = time.monotonic()
+            timeout = min([1.0, *(deadline - now for deadline in self._pending.values())])
+            try:
+                changed, overflowed = self._watcher.read(max(0.0, timeout))
+            except OSError:
+                changed, overflowed = set(), True
+            now = time.monotonic()
+            if overflowed:
+                self._pending.clear()
+                self._safe_pass(None)  # events were lost
+            for key in changed:
+                self._pending.setdefault(key, now + self.settle)
+            due = [key for key, deadline in self._pending.items() if deadline <= now]
+            if due:
+                for key in due:
+                    del self._pending[key]
+                self._safe_pass(due)
+            if self.mode != "inotify":
+                # Out of watches: poll instead
+                while not self._stop.wait(self.poll_interval):
+                    self._safe_pass(None)
+                return
+
+    def _safe_pass(self, dirs: Optional[List[str]]) -> None:
+        try:
+            with self._lock:
+                _, discovered = self._reconcile(False, dirs)
+        except Exception:
+            return  # retried on the next change or pass; the recorded state is only written after indexing
+        if self._watcher is not None:
+            try:
+                self._add_watches(discovered)
+            except OSError:
+                self._close_watcher()
+                self.mode = "poll"
+                return
+            # Entries created before the watch was in place: look once more
+            deadline = time.monotonic() + self.settle
+            for key in discovered:
+                self._pending.setdefault(key, deadline)
+
+    def _add_watches(self, keys: Iterable[str]) -> None:
+        for key in keys:
+            if key not in self._watcher:
+                self._watcher.watch(self.store.root / key, key)
+
+    def _close_watcher(self) -> None:
+        if self._watcher is not None:
+            self._watcher.close()
+            self._watcher = None
+
+    def stats(self) -> Dict[str, Any]:
+        watcher = self._watcher
+        return {
+            **self.counters,
+            "mode": self.mode,
+            "watched_dirs": len(watcher) if watcher is not None else 0,
+            "pending_dirs": len(self._pending),
+            "last": self.last,
+        }
+
+
+archive_reconciler = ArchiveReconciler(
+    instance_store,
+    settings.ARCHIVE_WATCH,
+    settings.ARCHIVE_WATCH_SETTLE,
+    settings.ARCHIVE_POLL_INTERVAL,
+    settings.INGEST_BATCH_SIZE,
+)
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(
+        prog="python -m app.services.reconciler", description="Bring the metadata index in line with the archive"
+    )
+    parser.add_argument("--full", action="store_true", help="List every directory and stat every file")
+    args = parser.parse_args(argv)
+    try:
+        summary = archive_reconciler.reconcile(full=args.full)
+    finally:
+        ingest_pipeline.shutdown()
+    print(json.dumps(summary))
+
+
+if __name__ == "__main__":
+    main()
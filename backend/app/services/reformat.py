@@ -0,0 +1,318 @@
+"""Multiplanar reformatting and MIP/MinIP slabs over cached series volumes"""
+
+import math
+import os
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Sequence, Tuple
+
+import numpy as np
+
+from app.services.volume import Volume, volume_service
+
+
+PLANES = ("axial", "coronal", "sagittal", "oblique")
+SLAB_MODES = ("mpr", "mip", "minip", "average")
+
+MAX_PLANE_SIZE = 4096  # pixels per side of an oblique plane
+MAX_SAMPLES = 1 << 27  # interpolated points per oblique plane or slab
+SAMPLE_CHUNK = 1 << 20  # points interpolated at once, which bounds the working memory
+
+
+class ReformatError(ValueError):
+    """Invalid reformat parameters."""
+
+
+class Plane:
+    """A reformatted 2D image and where it lies in patient space."""
+
+    def __init__(
+        self,
+        pixels: np.ndarray,
+        spacing: Tuple[float, float],
+        origin: np.ndarray,
+        row_direction: np.ndarray,
+        column_direction: np.ndarray,
+    ):
+        self.pixels = np.ascontiguousarray(pixels)
+        self.spacing = spacing
+        self.origin = origin
+        self.row_direction = row_direction
+        self.column_direction = column_direction
+
+    def header(self) -> Dict[str, Any]:
+        rows, columns = self.pixels.shape
+        return {
+            "dimensions": [columns, rows],
+            "spacing": [float(v) for v in self.spacing],
+            "origin": [float(v) for v in self.origin],
+            "row_direction": [float(v) for v in self.row_direction],
+            "column_direction": [float(v) for v in self.column_direction],
+            "dtype": self.pixels.dtype.name,
+            "byte_order": "little",
+        }
+
+
+def _reduce(slab: np.ndarray, mode: str, axis: int) -> np.ndarray:
+    # fmax/fmin skip NaN (rays outside the volume) like nanmax/nanmin, without an
+    # "All-NaN slice" warning when a whole ray is outside: such pixels stay NaN
+    if mode == "mip":
+        return np.fmax.reduce(slab, axis=axis)
+    if mode == "minip":
+        return np.fmin.reduce(slab, axis=axis)
+    if mode == "average":
+        if slab.dtype.kind != "f":
+            return slab.mean(axis=axis, dtype=np.float32)
+        counts = np.count_nonzero(~np.isnan(slab), axis=axis)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return np.nansum(slab, axis=axis, dtype=np.float32) / counts
+    return slab.take(slab.shape[axis] // 2, axis=axis)
+
+
+def _accumulate(total: Optional[np.ndarray], count: Optional[np.ndarray], samples: np.ndarray, mode: str):
+    """Fold one plane of a slab into the running reduction (NaN samples are outside the volume)."""
+    if total is None:
+        total = samples if mode != "average" else np.zeros_like(samples)
+        count = np.zeros(samples.shape, dtype=np.int32) if mode == "average" else None
+        if mode != "average":
+            return total, count
+    if mode == "mip":
+        return np.fmax(total, samples, out=total), count
+    if mode == "minip":
+        return np.fmin(total, samples, out=total), count
+    present = ~np.isnan(samples)
+    total += np.where(present, samples, 0)
+    count += present
+    return total, count
+
+
+def trilinear(voxels: np.ndarray, k: np.ndarray, j: np.ndarray, i: np.ndarray) -> np.ndarray:
+    """Sample a (slices, rows, columns) volume at fractional voxel coordinates.
+
+    Points outside the volume are NaN. The eight neighbours of every point
+    are gathered in one flat ``take`` and blended axis by axis, so the cost
+    is a handful of vector ops per plane.
+    """
+    shape = voxels.shape
+    inside = (k >= 0) & (k <= shape[0] - 1) & (j >= 0) & (j <= shape[1] - 1) & (i >= 0) & (i <= shape[2] - 1)
+
+    bases = []
+    fractions = []
+    for coordinate, size in zip((k, j, i), shape):
+        base = np.clip(np.floor(coordinate), 0, max(size - 2, 0)).astype(np.intp)
+        bases.append(base)
+        fractions.append(np.clip(coordinate - base, 0.0, 1.0).astype(np.float32))
+    (k0, j0, i0), (fk, fj, fi) = bases, fractions
+
+    stride_k, stride_j = shape[1] * shape[2], shape[2]
+    dk = stride_k if shape[0] > 1 else 0
+    dj = stride_j if shape[1] > 1 else 0
+    di = 1 if shape[2] > 1 else 0
+    offsets = np.array([0, di, dj, dj + di, dk, dk + di, dk + dj, dk + dj + di], dtype=np.intp)
+
+    index = k0 * stride_k + j0 * stride_j + i0
+    corners = voxels.reshape(-1).take(index + offsets.reshape((8,) + (1,) * index.ndim)).astype(np.float32)
+    corners = corners[0::2] + (corners[1::2] - corners[0::2]) * fi
+    corners = corners[0::2] + (corners[1::2] - corners[0::2]) * fj
+    values = corners[0] + (corners[1] - corners[0]) * fk
+    values[~inside] = np.nan
+    return values
+
+
+class ReformatService:
+    """Cut planes and slabs out of series volumes.
+
+    Volumes are memory-mapped once per series and kept in a small LRU, so
+    scrolling through planes only touches the pages each plane needs.
+    Axis-aligned planes are plain array slices; oblique planes use
+    vectorized trilinear interpolation.
+    """
+
+    def __init__(self, max_volumes: int = 8):
+        self.max_volumes = max_volumes
+        self._volumes: "OrderedDict[Tuple[str, str], tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def open_volume(self, study_uid: str, series_uid: str) -> Optional[Tuple[Volume, np.ndarray]]:
+        """Return the series volume and its memmap, reusing an open mapping when still current."""
+        key = (study_uid, series_uid)
+        with self._lock:
+            entry = self._volumes.get(key)
+        if entry is not None:
+            volume, voxels, mtime_ns = entry
+            try:
+                if os.stat(volume.path).st_mtime_ns == mtime_ns:
+                    with self._lock:
+                        self._volumes.move_to_end(key)
+                        self.hits += 1
+                    return volume, voxels
+            except FileNotFoundError:
+                pass
+        with self._lock:
+            self.misses += 1
+
+        volume = volume_service.get_volume(study_uid, series_uid)
+        if volume is None:
+            return None
+        voxels = volume.array()
+        with self._lock:
+            self._volumes[key] = (volume, voxels, os.stat(volume.path).st_mtime_ns)
+            self._volumes.move_to_end(key)
+            while len(self._volumes) > self.max_volumes:
+                self._volumes.popitem(last=False)
+        return volume, voxels
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"entries": len(self._volumes), "hits": self.hits, "misses": self.misses}
+
+    def reformat(
+        self,
+        volume: Volume,
+        voxels: np.ndarray,
+        plane: str = "axial",
+        position: Optional[float] = None,
+        center: Optional[Sequence[float]] = None,
+        row_direction: Optional[Sequence[float]] = None,
+        column_direction: Optional[Sequence[float]] = None,
+        size: Optional[Tuple[int, int]] = None,
+        pixel_spacing: Optional[float] = None,
+        thickness: float = 0.0,
+        mode: str = "mpr",
+    ) -> Plane:
+        """Compute a plane or slab.
+
+        ``position`` is the slice index for axis-aligned planes (middle by
+        default). Oblique planes are given by a ``center`` in patient mm and
+        the plane's row and column direction cosines. ``thickness`` in mm
+        turns the plane into a slab reduced by ``mode``.
+        """
+        if plane not in PLANES:
+            raise ReformatError(f"plane must be one of {', '.join(PLANES)}")
+        if mode not in SLAB_MODES:
+            raise ReformatError(f"mode must be one of {', '.join(SLAB_MODES)}")
+        if not all(math.isfinite(value) for value in (thickness, pixel_spacing or 1.0, position or 0.0)):
+            raise ReformatError("position, spacing and thickness must be finite")
+
+        if plane == "oblique":
+            return self._oblique(
+                volume, voxels, center, row_direction, column_direction, size, pixel_spacing, thickness, mode
+            )
+        return self._orthogonal(volume, voxels, plane, position, thickness, mode)
+
+    def _orthogonal(
+        self, volume: Volume, voxels: np.ndarray, plane: str, position: Optional[float], thickness: float, mode: str
+    ) -> Plane:
+        header = volume.header
+        sx, sy, sz = header["spacing"]
+        origin = np.array(header["origin"])
+        direction = np.array(header["direction"]).reshape(3, 3)
+        row_cosine, column_cosine, normal = direction
+        slices, rows, columns = voxels.shape
+
+        # Volume axis cut by the plane, its spacing, and the resulting image layout
+        axis, step, count = {"axial": (0, sz, slices), "coronal": (1, sy, rows), "sagittal": (2, sx, columns)}[plane]
+        index = int(round(position)) if position is not None else count // 2
+        if not 0 <= index < count:
+            raise ReformatError(f"position must be between 0 and {count - 1}")
+
+        half = int(round(thickness / step / 2)) if mode != "mpr" else 0
+        start, stop = max(index - half, 0), min(index + half + 1, count)
+        slab = voxels[(slice(None),) * axis + (slice(start, stop),)]
+        pixels = _reduce(np.asarray(slab), mode, axis)
+
+        if plane == "axial":
+            return Plane(pixels, (sx, sy), origin + index * sz * normal, row_cosine, column_cosine)
+
+        # Coronal and sagittal images are shown with the last slice at the top
+        pixels = pixels[::-1]
+        top = origin + (slices - 1) * sz * normal
+        if plane == "coronal":
+            return Plane(pixels, (sx, sz), top + index * sy * column_cosine, row_cosine, -normal)
+        return Plane(pixels, (sy, sz), top + index * sx * row_cosine, column_cosine, -normal)
+
+    def _oblique(
+        self,
+        volume: Volume,
+        voxels: np.ndarray,
+        center: Optional[Sequence[float]],
+        row_direction: Optional[Sequence[float]],
+        column_direction: Optional[Sequence[float]],
+        size: Optional[Tuple[int, int]],
+        pixel_spacing: Optional[float],
+        thickness: float,
+        mode: str,
+    ) -> Plane:
+        header = volume.header
+        spacing = np.array(header["spacing"])
+        origin = np.array(header["origin"])
+        direction = np.array(header["direction"]).reshape(3, 3)
+        extent = (np.array(voxels.shape[::-1]) - 1) * spacing
+
+        u = np.array(row_direction if row_direction is not None else direction[0], dtype=np.float64)
+        v = np.array(column_direction if column_direction is not None else direction[1], dtype=np.float64)
+        if np.linalg.norm(u) < 1e-6 or np.linalg.norm(v) < 1e-6:
+            raise ReformatError("row and column directions must be non-zero")
+        u /= np.linalg.norm(u)
+        v -= np.dot(v, u) * u  # make the plane axes orthogonal
+        if np.linalg.norm(v) < 1e-6:
+            raise ReformatError("row and column directions must not be parallel")
+        v /= np.linalg.norm(v)
+        n = np.cross(u, v)
+
+        if center is None:
+            center = origin + direction.T @ (extent / 2)
+        center = np.array(center, dtype=np.float64)
+        step = float(pixel_spacing or spacing.min())
+        if size is None:
+            side = int(math.ceil(extent.max() / step)) + 1
+            size = (side, side)
+        width, height = size
+        if not (1 <= width <= MAX_PLANE_SIZE and 1 <= height <= MAX_PLANE_SIZE):
+            raise ReformatError(f"plane size must be between 1 and {MAX_PLANE_SIZE} pixels per side")
+
+        xs = (np.arange(width, dtype=np.float64) - (width - 1) / 2) * step
+        ys = (np.arange(height, dtype=np.float64) - (height - 1) / 2) * step
+        # A slab thicker than the volume's diagonal samples nothing more
+        reach = float(np.linalg.norm(extent)) + spacing[2]
+        depth = int(round(min(thickness, reach) / spacing[2] / 2)) if mode != "mpr" else 0
+        zs = np.arange(-depth, depth + 1, dtype=np.float64) * spacing[2]
+        if width * height * len(zs) > MAX_SAMPLES:
+            raise ReformatError("plane size and slab thickness exceed the sampling limit")
+
+        # Patient-space sample points -> voxel coordinates (directions are orthonormal)
+        to_voxel = direction / spacing[:, None]
+        offset = to_voxel @ (center - origin)
+        plane_axes = to_voxel @ np.stack([u, v, n], axis=1)  # voxel-space step per mm along u, v, n
+
+        # Interpolate in bands of rows, one slab plane at a time, folding each into the reduction
+        pixels = np.empty((height, width), dtype=np.float32)
+        band = max(SAMPLE_CHUNK // width, 1)
+        for top in range(0, height, band):
+            rows = ys[top:top + band]
+            total = count = None
+            for z in zs:
+                grid = (
+                    (offset + plane_axes[:, 2] * z)[:, None, None]
+                    + plane_axes[:, 0, None, None] * xs[None, None, :]
+                    + plane_axes[:, 1, None, None] * rows[None, :, None]
+                )
+                i, j, k = grid
+                total, count = _accumulate(total, count, trilinear(voxels, k, j, i), mode if depth else "mpr")
+            if count is not None:
+                with np.errstate(invalid="ignore", divide="ignore"):
+                    total = total / count
+            pixels[top:top + band] = total
+
+        if np.isnan(pixels).all():
+            pixels = np.zeros_like(pixels)
+        else:
+            pixels = np.where(np.isnan(pixels), np.nanmin(pixels), pixels)
+
+        top_left = center - (width - 1) / 2 * step * u - (height - 1) / 2 * step * v
+        return Plane(pixels.astype(np.float32), (step, step), top_left, u, v)
+
+
+reformat_service = ReformatService()
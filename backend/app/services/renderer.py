@@ -0,0 +1,332 @@
+"""Server-side rendering of frames and thumbnails"""
+
+import io
+import os
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Dict, Optional, Tuple
+
+import numpy as np
+from PIL import Image
+
+from app.config import settings
+from app.services.dicom_parser import DICOMParserService
+from app.services.metadata_index import metadata_index
+from app.services.profiling import timed_stage
+from app.services.storage import instance_store
+
+
+RENDERED_MEDIA_TYPES = {"image/jpeg": "JPEG", "image/png": "PNG"}
+
+VOI_FUNCTIONS = ("LINEAR", "LINEAR_EXACT", "SIGMOID")
+MAX_LUT_ENTRIES = 65536  # wider value ranges (e.g. 32-bit dose grids) are windowed directly
+
+
+def pixel_dtype(metadata: Dict[str, Any]) -> np.dtype:
+    """NumPy dtype of decoded pixel bytes as produced by ``get_pixel_data``."""
+    bits = metadata.get("bits_allocated") or 16
+    signed = metadata.get("pixel_representation") == 1
+    if bits <= 8:
+        return np.dtype(np.int8 if signed else np.uint8)
+    if bits <= 16:
+        return np.dtype("<i2" if signed else "<u2")
+    return np.dtype("<i4" if signed else "<u4")
+
+
+def pixel_values(pixel_data: bytes, metadata: Dict[str, Any]) -> np.ndarray:
+    """Decoded frame bytes as a (rows, columns[, samples]) array of pixel values.
+
+    Native frames are kept as stored, for the wire, so bits above Bits
+    Stored (e.g. overlay planes) are masked off and signed values are
+    sign-extended here, before they are displayed or resampled. Colour
+    samples are interleaved: frames that are stored planar are decoded by
+    pydicom, which interleaves them.
+    """
+    dtype = pixel_dtype(metadata)
+    pixels = np.frombuffer(pixel_data, dtype=dtype)
+    width = dtype.itemsize * 8
+    unused = width - min(metadata.get("bits_stored") or width, width)
+    if unused:
+        if dtype.kind == "i":
+            pixels = (pixels << unused) >> unused  # the arithmetic shift back sign-extends
+        else:
+            pixels = pixels & dtype.type((1 << (width - unused)) - 1)
+    samples = metadata.get("samples_per_pixel") or 1
+    shape = (metadata["rows"], metadata["columns"], samples) if samples > 1 else (metadata["rows"], metadata["columns"])
+    return pixels.reshape(shape)
+
+
+def window_voi(
+    values: np.ndarray,
+    window_center: Optional[float],
+    window_width: Optional[float],
+    invert: bool = False,
+    function: str = "LINEAR",
+) -> np.ndarray:
+    """VOI LUT function of PS3.3 C.11.2.1.2-3 (LINEAR, LINEAR_EXACT or SIGMOID),
+    from modality values to 8-bit display values.
+
+    Without a usable window the full value range is shown linearly.
+    """
+    if window_center is None or window_width is None or window_width < 1:
+        low, high = float(np.nanmin(values)), float(np.nanmax(values))
+        window_center = (low + high) / 2
+        window_width = max(high - low, 1)
+        function = "LINEAR"
+
+    if function == "SIGMOID":
+        with np.errstate(over="ignore"):
+            display = (255.0 / (1 + np.exp(-4 * (values - window_center) / window_width))).astype(np.uint8)
+    elif function == "LINEAR_EXACT":
+        display = np.clip(((values - window_center) / window_width + 0.5) * 255.0, 0, 255).astype(np.uint8)
+    else:
+        c = window_center - 0.5
+        w = window_width - 1
+        display = np.clip(((values - c) / max(w, 1) + 0.5) * 255.0, 0, 255).astype(np.uint8)
+    return 255 - display if invert else display
+
+
+def voi_lut(
+    metadata: Dict[str, Any],
+    low: int,
+    high: int,
+    window_center: Optional[float],
+    window_width: Optional[float],
+    function: str = "LINEAR",
+) -> np.ndarray:
+    """Build a stored value -> 8-bit display LUT covering ``low..high``.
+
+    Applies Modality LUT (rescale slope/intercept) and the VOI LUT
+    function in one vectorized pass over the value range.
+    """
+    stored = np.arange(low, high + 1, dtype=np.float64)
+    values = stored * (metadata.get("rescale_slope") or 1) + (metadata.get("rescale_intercept") or 0)
+    invert = metadata.get("photometric_interpretation") == "MONOCHROME1"
+    return window_voi(values, window_center, window_width, invert, function)
+
+
+def apply_voi(
+    pixels: np.ndarray,
+    metadata: Dict[str, Any],
+    window_center: Optional[float],
+    window_width: Optional[float],
+    function: str = "LINEAR",
+) -> np.ndarray:
+    """Map a 2D array of stored values to 8-bit display values.
+
+    Integer pixels go through a LUT over their value range (one lookup per
+    pixel) unless that range is too wide for one; float pixels and such
+    wide ranges are windowed directly.
+    """
+    if np.issubdtype(pixels.dtype, np.integer):
+        low, high = int(pixels.min()), int(pixels.max())
+        if high - low < MAX_LUT_ENTRIES:
+            lut = voi_lut(metadata, low, high, window_center, window_width, function)
+            return np.take(lut, pixels.astype(np.intp) - low)
+        pixels = pixels.astype(np.float64)
+
+    values = pixels * (metadata.get("rescale_slope") or 1) + (metadata.get("rescale_intercept") or 0)
+    invert = metadata.get("photometric_interpretation") == "MONOCHROME1"
+    return window_voi(values, window_center, window_width, invert, function)
+
+
+class RenderService:
+    """Render frames to JPEG/PNG and maintain a disk cache of thumbnails."""
+
+    def __init__(self, thumbnail_root: Path):
+        self.thumbnail_root = thumbnail_root
+        self.parser = DICOMParserService()
+        self._executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="thumbnails")
+        self._pending = set()
+        self._lock = threading.Lock()
+
+    # ---------- Rendering ----------
+
+    def frame_image(
+        self,
+        metadata: Dict[str, Any],
+        frame: int = 1,
+        window_center: Optional[float] = None,
+        window_width: Optional[float] = None,
+        voi_function: str = "LINEAR",
+    ) -> Optional[Image.Image]:
+        """Decode a frame and apply rescale + VOI, returning an 8-bit PIL image."""
+        file_path = instance_store.checked_path(metadata["file_path"], metadata.get("content_hash"))
+        pixel_data = self.parser.get_pixel_data(file_path, frame, metadata["sop_instance_uid"])
+        if pixel_data is None:
+            return None
+
+        pixels = pixel_values(pixel_data, metadata)
+
+        if pixels.ndim == 3:
+            # Colour images are already display values
+            if pixels.dtype != np.uint8:
+                pixels = (pixels >> max(int(metadata.get("bits_stored") or 8) - 8, 0)).astype(np.uint8)
+            return Image.fromarray(pixels[..., :3], "RGB")
+
+        if window_center is None and window_width is None:
+            window_center = metadata.get("window_center")
+            window_width = metadata.get("window_width")
+
+        return Image.fromarray(apply_voi(pixels, metadata, window_center, window_width, voi_function), "L")
+
+    def render(
+        self,
+        metadata: Dict[str, Any],
+        frame: int = 1,
+        media_type: str = "image/jpeg",
+        viewport: Optional[Tuple[int, int]] = None,
+        window_center: Optional[float] = None,
+        window_width: Optional[float] = None,
+        quality: int = 90,
+        voi_function: str = "LINEAR",
+    ) -> Optional[bytes]:
+        """Render a frame to an encoded image, scaled down to fit ``viewport``."""
+        image = self.frame_image(metadata, frame, window_center, window_width, voi_function)
+        if image is None:
+            return None
+        if viewport:
+            image.thumbnail(viewport, Image.Resampling.LANCZOS)
+        return self.encode(image, media_type, quality)
+
+    def render_plane(
+        self,
+        pixels: np.ndarray,
+        metadata: Dict[str, Any],
+        spacing: Tuple[float, float],
+        media_type: str = "image/jpeg",
+        viewport: Optional[Tuple[int, int]] = None,
+        window_center: Optional[float] = None,
+        window_width: Optional[float] = None,
+        quality: int = 90,
+        voi_function: str = "LINEAR",
+    ) -> bytes:
+        """Render a 2D array of modality values (e.g. a reformatted plane) with square display pixels."""
+        if window_center is None and window_width is None:
+            window_center = metadata.get("window_center")
+            window_width = metadata.get("window_width")
+        display = apply_voi(pixels, {"photometric_interpretation": metadata.get("photometric_interpretation")},
+                            window_center, window_width, voi_function)
+        image = Image.fromarray(display, "L")
+
+        column_spacing, row_spacing = spacing
+        if not np.isclose(column_spacing, row_spacing):
+            scale = min(column_spacing, row_spacing)
+            image = image.resize(
+                (max(round(image.width * column_spacing / scale), 1), max(round(image.height * row_spacing / scale), 1)),
+                Image.Resampling.BILINEAR,
+            )
+        if viewport:
+            image.thumbnail(viewport, Image.Resampling.LANCZOS)
+        return self.encode(image, media_type, quality)
+
+    @staticmethod
+    def encode(image: Image.Image, media_type: str, quality: int = 90) -> bytes:
+        buffer = io.BytesIO()
+        with timed_stage("encode"):
+            if RENDERED_MEDIA_TYPES[media_type] == "JPEG":
+                image.save(buffer, "JPEG", quality=quality)
+            else:
+                image.save(buffer, "PNG", optimize=False)
+        return buffer.getvalue()
+
+    # ---------- Thumbnails ----------
+
+    def representative_instance(self, study_uid: str, series_uid: str) -> Optional[Dict[str, Any]]:
+        """The middle instance of a series, the usual choice for a series preview."""
+        instances = metadata_index.list_instances(study_uid, series_uid)
+        if not instances:
+            return None
+        return instances[len(instances) // 2]
+
+    def study_representative_instance(self, study_uid: str) -> Optional[Dict[str, Any]]:
+        """The representative instance of the study's first series with pixel data."""
+        for series in metadata_index.list_series(study_uid):
+            metadata = self.representative_instance(study_uid, series["series_instance_uid"])
+            if metadata is not None and metadata.get("rows"):
+                return metadata
+        return None
+
+    def _thumbnail_path(self, study_uid: str, series_uid: str, sop_uid: Optional[str] = None) -> Path:
+        if sop_uid is None:
+            return self.thumbnail_root / study_uid / f"{series_uid}.jpg"
+        return self.thumbnail_root / study_uid / series_uid / f"{sop_uid}.jpg"
+
+    @staticmethod
+    def _is_fresh(path: Path, metadata: Dict[str, Any]) -> bool:
+        """A cached thumbnail is valid while it is newer than the file it was rendered from.
+
+        Thumbnails of studies in the cold tier, whose files are not on hot
+        storage, stay valid so browsing does not restore them.
+        """
+        try:
+            thumbnail_mtime = path.stat().st_mtime_ns
+        except FileNotFoundError:
+            return False
+        try:
+            return thumbnail_mtime >= instance_store.path(metadata["file_path"]).stat().st_mtime_ns
+        except FileNotFoundError:
+            return True
+
+    def _write_thumbnail(self, metadata: Dict[str, Any], path: Path) -> Optional[Path]:
+        if not instance_store.exists(metadata["file_path"]):
+            return None  # in the cold tier: callers restore the study and ask again
+        size = settings.THUMBNAIL_SIZE
+        frame = ((metadata.get("number_of_frames") or 1) + 1) // 2
+        content = self.render(metadata, frame, "image/jpeg", (size, size), quality=80)
+        if content is None:
+            return None
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(f".{path.name}.{threading.get_ident()}.tmp")
+        tmp_path.write_bytes(content)
+        os.replace(tmp_path, path)
+        return path
+
+    def instance_thumbnail(self, metadata: Dict[str, Any]) -> Optional[Path]:
+        path = self._thumbnail_path(
+            metadata["study_instance_uid"], metadata["series_instance_uid"], metadata["sop_instance_uid"]
+        )
+        if self._is_fresh(path, metadata):
+            return path
+        return self._write_thumbnail(metadata, path)
+
+    def series_thumbnail(self, study_uid: str, series_uid: str, rebuild: bool = False) -> Optional[Path]:
+        path = self._thumbnail_path(study_uid, series_uid)
+        metadata = self.representative_instance(study_uid, series_uid)
+        if metadata is None:
+            return None
+        if not rebuild and self._is_fresh(path, metadata):
+            return path
+        return self._write_thumbnail(metadata, path)
+
+    def study_thumbnail(self, study_uid: str) -> Optional[Path]:
+        for series in metadata_index.list_series(study_uid):
+            path = self.series_thumbnail(study_uid, series["series_instance_uid"])
+            if path is not None:
+                return path
+        return None
+
+    def schedule_series_thumbnails(self, series_keys) -> None:
+        """Regenerate series thumbnails in the background after ingest."""
+        for study_uid, series_uid in set(series_keys):
+            with self._lock:
+                if (study_uid, series_uid) in self._pending:
+                    continue
+                self._pending.add((study_uid, series_uid))
+            self._executor.submit(self._background_thumbnail, study_uid, series_uid)
+
+    def _background_thumbnail(self, study_uid: str, series_uid: str) -> None:
+        with self._lock:
+            self._pending.discard((study_uid, series_uid))
+        try:
+            self.series_thumbnail(study_uid, series_uid, rebuild=True)
+        except Exception:
+            pass  # previews are best effort; the endpoint renders on demand
+
+    def remove_study(self, study_uid: str) -> None:
+        shutil.rmtree(self.thumbnail_root / study_uid, ignore_errors=True)
+
+
+render_service = RenderService(settings.STORAGE_PATH / ".thumbnails")
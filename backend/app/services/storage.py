@@ -0,0 +1,283 @@
+"""Instance storage backends: content-addressed (sharded) and hierarchical layouts"""
+
+import abc
+import argparse
+import hashlib
+import os
+import re
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from app.config import settings
+
+
+OBJECTS_DIR = ".objects"
+HASH_CHUNK_SIZE = 1024 * 1024
+
+# UIDs are digits and dots (PS3.5 9.1); anything else must never reach a path under the store
+UID_PATTERN = re.compile(r"[0-9]+(\.[0-9]+)*")
+
+# Stat signatures of files whose checksum has been verified, per store
+MAX_VERIFIED = 100_000
+
+
+class StorageError(Exception):
+    """A stored object is missing or cannot be written."""
+
+
+class IntegrityError(StorageError):
+    """A stored object no longer matches its checksum."""
+
+
+def is_valid_uid(uid: str) -> bool:
+    """Whether ``uid`` is a well-formed UID, safe to use as a path component."""
+    return len(uid) <= 64 and UID_PATTERN.fullmatch(uid) is not None
+
+
+def file_digest(path: Path) -> str:
+    """SHA-256 of a file, read in large chunks."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class InstanceStore(abc.ABC):
+    """Where instance files live under the storage root.
+
+    The metadata index keeps each instance's path relative to ``root``, so
+    readers only ever go through ``path()``; backends differ in where
+    ``put()`` places new files. Stores hold no locks or open handles and
+    can be sent to worker processes.
+    """
+
+    layout = ""
+    trees: Tuple[str, ...] = (".",)  # directories holding files, relative to root
+    tree_depth = 2  # files sit this many directories below each tree
+
+    def __init__(self, root: Path):
+        self.root = root
+        self._verified: Dict[str, Tuple[int, int]] = {}
+
+    def __getstate__(self):
+        return {"root": self.root}
+
+    def __setstate__(self, state):
+        self.__init__(state["root"])
+
+    def path(self, relative_path: str) -> Path:
+        return self.root / relative_path
+
+    def exists(self, relative_path: str) -> bool:
+        return self.path(relative_path).exists()
+
+    def checked_path(self, relative_path: str, digest: Optional[str] = None) -> Path:
+        """Absolute path of a stored file about to be read, verified first when VERIFY_CHECKSUMS is on."""
+        if settings.VERIFY_CHECKSUMS:
+            self.verify(relative_path, digest)
+        return self.path(relative_path)
+
+    @abc.abstractmethod
+    def put(self, staged_path: Path, metadata: Dict, digest: Optional[str] = None) -> Tuple[Path, str]:
+        """Move a staged file into the store; returns its relative path and SHA-256."""
+
+    def remove(self, relative_paths: Iterable[str]) -> None:
+        for relative_path in relative_paths:
+            self.path(relative_path).unlink(missing_ok=True)
+
+    @abc.abstractmethod
+    def iter_files(self) -> Iterator[Tuple[Path, Optional[str]]]:
+        """Relative paths of stored files, with their SHA-256 when the layout records it."""
+
+    def verify(self, relative_path: str, digest: Optional[str]) -> None:
+        """Re-hash a stored file against its checksum, once per file version.
+
+        Raises IntegrityError on a mismatch and FileNotFoundError if the
+        file is gone. Files without a recorded checksum pass.
+        """
+        digest = digest or self.recorded_digest(relative_path)
+        path = self.path(relative_path)
+        stat = os.stat(path)
+        signature = (stat.st_mtime_ns, stat.st_size)
+        if digest is None or self._verified.get(str(path)) == signature:
+            return
+        if file_digest(path) != digest:
+            raise IntegrityError(f"Checksum mismatch for {relative_path}")
+        if len(self._verified) >= MAX_VERIFIED:
+            self._verified.clear()
+        self._verified[str(path)] = signature
+
+    def recorded_digest(self, relative_path: str) -> Optional[str]:
+        return None
+
+
+class HierarchicalStore(InstanceStore):
+    """``<study>/<series>/<sop>.dcm``, the original layout."""
+
+    layout = "hierarchical"
+
+    def put(self, staged_path: Path, metadata: Dict, digest: Optional[str] = None) -> Tuple[Path, str]:
+        uids = (metadata["study_instance_uid"], metadata["series_instance_uid"], metadata["sop_instance_uid"])
+        if not all(is_valid_uid(uid) for uid in uids):
+            # The UIDs become path components: never let one climb out of the store
+            staged_path.unlink(missing_ok=True)
+            raise StorageError("Study, Series or SOP Instance UID is not a valid UID")
+        relative_path = Path(uids[0]) / uids[1] / f"{uids[2]}.dcm"
+        digest = digest or file_digest(staged_path)
+        file_path = self.root / relative_path
+        file_path.parent.mkdir(parents=True, exist_ok=True)
+        os.replace(staged_path, file_path)
+        return relative_path, digest
+
+    def iter_files(self) -> Iterator[Tuple[Path, Optional[str]]]:
+        for file_path in self.root.glob("*/*/*.dcm"):
+            relative_path = file_path.relative_to(self.root)
+            if not relative_path.parts[0].startswith("."):
+                yield relative_path, None
+
+
+class ContentAddressedStore(InstanceStore):
+    """Files named by their SHA-256 in a two-level fan-out: ``.objects/ab/cd/abcd....dcm``.
+
+    Directories stay small (65536 shards) however many instances a series
+    has, identical content is stored once, and a file's name is its
+    checksum. Objects are immutable: new content for a SOP Instance UID is
+    a new object, and the index is what points the UID at it.
+    """
+
+    layout = "content"
+    trees = (OBJECTS_DIR, ".")  # and a <study>/<series>/<sop>.dcm tree not migrated yet
+
+    def object_path(self, digest: str) -> Path:
+        return Path(OBJECTS_DIR) / digest[:2] / digest[2:4] / f"{digest}.dcm"
+
+    def put(self, staged_path: Path, metadata: Dict, digest: Optional[str] = None) -> Tuple[Path, str]:
+        digest = digest or file_digest(staged_path)
+        relative_path = self.object_path(digest)
+        file_path = self.root / relative_path
+        if file_path.exists():
+            staged_path.unlink(missing_ok=True)  # same bytes already stored
+        else:
+            file_path.parent.mkdir(parents=True, exist_ok=True)
+            os.replace(staged_path, file_path)
+        return relative_path, digest
+
+    def iter_files(self) -> Iterator[Tuple[Path, Optional[str]]]:
+        for file_path in (self.root / OBJECTS_DIR).glob("*/*/*.dcm"):
+            yield file_path.relative_to(self.root), file_path.stem
+        # A <study>/<series>/<sop>.dcm tree not migrated yet is still part of the archive
+        yield from HierarchicalStore(self.root).iter_files()
+
+    def recorded_digest(self, relative_path: str) -> Optional[str]:
+        path = Path(relative_path)
+        return path.stem if path.parts[0] == OBJECTS_DIR else None
+
+
+STORE_LAYOUTS = {store.layout: store for store in (ContentAddressedStore, HierarchicalStore)}
+
+
+def create_store(layout: str, root: Path) -> InstanceStore:
+    if layout not in STORE_LAYOUTS:
+        raise ValueError(f"STORAGE_LAYOUT must be one of {', '.join(STORE_LAYOUTS)}")
+    return STORE_LAYOUTS[layout](root)
+
+
+instance_store = create_store(settings.STORAGE_LAYOUT, settings.STORAGE_PATH)
+
+
+# ---------- Migration ----------
+
+def migrate_hierarchical_tree(store: ContentAddressedStore, workers: int = 8, dry_run: bool = False) -> Dict[str, int]:
+    """Move a ``<study>/<series>/<sop>.dcm`` tree into the content-addressed layout.
+
+    Safe to run against a live server: each object is hard-linked into
+    place, the index is repointed in batches, and only then are the old
+    files removed. Files that are not indexed yet are parsed and indexed.
+    """
+    from app.services.dicom_parser import DICOMParserService
+    from app.services.metadata_index import metadata_index
+
+    legacy = list(HierarchicalStore(store.root).iter_files())
+    summary = {"files": len(legacy), "migrated": 0, "duplicates": 0, "indexed": 0, "failed": 0, "bytes": 0}
+    if dry_run:
+        summary["bytes"] = sum(store.path(str(p)).stat().st_size for p, _ in legacy)
+        return summary
+
+    parser = DICOMParserService()
+
+    def link(relative_path: Path) -> Tuple[Path, Path, str, bool]:
+        source = store.root / relative_path
+        digest = file_digest(source)
+        object_path = store.object_path(digest)
+        target = store.root / object_path
+        duplicate = target.exists()
+        if not duplicate:
+            target.parent.mkdir(parents=True, exist_ok=True)
+            try:
+                os.link(source, target)
+            except FileExistsError:
+                duplicate = True
+            except OSError:
+                shutil.copy2(source, target)
+        return relative_path, object_path, digest, duplicate
+
+    def flush(batch: List[Tuple[Path, Path, str, bool]]) -> None:
+        moved = metadata_index.relocate_instances([(str(old), str(new), digest) for old, new, digest, _ in batch])
+        for old, new, digest, duplicate in batch:
+            if str(old) not in moved:
+                try:
+                    metadata = parser.parse_file(store.root / new)
+                except Exception:
+                    summary["failed"] += 1
+                    continue
+                metadata["content_hash"] = digest
+                metadata_index.add_instance(metadata, new)
+                summary["indexed"] += 1
+            summary["duplicates" if duplicate else "migrated"] += 1
+            summary["bytes"] += (store.root / new).stat().st_size
+            (store.root / old).unlink(missing_ok=True)
+
+    batch: List[Tuple[Path, Path, str, bool]] = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for result in executor.map(link, [p for p, _ in legacy]):
+            batch.append(result)
+            if len(batch) >= 500:
+                flush(batch)
+                batch = []
+    flush(batch)
+
+    # Drop the emptied <study>/<series> directories
+    for study_dir in store.root.iterdir():
+        if study_dir.is_dir() and not study_dir.name.startswith("."):
+            for series_dir in study_dir.iterdir():
+                if series_dir.is_dir():
+                    try:
+                        series_dir.rmdir()
+                    except OSError:
+                        pass
+            try:
+                study_dir.rmdir()
+            except OSError:
+                pass
+    return summary
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(prog="python -m app.services.storage", description="Instance storage maintenance")
+    commands = parser.add_subparsers(dest="command", required=True)
+    migrate = commands.add_parser("migrate", help="Move a <study>/<series>/<sop>.dcm tree into the content-addressed layout")
+    migrate.add_argument("--dry-run", action="store_true", help="Only count the files that would be moved")
+    migrate.add_argument("--workers", type=int, default=settings.IO_WORKERS, help="Threads hashing files")
+    args = parser.parse_args(argv)
+
+    if args.command == "migrate":
+        store = ContentAddressedStore(settings.STORAGE_PATH)
+        summary = migrate_hierarchical_tree(store, workers=args.workers, dry_run=args.dry_run)
+        print(", ".join(f"{key}: {value}" for key, value in summary.items()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,310 @@
+"""Embedded C-STORE SCP: modalities push instances straight into the archive"""
+
+import argparse
+import queue
+import shutil
+import threading
+import time
+import uuid
+from collections import deque
+from pathlib import Path
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+from pynetdicom import AE, ALL_TRANSFER_SYNTAXES, AllStoragePresentationContexts, _config, evt
+from pynetdicom.sop_class import Verification
+
+from app.config import settings
+from app.services.ingest import IngestError, StagedFile, find_duplicate, index_stored, store_staged_file
+from app.services.ingest_jobs import ingest_pipeline
+from app.services.metrics import ingest_bytes, ingest_instances, ingest_seconds
+from app.services.storage import file_digest, instance_store
+
+# C-STORE response statuses (PS3.4 B.2.3)
+STATUS_SUCCESS = 0x0000
+STATUS_OUT_OF_RESOURCES = 0xA700
+STATUS_CANNOT_UNDERSTAND = 0xC000
+
+MAX_HISTORY = 100
+
+
+class AssociationStats:
+    """What one association sent and how fast it was stored."""
+
+    def __init__(self, calling_ae: str, address: str, port: int):
+        self.id = uuid.uuid4().hex[:12]
+        self.calling_ae = calling_ae
+        self.address = address
+        self.port = port
+        self.status = "active"
+        self.started_at = time.time()
+        self.finished_at: Optional[float] = None
+        self.stored = 0
+        self.duplicates = 0
+        self.failed = 0
+        self.bytes = 0
+        self.study_uids: set = set()
+        self._lock = threading.Lock()
+
+    def record(self, outcome: str, size: int, study_uid: Optional[str] = None) -> None:
+        with self._lock:
+            if outcome == "stored":
+                self.stored += 1
+            elif outcome == "duplicate":
+                self.duplicates += 1
+            else:
+                self.failed += 1
+            self.bytes += size
+            if study_uid:
+                self.study_uids.add(study_uid)
+
+    def finish(self, status: str) -> None:
+        self.status = status
+        self.finished_at = time.time()
+
+    @property
+    def instances(self) -> int:
+        return self.stored + self.duplicates + self.failed
+
+    def to_dict(self) -> Dict[str, Any]:
+        elapsed = (self.finished_at or time.time()) - self.started_at
+        return {
+            "id": self.id,
+            "calling_ae": self.calling_ae,
+            "address": self.address,
+            "port": self.port,
+            "status": self.status,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "instances": self.instances,
+            "stored": self.stored,
+            "duplicates": self.duplicates,
+            "failed": self.failed,
+            "bytes": self.bytes,
+            "instances_per_second": round(self.instances / elapsed, 2) if elapsed > 0 else None,
+            "mb_per_second": round(self.bytes / elapsed / 1e6, 2) if elapsed > 0 else None,
+            "study_uids": sorted(self.study_uids),
+        }
+
+
+def _new_stats(assoc) -> AssociationStats:
+    # The sending peer: the requestor on our SCP, the acceptor when we asked it for a C-GET
+    peer = assoc.acceptor if assoc.is_requestor else assoc.requestor
+    return AssociationStats(peer.ae_title, peer.address, peer.port)
+
+
+class StorageSCP:
+    """A pynetdicom Storage SCP feeding the same store and index as the upload API.
+
+    Each association runs on its own thread. Datasets are received straight
+    to a temporary file (never decoded in memory), moved into staging and
+    checked against the index by checksum. Headers are parsed on the ingest
+    worker processes, so concurrent associations scale with cores. A C-STORE
+    is answered once its file is in the store; index updates are queued and
+    written by one thread in transactions of up to ``INGEST_BATCH_SIZE``
+    instances, at most ``SCP_FLUSH_INTERVAL`` seconds after arrival.
+    """
+
+    def __init__(self, ae_title: str, host: str, port: int, max_associations: int, batch_size: int, flush_interval: float):
+        self.ae_title = ae_title
+        self.host = host
+        self.port = port
+        self.max_associations = max_associations
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.staging_dir = settings.STORAGE_PATH / ".staging"
+        self.index_errors = 0
+        self._server = None
+        self._writer: Optional[threading.Thread] = None
+        self._queue: "queue.Queue[Optional[Tuple[Dict[str, Any], Path, str]]]" = queue.Queue()
+        self._active: Dict[int, AssociationStats] = {}
+        self._history: Deque[AssociationStats] = deque(maxlen=MAX_HISTORY)
+        self._lock = threading.Lock()
+
+    @property
+    def running(self) -> bool:
+        return self._server is not None
+
+    @property
+    def address(self) -> Tuple[str, int]:
+        """Listening address; the bound port when started on port 0."""
+        return self._server.server_address if self._server is not None else (self.host, self.port)
+
+    def start(self) -> None:
+        if self._server is not None:
+            return
+        self.prepare()
+
+        ae = AE(ae_title=self.ae_title)
+        ae.maximum_associations = self.max_associations
+        ae.maximum_pdu_size = 0  # no limit: fewer, larger PDUs per dataset
+        for context in AllStoragePresentationContexts:
+            ae.add_supported_context(context.abstract_syntax, ALL_TRANSFER_SYNTAXES)
+        ae.add_supported_context(Verification)
+        self._server = ae.start_server((self.host, self.port), block=False, evt_handlers=self.handlers())
+
+    def prepare(self) -> None:
+        """Get ready to receive instances, on this SCP or on associations this process opens (C-GET)."""
+        with self._lock:
+            if self._writer is not None:
+                return
+            # Write received datasets to a file as their PDUs arrive instead of buffering them
+            _config.STORE_RECV_CHUNKED_DATASET = True
+            self.staging_dir.mkdir(parents=True, exist_ok=True)
+            self._writer = threading.Thread(target=self._write_index, name="scp-index", daemon=True)
+            self._writer.start()
+
+    def handlers(self) -> List[tuple]:
+        """Event handlers that store received instances and track the association's throughput."""
+        return [
+            (evt.EVT_C_STORE, self._on_c_store),
+            (evt.EVT_ACCEPTED, self._on_accepted),
+            (evt.EVT_RELEASED, self._on_finished, ["released"]),
+            (evt.EVT_ABORTED, self._on_finished, ["aborted"]),
+        ]
+
+    def shutdown(self) -> None:
+        """Stop accepting associations and write the pending index batch."""
+        if self._server is not None:
+            self._server.shutdown()
+            self._server = None
+        if self._writer is not None:
+            self._queue.put(None)
+            self._writer.join()
+            self._writer = None
+
+    def flush(self) -> None:
+        """Block until everything received so far is in the index."""
+        self._queue.join()
+
+    # ---------- Association events ----------
+
+    def _on_accepted(self, event) -> None:
+        with self._lock:
+            self._active[id(event.assoc)] = _new_stats(event.assoc)
+
+    def _on_finished(self, event, status: str) -> None:
+        with self._lock:
+            stats = self._active.pop(id(event.assoc), None)
+            if stats is None:
+                return
+            stats.finish(status)
+            self._history.append(stats)
+        ingest_seconds.labels("dimse").observe(stats.finished_at - stats.started_at)
+
+    def _stats(self, event) -> AssociationStats:
+        with self._lock:
+            stats = self._active.get(id(event.assoc))
+            if stats is None:  # accepted before the handler was bound
+                stats = self._active[id(event.assoc)] = _new_stats(event.assoc)
+            return stats
+
+    def _on_c_store(self, event) -> int:
+        stats = self._stats(event)
+        staged = StagedFile(str(event.request.AffectedSOPInstanceUID), self.staging_dir / f"{uuid.uuid4().hex}.dcm")
+        try:
+            # A rename when the temporary directory is on the storage volume, a copy otherwise
+            shutil.move(str(event.dataset_path), staged.path)
+            staged.size = staged.path.stat().st_size
+            staged.digest = file_digest(staged.path)
+        except OSError:
+            staged.path.unlink(missing_ok=True)
+            return self._outcome(stats, "failed", 0, STATUS_OUT_OF_RESOURCES)
+
+        duplicate = find_duplicate(staged)
+        if duplicate is not None:
+            staged.path.unlink(missing_ok=True)
+            return self._outcome(stats, "duplicate", staged.size, STATUS_SUCCESS, duplicate["study_instance_uid"])
+
+        try:
+            result = ingest_pipeline.executor.submit(store_staged_file, staged.path, instance_store, staged.digest).result()
+        except IngestError:
+            return self._outcome(stats, "failed", staged.size, STATUS_CANNOT_UNDERSTAND)
+        except Exception:
+            staged.path.unlink(missing_ok=True)
+            return self._outcome(stats, "failed", staged.size, STATUS_OUT_OF_RESOURCES)
+
+        self._queue.put(result)
+        return self._outcome(stats, "stored", staged.size, STATUS_SUCCESS, result[0]["study_instance_uid"])
+
+    def _outcome(self, stats: AssociationStats, outcome: str, size: int, status: int, study_uid: Optional[str] = None) -> int:
+        stats.record(outcome, size, study_uid)
+        ingest_instances.labels("dimse", outcome).inc()
+        ingest_bytes.labels("dimse").inc(size)
+        return status
+
+    # ---------- Index writer ----------
+
+    def _write_index(self) -> None:
+        stopping = False
+        while not stopping:
+            item = self._queue.get()
+            if item is None:
+                self._queue.task_done()
+                break
+            batch: List[Tuple[Dict[str, Any], Path, str]] = [item]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                try:
+                    item = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            try:
+                index_stored(batch)
+            except Exception:
+                # The files are stored; the archive reconciler picks them up
+                self.index_errors += len(batch)
+            for _ in range(len(batch) + stopping):
+                self._queue.task_done()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            active = [stats.to_dict() for stats in self._active.values()]
+            recent = [stats.to_dict() for stats in reversed(self._history)]
+        host, port = self.address
+        return {
+            "running": self.running,
+            "ae_title": self.ae_title,
+            "host": host,
+            "port": port,
+            "pending_index_updates": self._queue.qsize(),
+            "index_errors": self.index_errors,
+            "active": active,
+            "recent": recent,
+        }
+
+
+storage_scp = StorageSCP(
+    settings.LOCAL_AE_TITLE,
+    settings.SCP_HOST,
+    settings.SCP_PORT,
+    settings.SCP_MAX_ASSOCIATIONS,
+    settings.INGEST_BATCH_SIZE,
+    settings.SCP_FLUSH_INTERVAL,
+)
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(prog="python -m app.services.storage_scp", description="Run the Storage SCP without the HTTP API")
+    parser.add_argument("--port", type=int, default=settings.SCP_PORT)
+    args = parser.parse_args(argv)
+
+    storage_scp.port = args.port
+    storage_scp.start()
+    host, port = storage_scp.address
+    print(f"{storage_scp.ae_title} listening on {host}:{port}")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        storage_scp.shutdown()
+        ingest_pipeline.shutdown()
+
+
+if __name__ == "__main__":
+    main()
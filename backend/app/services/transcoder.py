@@ -0,0 +1,162 @@
+"""Transfer syntax negotiation and transcoding of single frames"""
+
+import gzip
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+from pydicom.pixels.encoders import RLELosslessEncoder
+from pydicom.uid import UID, ExplicitVRLittleEndian, ImplicitVRLittleEndian, RLELossless
+
+from app.services.cache import dicom_cache
+from app.services.dicom_parser import DICOMParserService
+from app.services.executor import blocking_executor
+from app.services.frame_scheduler import frame_scheduler
+from app.services.profiling import timed_stage
+
+
+# Single-frame media types of the stored transfer syntaxes (PS3.18 Table 8.7.3-5)
+FRAME_MEDIA_TYPES = {
+    "1.2.840.10008.1.2.1": "application/octet-stream",
+    "1.2.840.10008.1.2": "application/octet-stream",
+    "1.2.840.10008.1.2.5": "image/x-dicom-rle",
+    "1.2.840.10008.1.2.4.50": "image/jpeg",
+    "1.2.840.10008.1.2.4.51": "image/jpeg",
+    "1.2.840.10008.1.2.4.57": "image/jpeg",
+    "1.2.840.10008.1.2.4.70": "image/jpeg",
+    "1.2.840.10008.1.2.4.80": "image/jls",
+    "1.2.840.10008.1.2.4.81": "image/jls",
+    "1.2.840.10008.1.2.4.90": "image/jp2",
+    "1.2.840.10008.1.2.4.91": "image/jp2",
+    "1.2.840.10008.1.2.4.201": "image/jphc",
+    "1.2.840.10008.1.2.4.202": "image/jphc",
+    "1.2.840.10008.1.2.4.203": "image/jphc",
+}
+
+# Syntaxes frames can be produced in from decoded pixels
+UNCOMPRESSED_SYNTAXES = (ExplicitVRLittleEndian, ImplicitVRLittleEndian)
+TRANSCODE_SYNTAXES = UNCOMPRESSED_SYNTAXES + (RLELossless,)
+
+
+def frame_content_type(transfer_syntax: str) -> str:
+    media_type = FRAME_MEDIA_TYPES.get(transfer_syntax, "application/octet-stream")
+    return f"{media_type}; transfer-syntax={transfer_syntax}"
+
+
+def encode_rle_frame(pixel_data: bytes, metadata: Dict[str, Any]) -> bytes:
+    """RLE Lossless encode one decoded frame (picklable, runs on the decode pool)."""
+    samples = metadata.get("samples_per_pixel") or 1
+    photometric = metadata.get("photometric_interpretation") or "MONOCHROME2"
+    if samples > 1:
+        photometric = "RGB"  # decoded colour frames are RGB whatever the stored interpretation
+    return RLELosslessEncoder.encode(
+        pixel_data,
+        rows=metadata["rows"],
+        columns=metadata["columns"],
+        samples_per_pixel=samples,
+        bits_allocated=metadata["bits_allocated"],
+        bits_stored=metadata.get("bits_stored") or metadata["bits_allocated"],
+        pixel_representation=metadata.get("pixel_representation") or 0,
+        photometric_interpretation=photometric,
+        number_of_frames=1,
+        planar_configuration=0,
+    )
+
+
+class FrameTranscoder:
+    """Pick the transfer syntax a frame is sent in and produce it.
+
+    Compressed frames are passed through untouched when the client accepts
+    the stored syntax. Otherwise frames are decoded and sent uncompressed,
+    or re-encoded as RLE Lossless when that is what the client asks for.
+    Encoded frames are cached, so each is encoded only once.
+    """
+
+    def __init__(self):
+        self.parser = DICOMParserService()
+
+    def negotiate(
+        self,
+        ranges: List[Tuple[str, Dict[str, str]]],
+        stored_syntax: str,
+        part_type: str = "application/octet-stream",
+    ) -> Optional[str]:
+        """Return the transfer syntax to send frames in, given parsed Accept ranges.
+
+        None means nothing acceptable can be produced.
+        """
+        if not ranges:
+            return ExplicitVRLittleEndian
+
+        def quality(media_range) -> float:
+            try:
+                return float(media_range[1].get("q", 1))
+            except ValueError:
+                return 0.0
+
+        for media_type, params in sorted(ranges, key=quality, reverse=True):
+            if quality((media_type, params)) <= 0:
+                continue
+            if media_type == "multipart/related":
+                media_type = params.get("type", part_type).lower()
+
+            transfer_syntax = params.get("transfer-syntax")
+            if transfer_syntax == "*":
+                return stored_syntax
+            if media_type in ("*/*", "application/*"):
+                if transfer_syntax in TRANSCODE_SYNTAXES + (stored_syntax,):
+                    return transfer_syntax
+                return ExplicitVRLittleEndian
+            if transfer_syntax is None:
+                if media_type == "application/octet-stream":
+                    return ExplicitVRLittleEndian
+                if media_type == "image/x-dicom-rle":
+                    return RLELossless
+                if FRAME_MEDIA_TYPES.get(stored_syntax) == media_type:
+                    return stored_syntax
+                continue
+            if transfer_syntax == stored_syntax or transfer_syntax in TRANSCODE_SYNTAXES:
+                if FRAME_MEDIA_TYPES.get(transfer_syntax, "application/octet-stream") == media_type:
+                    return transfer_syntax
+        return None
+
+    async def get_frame(
+        self, file_path: Path, sop_uid: str, frame: int, stored_syntax: str, target_syntax: str, priority: float = 0.0
+    ) -> Optional[Tuple[bytes, str]]:
+        """Return a frame's bytes and the transfer syntax they are in.
+
+        Decoding waits for the frame scheduler at ``priority`` (lower first).
+        """
+        if target_syntax == stored_syntax and UID(stored_syntax).is_compressed:
+            raw = await blocking_executor.run_io(self.parser.get_raw_frame, file_path, frame)
+            if raw is not None:
+                return raw, stored_syntax
+
+        if target_syntax == RLELossless:
+            encoded = dicom_cache.get_transcoded(sop_uid, frame, RLELossless)
+            if encoded is None:
+                pixel_data = await frame_scheduler.get_pixel_data(file_path, sop_uid, frame, priority)
+                if pixel_data is None:
+                    return None
+                metadata = await blocking_executor.run_io(self.parser.parse_file, file_path, sop_uid)
+                with timed_stage("encode"):
+                    encoded = await blocking_executor.run_cpu(encode_rle_frame, pixel_data, metadata)
+                dicom_cache.put_transcoded(sop_uid, frame, RLELossless, encoded)
+            return encoded, RLELossless
+
+        pixel_data = await frame_scheduler.get_pixel_data(file_path, sop_uid, frame, priority)
+        if pixel_data is None:
+            return None
+        return pixel_data, target_syntax if target_syntax in UNCOMPRESSED_SYNTAXES else ExplicitVRLittleEndian
+
+    async def gzip_frame(self, sop_uid: str, frame: int, transfer_syntax: str, data: bytes) -> bytes:
+        """gzip Content-Encoding of an uncompressed frame, cached alongside other encodings."""
+        key = f"{transfer_syntax}+gzip"
+        encoded = dicom_cache.get_transcoded(sop_uid, frame, key)
+        if encoded is None:
+            with timed_stage("encode"):
+                encoded = await blocking_executor.run_io(gzip.compress, data, 6)
+            dicom_cache.put_transcoded(sop_uid, frame, key, encoded)
+        return encoded
+
+
+frame_transcoder = FrameTranscoder()
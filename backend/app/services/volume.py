@@ -0,0 +1,217 @@
+"""Sorted, rescaled 3D series volumes cached as memory-mapped files"""
+
+import json
+import os
+import shutil
+import struct
+import threading
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+from pydicom.uid import UID
+
+from app.config import settings
+from app.services.executor import blocking_executor
+from app.services.frame_access import decode_frame, frame_accessor
+from app.services.metadata_index import metadata_index
+from app.services.renderer import pixel_values
+from app.services.storage import instance_store
+
+
+# Voxel data starts on this boundary so clients can view it as a typed array in place
+DATA_ALIGNMENT = 16
+LOCK_STRIPES = 256
+
+
+def encode_header(header: Dict[str, Any]) -> bytes:
+    """Length-prefixed JSON header, padded so the data after it is aligned.
+
+    Sets ``header["data_offset"]`` to the length of the returned prefix.
+    """
+    # The header records where the data starts, which depends on the header's own length
+    header["data_offset"] = 0
+    while True:
+        header_bytes = json.dumps(header).encode()
+        data_offset = -(-(4 + len(header_bytes)) // DATA_ALIGNMENT) * DATA_ALIGNMENT
+        if header["data_offset"] == data_offset:
+            break
+        header["data_offset"] = data_offset
+    header_bytes = header_bytes.ljust(data_offset - 4)
+    return struct.pack("<I", len(header_bytes)) + header_bytes
+
+
+class VolumeError(Exception):
+    """A series cannot be assembled into a regular volume."""
+
+
+class Volume:
+    """A cached volume file: a uint32 header length, the JSON header, then voxels."""
+
+    def __init__(self, path: Path, header: Dict[str, Any]):
+        self.path = path
+        self.header = header
+
+    @classmethod
+    def load(cls, path: Path) -> "Volume":
+        with open(path, "rb") as f:
+            (length,) = struct.unpack("<I", f.read(4))
+            header = json.loads(f.read(length))
+        return cls(path, header)
+
+    @property
+    def shape(self) -> Tuple[int, int, int]:
+        columns, rows, slices = self.header["dimensions"]
+        return slices, rows, columns
+
+    def array(self) -> np.memmap:
+        """Read-only (slices, rows, columns) view of the voxels, shared through the page cache."""
+        return np.memmap(
+            self.path, dtype=np.dtype(self.header["dtype"]).newbyteorder("<"), mode="r",
+            offset=self.header["data_offset"], shape=self.shape,
+        )
+
+
+class VolumeService:
+    """Assemble series into volumes once and serve them from disk afterwards.
+
+    Slices are ordered by their distance along the normal of the image
+    plane, rescaled to modality values and written to a single file that
+    later requests memory-map (or send as is) without decoding anything.
+    """
+
+    def __init__(self, root: Path):
+        self.root = root
+        self._series_locks = [threading.Lock() for _ in range(LOCK_STRIPES)]  # one build per series at a time
+
+    def _volume_path(self, study_uid: str, series_uid: str) -> Path:
+        return self.root / study_uid / f"{series_uid}.vol"
+
+    def _series_lock(self, study_uid: str, series_uid: str) -> threading.Lock:
+        return self._series_locks[hash((study_uid, series_uid)) % LOCK_STRIPES]
+
+    def get_volume(self, study_uid: str, series_uid: str) -> Optional[Volume]:
+        """Return the cached volume of a series, building it if needed."""
+        series = metadata_index.get_series(series_uid)
+        if series is None or series["study_instance_uid"] != study_uid:
+            return None
+
+        path = self._volume_path(study_uid, series_uid)
+        with self._series_lock(study_uid, series_uid):
+            if path.exists():
+                volume = Volume.load(path)
+                if volume.header["instance_count"] == series["instance_count"]:
+                    return volume
+            return self._build(study_uid, series_uid, path)
+
+    def invalidate_series(self, series_keys: Iterable[Tuple[str, str]]) -> None:
+        for study_uid, series_uid in set(series_keys):
+            self._volume_path(study_uid, series_uid).unlink(missing_ok=True)
+
+    def remove_study(self, study_uid: str) -> None:
+        shutil.rmtree(self.root / study_uid, ignore_errors=True)
+
+    # ---------- Assembly ----------
+
+    def _build(self, study_uid: str, series_uid: str, path: Path) -> Volume:
+        instances = metadata_index.list_instances(study_uid, series_uid)
+        slices, header = self._geometry(instances)
+
+        slope_intercepts = {(i.get("rescale_slope") or 1, i.get("rescale_intercept") or 0) for i in slices}
+        integral = all(float(s).is_integer() and float(b).is_integer() for s, b in slope_intercepts)
+        dtype = np.dtype("<i2") if integral and self._fits_int16(slices) else np.dtype("<f4")
+        header["dtype"] = dtype.name
+
+        prefix = encode_header(header)
+
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(f".{path.name}.{threading.get_ident()}.tmp")
+        with open(tmp_path, "wb") as f:
+            f.write(prefix)
+
+        columns, rows, count = header["dimensions"]
+        voxels = np.memmap(tmp_path, dtype=dtype, mode="r+", offset=len(prefix), shape=(count, rows, columns))
+        try:
+            for index, pixels in enumerate(self._decode_slices(slices)):
+                metadata = slices[index]
+                if pixels is None:
+                    raise VolumeError(f"Could not decode slice {metadata['sop_instance_uid']}")
+                values = pixel_values(pixels, metadata)
+                slope = metadata.get("rescale_slope") or 1
+                intercept = metadata.get("rescale_intercept") or 0
+                voxels[index] = values * slope + intercept if (slope, intercept) != (1, 0) else values
+            voxels.flush()
+        except BaseException:
+            del voxels
+            tmp_path.unlink(missing_ok=True)
+            raise
+        del voxels
+
+        os.replace(tmp_path, path)
+        return Volume(path, header)
+
+    def _geometry(self, instances: List[Dict[str, Any]]) -> Tuple[List[Dict[str, Any]], Dict[str, Any]]:
+        """Sort slices along the normal and derive the volume's spatial header."""
+        slices = [
+            i for i in instances
+            if i.get("rows") and i.get("image_position_patient") and i.get("image_orientation_patient")
+        ]
+        if len(slices) < 2:
+            raise VolumeError("Series needs at least two positioned slices to form a volume")
+        if any(i.get("number_of_frames", 1) > 1 or (i.get("samples_per_pixel") or 1) > 1 for i in slices):
+            raise VolumeError("Only single-frame grayscale series can be assembled into a volume")
+
+        first = slices[0]
+        orientation = np.array(first["image_orientation_patient"], dtype=np.float64)
+        row_cosine, column_cosine = orientation[:3], orientation[3:]
+        normal = np.cross(row_cosine, column_cosine)
+
+        for i in slices:
+            if (i["rows"], i["columns"]) != (first["rows"], first["columns"]):
+                raise VolumeError("Slices have different dimensions")
+            if not np.allclose(i["image_orientation_patient"], orientation, atol=1e-4):
+                raise VolumeError("Slices have different orientations")
+
+        distances = np.array([np.dot(i["image_position_patient"], normal) for i in slices])
+        order = np.argsort(distances, kind="stable")
+        slices = [slices[k] for k in order]
+        gaps = np.diff(distances[order])
+        if np.any(gaps < 1e-4):
+            raise VolumeError("Series contains slices at the same position")
+        slice_spacing = float(np.median(gaps))
+
+        row_spacing, column_spacing = first.get("pixel_spacing") or (1.0, 1.0)
+        header = {
+            "dimensions": [first["columns"], first["rows"], len(slices)],
+            "spacing": [float(column_spacing), float(row_spacing), slice_spacing],
+            "origin": [float(v) for v in slices[0]["image_position_patient"]],
+            "direction": [float(v) for v in (*row_cosine, *column_cosine, *normal)],
+            "byte_order": "little",
+            "instance_count": len(instances),
+        }
+        return slices, header
+
+    @staticmethod
+    def _fits_int16(slices: List[Dict[str, Any]]) -> bool:
+        low, high = np.iinfo(np.int16).min, np.iinfo(np.int16).max
+        for i in slices:
+            bits = i.get("bits_stored") or i.get("bits_allocated") or 16
+            signed = i.get("pixel_representation") == 1
+            stored_min, stored_max = (-(1 << (bits - 1)), (1 << (bits - 1)) - 1) if signed else (0, (1 << bits) - 1)
+            slope = i.get("rescale_slope") or 1
+            intercept = i.get("rescale_intercept") or 0
+            values = (stored_min * slope + intercept, stored_max * slope + intercept)
+            if min(values) < low or max(values) > high:
+                return False
+        return True
+
+    @staticmethod
+    def _decode_slices(slices: List[Dict[str, Any]]) -> Iterable[bytes]:
+        """Decoded pixels per slice, in order, without filling the frame cache."""
+        paths = [instance_store.checked_path(i["file_path"], i.get("content_hash")) for i in slices]
+        if any(UID(i.get("transfer_syntax_uid") or "").is_compressed for i in slices):
+            return blocking_executor.cpu_pool.map(decode_frame, paths, [1] * len(paths), chunksize=8)
+        return (frame_accessor.read_decoded_frame(path, 1) for path in paths)
+
+
+volume_service = VolumeService(settings.STORAGE_PATH / ".volumes")
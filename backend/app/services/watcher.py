@@ -0,0 +1,109 @@
+"""Directory change notifications from Linux inotify, through ctypes"""
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import sys
+from pathlib import Path
+from typing import Dict, Set, Tuple
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+
+# Entries appearing, disappearing or finishing being written; not every write() of a copy
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+
+EVENT_HEADER = struct.Struct("iIII")  # wd, mask, cookie, len (struct inotify_event)
+READ_SIZE = 64 * 1024
+
+
+class DirectoryWatcher:
+    """Report which watched directories had entries added, removed or rewritten.
+
+    Watches are per directory (inotify is not recursive); each carries a key
+    chosen by the caller. Raises OSError where inotify is not available, or
+    from ``watch()`` once the per-user watch limit is reached (ENOSPC), so
+    callers can fall back to polling.
+    """
+
+    def __init__(self):
+        if not sys.platform.startswith("linux"):
+            raise OSError(errno.ENOSYS, "inotify is only available on Linux")
+        self._libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self._fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            raise self._error("inotify_init1")
+        self._keys: Dict[int, str] = {}
+        self._watched: Dict[str, int] = {}
+
+    def _error(self, call: str) -> OSError:
+        code = ctypes.get_errno()
+        return OSError(code, f"{call}: {os.strerror(code)}")
+
+    def __len__(self) -> int:
+        return len(self._watched)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._watched
+
+    def watch(self, path: Path, key: str) -> None:
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(path), WATCH_MASK | IN_ONLYDIR)
+        if wd < 0:
+            if ctypes.get_errno() == errno.ENOENT:
+                return  # removed meanwhile
+            raise self._error("inotify_add_watch")
+        self._keys[wd] = key
+        self._watched[key] = wd
+
+    def read(self, timeout: float) -> Tuple[Set[str], bool]:
+        """Wait up to ``timeout`` seconds for events.
+
+        Returns the keys of the directories that changed, and whether the
+        kernel queue overflowed (events were lost: rescan everything).
+        """
+        ready, _, _ = select.select([self._fd], [], [], timeout)
+        if not ready:
+            return set(), False
+        changed: Set[str] = set()
+        overflowed = False
+        while True:
+            try:
+                data = os.read(self._fd, READ_SIZE)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+                offset += EVENT_HEADER.size + length
+                if mask & IN_Q_OVERFLOW:
+                    overflowed = True
+                    continue
+                key = self._keys.get(wd)
+                if key is None:
+                    continue
+                changed.add(key)
+                if mask & IN_IGNORED:  # directory removed, or its watch dropped
+                    del self._keys[wd]
+                    if self._watched.get(key) == wd:
+                        del self._watched[key]
+        return changed, overflowed
+
+    def close(self) -> None:
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+        self._keys.clear()
+        self._watched.clear()
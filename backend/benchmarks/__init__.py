@@ -0,0 +1,4 @@
+"""Reproducible API benchmarks over synthetic DICOM archives.
+
+Run from ``backend/`` with ``python -m benchmarks --help``.
+"""
@@ -0,0 +1,98 @@
+"""Command line entry point: ``python -m benchmarks``"""
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+from benchmarks.generator import SERIES_KINDS, ArchiveSpec
+from benchmarks.scenarios import PROFILE_TOKEN
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(prog="python -m benchmarks", description="Benchmark the API against a synthetic DICOM archive")
+    archive = parser.add_argument_group("synthetic archive")
+    archive.add_argument("--studies", type=int, default=4)
+    archive.add_argument("--series", type=int, default=4, help="series per study")
+    archive.add_argument("--instances", type=int, default=24, help="instances per single-frame series")
+    archive.add_argument("--frames", type=int, default=8, help="frames per multi-frame instance")
+    archive.add_argument("--rows", type=int, default=256)
+    archive.add_argument("--columns", type=int, default=256)
+    archive.add_argument("--kinds", default=",".join(SERIES_KINDS), help="series kinds to cycle through")
+    archive.add_argument("--seed", type=int, default=0)
+
+    run = parser.add_argument_group("run")
+    run.add_argument("--iterations", type=int, default=50, help="measured requests per scenario")
+    run.add_argument("--warmup", type=int, default=3, help="unmeasured requests per scenario")
+    run.add_argument("--concurrency", type=int, default=1)
+    run.add_argument("--upload-batch", type=int, default=16, help="files per upload request")
+    run.add_argument("--scenario", action="append", help="only run scenarios whose name contains this (repeatable)")
+    run.add_argument("--storage", type=Path, help="storage directory (default: a fresh temporary directory)")
+
+    output = parser.add_argument_group("output")
+    output.add_argument("--output", type=Path, help="write the report as JSON")
+    output.add_argument("--baseline", type=Path, help="compare against a stored report")
+    output.add_argument("--save-baseline", action="store_true", help="write the report to --baseline")
+    output.add_argument("--threshold", type=float, default=0.2, help="allowed regression as a fraction (0.2 = 20%%)")
+    output.add_argument("--min-delta-ms", type=float, default=1.0, help="ignore latency changes smaller than this")
+    return parser.parse_args(argv)
+
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+
+    # Settings are read at import time, so point the app at its storage before importing it
+    storage = args.storage or Path(tempfile.mkdtemp(prefix="dicom-bench-"))
+    os.environ["STORAGE_PATH"] = str(storage)
+    os.environ.pop("INDEX_PATH", None)
+    os.environ["PROFILING_TOKEN"] = PROFILE_TOKEN
+
+    from app.main import app
+    from benchmarks.runner import BenchmarkRunner, compare, format_table
+
+    spec = ArchiveSpec(
+        studies=args.studies,
+        series_per_study=args.series,
+        instances_per_series=args.instances,
+        frames=args.frames,
+        rows=args.rows,
+        columns=args.columns,
+        kinds=[kind for kind in args.kinds.split(",") if kind],
+        seed=args.seed,
+    )
+    runner = BenchmarkRunner(
+        app, spec, iterations=args.iterations, concurrency=args.concurrency,
+        warmup=args.warmup, upload_batch=args.upload_batch, log=lambda line: print(line, file=sys.stderr),
+    )
+    report = asyncio.run(runner.run(args.scenario))
+
+    print(format_table(report))
+    print(f"\npeak RSS: {report['peak_rss_mb']} MB, storage: {storage}")
+    if report["uncovered_routes"]:
+        print("routes without a scenario: " + ", ".join(report["uncovered_routes"]))
+
+    if args.output:
+        args.output.write_text(json.dumps(report, indent=2))
+
+    if args.baseline and args.save_baseline:
+        args.baseline.write_text(json.dumps(report, indent=2))
+        print(f"baseline written to {args.baseline}")
+    elif args.baseline:
+        baseline = json.loads(args.baseline.read_text())
+        if baseline.get("spec") != report["spec"] or baseline.get("settings") != report["settings"]:
+            print("warning: baseline was recorded with a different archive or run settings")
+        regressions = compare(report, baseline, args.threshold, args.min_delta_ms)
+        if regressions:
+            print(f"\n{len(regressions)} regression(s) beyond {args.threshold:.0%}:")
+            for regression in regressions:
+                print(f"  {regression}")
+            return 1
+        print(f"\nno regressions beyond {args.threshold:.0%} against {args.baseline}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,154 @@
+"""Push a synthetic archive to the Storage SCP over concurrent associations: ``python -m benchmarks.dimse``
+
+Without ``--host`` the SCP is started in-process on a free port against a
+fresh storage directory, and the run checks that every instance reached the
+index. With ``--host``/``--port`` it sends to an SCP that is already running.
+"""
+
+import argparse
+import io
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+from pydicom import dcmread
+from pydicom.uid import CTImageStorage, ExplicitVRLittleEndian, RLELossless
+from pynetdicom import AE
+
+from benchmarks.generator import SERIES_KINDS, ArchiveSpec, generate
+
+
+def send(host: str, port: int, called_ae: str, files: List[Tuple[str, bytes]]) -> Dict[str, Any]:
+    """Send files over one association; returns the SCU-side counts and timing."""
+    datasets = [dcmread(io.BytesIO(content)) for _, content in files]
+    ae = AE(ae_title="BENCH_SCU")
+    ae.maximum_pdu_size = 0
+    for transfer_syntax in (ExplicitVRLittleEndian, RLELossless):
+        ae.add_requested_context(CTImageStorage, transfer_syntax)
+
+    result = {"instances": len(datasets), "bytes": sum(len(content) for _, content in files), "failed": 0}
+    started = time.perf_counter()
+    assoc = ae.associate(host, port, ae_title=called_ae)
+    if not assoc.is_established:
+        result.update(failed=len(datasets), seconds=0.0, error="association rejected or aborted")
+        return result
+    for ds in datasets:
+        status = assoc.send_c_store(ds)
+        if not status or status.Status != 0x0000:
+            result["failed"] += 1
+    assoc.release()
+    result["seconds"] = time.perf_counter() - started
+    return result
+
+
+def run(host: str, port: int, called_ae: str, spec: ArchiveSpec, associations: int) -> Dict[str, Any]:
+    manifest, files = generate(spec)
+    files = list(files)
+    # Round-robin, so concurrent associations write into the same studies as a real modality fleet might
+    shares = [files[i::associations] for i in range(associations)]
+    results: List[Optional[Dict[str, Any]]] = [None] * associations
+
+    def worker(i: int) -> None:
+        results[i] = send(host, port, called_ae, shares[i])
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(associations)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    instances = sum(result["instances"] for result in results)
+    total_bytes = sum(result["bytes"] for result in results)
+    return {
+        "spec": spec.to_dict(),
+        "associations": associations,
+        "instances": instances,
+        "failed": sum(result["failed"] for result in results),
+        "seconds": round(elapsed, 3),
+        "instances_per_second": round(instances / elapsed, 2),
+        "mb_per_second": round(total_bytes / elapsed / 1e6, 2),
+        "per_association": [
+            {
+                "instances": result["instances"],
+                "failed": result["failed"],
+                "seconds": round(result["seconds"], 3),
+                "instances_per_second": round(result["instances"] / result["seconds"], 2) if result["seconds"] else None,
+            }
+            for result in results
+        ],
+        "study_uids": manifest.study_uids,
+    }
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.dimse", description="Send a synthetic archive to the Storage SCP")
+    parser.add_argument("--host", help="SCP to send to (default: start one in-process)")
+    parser.add_argument("--port", type=int, default=11112)
+    parser.add_argument("--called-ae", default=None, help="called AE title (default: LOCAL_AE_TITLE)")
+    parser.add_argument("--associations", type=int, default=4, help="concurrent associations")
+    parser.add_argument("--studies", type=int, default=2)
+    parser.add_argument("--series", type=int, default=2, help="series per study")
+    parser.add_argument("--instances", type=int, default=50, help="instances per single-frame series")
+    parser.add_argument("--rows", type=int, default=256)
+    parser.add_argument("--columns", type=int, default=256)
+    parser.add_argument("--kinds", default=",".join(SERIES_KINDS[:2]), help="series kinds to cycle through")
+    parser.add_argument("--storage", type=Path, help="storage directory of the in-process SCP (default: temporary)")
+    parser.add_argument("--output", type=Path, help="write the report as JSON")
+    args = parser.parse_args(argv)
+
+    spec = ArchiveSpec(
+        studies=args.studies,
+        series_per_study=args.series,
+        instances_per_series=args.instances,
+        rows=args.rows,
+        columns=args.columns,
+        kinds=[kind for kind in args.kinds.split(",") if kind],
+    )
+
+    if args.host:
+        report = run(args.host, args.port, args.called_ae or "ANY-SCP", spec, args.associations)
+    else:
+        # Settings are read at import time, so point the app at its storage before importing it
+        storage = args.storage or Path(tempfile.mkdtemp(prefix="dicom-scp-bench-"))
+        os.environ["STORAGE_PATH"] = str(storage)
+        os.environ.pop("INDEX_PATH", None)
+
+        from app.services.ingest_jobs import ingest_pipeline
+        from app.services.metadata_index import metadata_index
+        from app.services.storage_scp import storage_scp
+
+        storage_scp.port = 0
+        storage_scp.start()
+        try:
+            host, port = storage_scp.address
+            report = run("127.0.0.1", port, args.called_ae or storage_scp.ae_title, spec, args.associations)
+            storage_scp.flush()
+            report["indexed"] = sum(len(metadata_index.list_sop_uids(uid)) for uid in report["study_uids"])
+            report["server"] = storage_scp.stats()["recent"]
+        finally:
+            storage_scp.shutdown()
+            ingest_pipeline.shutdown()
+
+    print(
+        f"{report['instances']} instances over {report['associations']} associations in {report['seconds']} s: "
+        f"{report['instances_per_second']} instances/s, {report['mb_per_second']} MB/s, {report['failed']} failed"
+    )
+    for i, association in enumerate(report.get("server") or report["per_association"]):
+        print(f"  association {i}: {association['instances']} instances, {association['instances_per_second']} instances/s")
+    if "indexed" in report:
+        print(f"indexed: {report['indexed']}")
+
+    if args.output:
+        args.output.write_text(json.dumps(report, indent=2))
+    return 0 if not report["failed"] and report.get("indexed", report["instances"]) == report["instances"] else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
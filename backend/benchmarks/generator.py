@@ -0,0 +1,175 @@
+"""Deterministic synthetic DICOM archives built with pydicom"""
+
+import io
+from dataclasses import asdict, dataclass, field
+from typing import Any, Dict, Iterator, List, Tuple
+
+import numpy as np
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.uid import CTImageStorage, ExplicitVRLittleEndian, RLELossless, generate_uid
+
+
+# Series kinds, cycled through within each study
+SERIES_KINDS = ("native", "rle", "native-multiframe", "rle-multiframe")
+
+
+@dataclass
+class ArchiveSpec:
+    """Shape of a synthetic archive; the same spec and seed always give the same bytes."""
+
+    studies: int = 4
+    series_per_study: int = 4
+    instances_per_series: int = 24
+    frames: int = 8  # per multi-frame instance
+    rows: int = 256
+    columns: int = 256
+    kinds: List[str] = field(default_factory=lambda: list(SERIES_KINDS))
+    seed: int = 0
+    patients: int = 0  # studies are spread over this many patients (0: one patient per study)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return asdict(self)
+
+    @property
+    def instance_count(self) -> int:
+        multiframe = sum(1 for n in range(self.series_per_study) if self.series_kind(n).endswith("multiframe"))
+        return self.studies * ((self.series_per_study - multiframe) * self.instances_per_series + multiframe)
+
+    def series_kind(self, index: int) -> str:
+        return self.kinds[index % len(self.kinds)]
+
+
+@dataclass
+class SeriesInfo:
+    study_uid: str
+    series_uid: str
+    kind: str
+    sop_uids: List[str]
+    frames: int
+
+
+class Manifest:
+    """UIDs of what was generated, for building request paths."""
+
+    def __init__(self):
+        self.series: List[SeriesInfo] = []
+        self.context: Dict[str, str] = {}  # ids learned while running, e.g. of stored profiles
+
+    @property
+    def study_uids(self) -> List[str]:
+        return list(dict.fromkeys(s.study_uid for s in self.series))
+
+    def of_kind(self, kind: str) -> List[SeriesInfo]:
+        return [s for s in self.series if s.kind == kind]
+
+    def instances(self) -> List[Tuple[SeriesInfo, str]]:
+        return [(s, sop) for s in self.series for sop in s.sop_uids]
+
+
+def _uid(seed: int, *parts: Any) -> str:
+    return generate_uid(entropy_srcs=[str(seed), *map(str, parts)])
+
+
+def _pixels(rng: np.random.Generator, frames: int, rows: int, columns: int, z: float) -> np.ndarray:
+    """A smooth phantom with noise, so compression and windowing behave like real CT."""
+    y, x = np.mgrid[0:rows, 0:columns]
+    radius = np.hypot(y - rows / 2, x - columns / 2) / (min(rows, columns) / 2)
+    base = np.where(radius < 0.9, 1000 + 200 * np.cos(radius * 6 + z / 10), 0)
+    noise = rng.normal(0, 20, size=(frames, rows, columns))
+    return np.clip(base + noise, 0, 4095).astype(np.uint16)
+
+
+def _dataset(spec: ArchiveSpec, study: int, series: int, instance: int, kind: str) -> Tuple[Dataset, np.ndarray]:
+    rng = np.random.default_rng([spec.seed, study, series, instance])
+    multiframe = kind.endswith("multiframe")
+    frames = spec.frames if multiframe else 1
+    z = float(instance) * 2.0
+
+    ds = Dataset()
+    ds.file_meta = FileMetaDataset()
+    ds.file_meta.MediaStorageSOPClassUID = CTImageStorage
+    ds.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+
+    ds.SOPClassUID = CTImageStorage
+    ds.SOPInstanceUID = _uid(spec.seed, "instance", study, series, instance)
+    ds.file_meta.MediaStorageSOPInstanceUID = ds.SOPInstanceUID
+    ds.StudyInstanceUID = _uid(spec.seed, "study", study)
+    ds.SeriesInstanceUID = _uid(spec.seed, "series", study, series)
+
+    patient = study % spec.patients if spec.patients else study
+    ds.PatientName = f"BENCH^PATIENT{patient:04d}"
+    ds.PatientID = f"BENCH{patient:06d}"
+    ds.PatientBirthDate = "19700101"
+    ds.PatientSex = "O"
+    ds.StudyDate = f"2024{1 + study % 12:02d}{1 + study % 28:02d}"
+    ds.StudyTime = "120000"
+    ds.AccessionNumber = f"ACC{study:06d}"
+    ds.StudyDescription = "Synthetic benchmark study"
+    ds.SeriesDescription = kind
+    ds.Modality = "CT"
+    ds.SeriesNumber = series + 1
+    ds.InstanceNumber = instance + 1
+
+    ds.Rows = spec.rows
+    ds.Columns = spec.columns
+    ds.SamplesPerPixel = 1
+    ds.PhotometricInterpretation = "MONOCHROME2"
+    ds.BitsAllocated = 16
+    ds.BitsStored = 12
+    ds.HighBit = 11
+    ds.PixelRepresentation = 0
+    ds.PixelSpacing = [0.7, 0.7]
+    ds.SliceThickness = 2.0
+    ds.ImagePositionPatient = [0.0, 0.0, z]
+    ds.ImageOrientationPatient = [1, 0, 0, 0, 1, 0]
+    ds.RescaleIntercept = -1024
+    ds.RescaleSlope = 1
+    ds.WindowCenter = 40
+    ds.WindowWidth = 400
+
+    # A binary element above BULKDATA_THRESHOLD, served through the bulkdata endpoint
+    ds.add_new(0x60000010, "US", spec.rows)
+    ds.add_new(0x60000011, "US", spec.columns)
+    ds.add_new(0x60000040, "CS", "G")
+    ds.add_new(0x60000050, "SS", [1, 1])
+    ds.add_new(0x60000100, "US", 1)
+    ds.add_new(0x60000102, "US", 0)
+    ds.add_new(0x60003000, "OW", rng.integers(0, 256, spec.rows * spec.columns // 8, dtype=np.uint8).tobytes())
+
+    pixels = _pixels(rng, frames, spec.rows, spec.columns, z)
+    if multiframe:
+        ds.NumberOfFrames = frames
+    else:
+        pixels = pixels[0]
+    ds.PixelData = pixels.tobytes()
+    if kind.startswith("rle"):
+        ds.compress(RLELossless, pixels, generate_instance_uid=False)
+    return ds, pixels
+
+
+def generate(spec: ArchiveSpec) -> Tuple[Manifest, Iterator[Tuple[str, bytes]]]:
+    """Return the archive's manifest and a lazy iterator of ``(filename, file bytes)``."""
+    manifest = Manifest()
+    plan = []
+    for study in range(spec.studies):
+        for series in range(spec.series_per_study):
+            kind = spec.series_kind(series)
+            count = 1 if kind.endswith("multiframe") else spec.instances_per_series
+            info = SeriesInfo(
+                _uid(spec.seed, "study", study),
+                _uid(spec.seed, "series", study, series),
+                kind,
+                [_uid(spec.seed, "instance", study, series, n) for n in range(count)],
+                spec.frames if kind.endswith("multiframe") else 1,
+            )
+            manifest.series.append(info)
+            plan.extend((study, series, n, kind) for n in range(count))
+
+    def files() -> Iterator[Tuple[str, bytes]]:
+        for study, series, instance, kind in plan:
+            ds, _ = _dataset(spec, study, series, instance, kind)
+            buffer = io.BytesIO()
+            ds.save_as(buffer, enforce_file_format=True)
+            yield f"{study}_{series}_{instance}.dcm", buffer.getvalue()
+
+    return manifest, files()
@@ -0,0 +1,288 @@
+"""A local Q/R SCP standing in for a PACS, and a check of the caching proxy against it: ``python -m benchmarks.pacs``
+
+``python -m benchmarks.pacs`` serves a synthetic archive (all studies of one
+patient) from an in-process stand-in, points the app's PACS proxy at it and
+times a cold QIDO search, a cached repeat, concurrent first opens of a study
+(joined into one retrieve) and the prefetch of the patient's prior studies.
+``python -m benchmarks.pacs serve`` only runs the stand-in, for pointing a
+separately started server at it.
+"""
+
+import argparse
+import asyncio
+import fnmatch
+import io
+import os
+import socket
+import sys
+import tempfile
+import time
+from collections import Counter
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import httpx
+from pydicom import dcmread
+from pydicom.dataset import Dataset
+from pynetdicom import AE, ALL_TRANSFER_SYNTAXES, StoragePresentationContexts, evt
+from pynetdicom.sop_class import (
+    StudyRootQueryRetrieveInformationModelFind,
+    StudyRootQueryRetrieveInformationModelGet,
+    StudyRootQueryRetrieveInformationModelMove,
+    Verification,
+)
+
+from benchmarks.generator import ArchiveSpec, generate
+from benchmarks.scenarios import API
+
+LEVEL_KEYS = {"STUDY": "StudyInstanceUID", "SERIES": "SeriesInstanceUID", "IMAGE": "SOPInstanceUID"}
+
+
+class PacsStandIn:
+    """C-ECHO, C-FIND, C-GET and C-MOVE (Study Root) over instances held in memory.
+
+    Matching covers what the proxy sends: single values, UID lists,
+    ``*``/``?`` wildcards, date ranges and ModalitiesInStudy. ``requests``
+    counts the operations received, so callers can check what was cached or
+    joined.
+    """
+
+    def __init__(self, files: Iterable[Tuple[str, bytes]], ae_title: str = "PACS", destinations: Optional[Dict[str, Tuple[str, int]]] = None):
+        self.instances: List[Dataset] = [dcmread(io.BytesIO(content)) for _, content in files]
+        self.ae_title = ae_title
+        self.destinations = destinations or {}
+        self.requests: Counter = Counter()
+        self._server = None
+
+    @property
+    def address(self) -> Tuple[str, int]:
+        return self._server.server_address
+
+    def start(self, host: str = "127.0.0.1", port: int = 0) -> None:
+        ae = AE(ae_title=self.ae_title)
+        ae.maximum_pdu_size = 0
+        ae.add_supported_context(Verification)
+        ae.add_supported_context(StudyRootQueryRetrieveInformationModelFind)
+        ae.add_supported_context(StudyRootQueryRetrieveInformationModelGet)
+        ae.add_supported_context(StudyRootQueryRetrieveInformationModelMove)
+        for context in StoragePresentationContexts:
+            # The C-GET requestor acts as Storage SCP on our association
+            ae.add_supported_context(context.abstract_syntax, ALL_TRANSFER_SYNTAXES, scu_role=False, scp_role=True)
+        # C-MOVE sub-operations go out on a new association to the destination, one context per stored encoding
+        for sop_class, transfer_syntax in sorted({(ds.SOPClassUID, ds.file_meta.TransferSyntaxUID) for ds in self.instances}):
+            ae.add_requested_context(sop_class, transfer_syntax)
+        self._server = ae.start_server(
+            (host, port),
+            block=False,
+            evt_handlers=[(evt.EVT_C_FIND, self._on_find), (evt.EVT_C_GET, self._on_get), (evt.EVT_C_MOVE, self._on_move)],
+        )
+
+    def shutdown(self) -> None:
+        if self._server is not None:
+            self._server.shutdown()
+            self._server = None
+
+    # ---------- Handlers ----------
+
+    def _on_find(self, event):
+        self.requests["find"] += 1
+        identifier = event.identifier
+        level = identifier.QueryRetrieveLevel
+        seen = set()
+        for ds in self.instances:
+            key = str(ds[LEVEL_KEYS[level]].value)
+            if key in seen or not self._matches(ds, identifier):
+                continue
+            seen.add(key)
+            if event.is_cancelled:
+                yield 0xFE00, None
+                return
+            yield 0xFF00, self._response(ds, identifier)
+
+    def _on_get(self, event):
+        self.requests["get"] += 1
+        matches = [ds for ds in self.instances if self._matches(ds, event.identifier)]
+        yield len(matches)
+        for ds in matches:
+            if event.is_cancelled:
+                yield 0xFE00, None
+                return
+            yield 0xFF00, ds
+
+    def _on_move(self, event):
+        self.requests["move"] += 1
+        destination = self.destinations.get(str(event.move_destination).strip())
+        if destination is None:
+            yield None, None  # unknown move destination
+            return
+        yield destination
+        matches = [ds for ds in self.instances if self._matches(ds, event.identifier)]
+        yield len(matches)
+        for ds in matches:
+            if event.is_cancelled:
+                yield 0xFE00, None
+                return
+            yield 0xFF00, ds
+
+    # ---------- Matching ----------
+
+    def _study_instances(self, study_uid: str) -> List[Dataset]:
+        return [ds for ds in self.instances if ds.StudyInstanceUID == study_uid]
+
+    def _value(self, ds: Dataset, keyword: str):
+        if keyword == "ModalitiesInStudy":
+            return sorted({str(i.Modality) for i in self._study_instances(ds.StudyInstanceUID)})
+        if keyword == "NumberOfStudyRelatedSeries":
+            return len({i.SeriesInstanceUID for i in self._study_instances(ds.StudyInstanceUID)})
+        if keyword == "NumberOfStudyRelatedInstances":
+            return len(self._study_instances(ds.StudyInstanceUID))
+        if keyword == "NumberOfSeriesRelatedInstances":
+            return sum(1 for i in self.instances if i.SeriesInstanceUID == ds.SeriesInstanceUID)
+        return ds.get(keyword)
+
+    def _matches(self, ds: Dataset, identifier: Dataset) -> bool:
+        for elem in identifier:
+            if elem.keyword == "QueryRetrieveLevel" or elem.value in (None, "", "*"):
+                continue
+            value = self._value(ds, elem.keyword)
+            wanted = [str(v) for v in elem.value] if elem.VM > 1 else [str(elem.value)]
+            if elem.keyword == "ModalitiesInStudy":
+                if not set(value) & set(wanted):
+                    return False
+                continue
+            value = str(value) if value is not None else ""
+            if elem.VR in ("DA", "TM", "DT") and "-" in wanted[0]:
+                start, end = wanted[0].split("-", 1)
+                if (start and value < start) or (end and value > end):
+                    return False
+            elif not any(fnmatch.fnmatchcase(value, pattern) for pattern in wanted):
+                return False
+        return True
+
+    def _response(self, ds: Dataset, identifier: Dataset) -> Dataset:
+        response = Dataset()
+        for elem in identifier:
+            value = identifier.QueryRetrieveLevel if elem.keyword == "QueryRetrieveLevel" else self._value(ds, elem.keyword)
+            setattr(response, elem.keyword, value)
+        response.RetrieveAETitle = self.ae_title
+        return response
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+async def check(spec: ArchiveSpec, method: str, opens: int) -> int:
+    """Run the proxy against the stand-in; returns the number of failed checks."""
+    manifest, files = generate(spec)
+    scp_port = _free_port()
+    pacs = PacsStandIn(files, destinations={"DICOM_VIEWER": ("127.0.0.1", scp_port)})
+    pacs.start()
+
+    # Settings are read at import time, so configure the app before importing it
+    os.environ["STORAGE_PATH"] = tempfile.mkdtemp(prefix="dicom-pacs-bench-")
+    os.environ.pop("INDEX_PATH", None)
+    os.environ.update({
+        "PACS_HOST": "127.0.0.1",
+        "PACS_PORT": str(pacs.address[1]),
+        "PACS_AE_TITLE": pacs.ae_title,
+        "LOCAL_AE_TITLE": "DICOM_VIEWER",
+        "PACS_RETRIEVE_METHOD": method,
+        "SCP_ENABLED": str(method == "move").lower(),
+        "SCP_PORT": str(scp_port),
+    })
+    from app.main import app
+    from app.services.metadata_index import metadata_index
+    from app.services.pacs_proxy import pacs_proxy
+
+    failures = 0
+
+    def report(name: str, ok: bool, detail: str) -> None:
+        nonlocal failures
+        failures += not ok
+        print(f"{'ok  ' if ok else 'FAIL'} {name}: {detail}")
+
+    async with app.router.lifespan_context(app):
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://benchmark", timeout=None) as client:
+            patient_id = str(pacs.instances[0].PatientID)
+            for attempt in ("cold", "cached"):
+                started = time.perf_counter()
+                response = await client.get(f"{API}/dicomweb/studies", params={"PatientID": patient_id})
+                elapsed = (time.perf_counter() - started) * 1000
+                report(f"QIDO search ({attempt})", len(response.json()) == spec.studies, f"{len(response.json())} studies in {elapsed:.1f} ms")
+            report("C-FIND cache", pacs.requests["find"] == 1, f"{pacs.requests['find']} C-FIND sent to the PACS")
+
+            study_uid = manifest.study_uids[-1]
+            started = time.perf_counter()
+            responses = await asyncio.gather(*(
+                client.get(f"{API}/dicomweb/studies/{study_uid}/metadata") for _ in range(opens)
+            ))
+            elapsed = (time.perf_counter() - started) * 1000
+            statuses = Counter(response.status_code for response in responses)
+            report("first open", statuses == {200: opens}, f"{opens} concurrent requests -> {dict(statuses)} in {elapsed:.1f} ms")
+            report("retrieve joined", pacs.requests[method] == 1, f"{pacs.requests[method]} C-{method.upper()} for {opens} requests")
+
+            priors = manifest.study_uids[:-1][-2:]
+            deadline = time.monotonic() + 60
+            while time.monotonic() < deadline and any(metadata_index.get_study(uid) is None for uid in priors):
+                await asyncio.sleep(0.05)
+            fetched = sum(metadata_index.get_study(uid) is not None for uid in priors)
+            report("prefetch", fetched == len(priors), f"{fetched}/{len(priors)} prior studies archived ahead of time")
+
+            retrieves = pacs.requests[method]
+            series = next((series for series in manifest.series if series.study_uid in priors[-1:]), manifest.series[0])
+            started = time.perf_counter()
+            response = await client.get(
+                f"{API}/dicomweb/studies/{series.study_uid}/series/{series.series_uid}/instances/{series.sop_uids[0]}/frames/1"
+            )
+            elapsed = (time.perf_counter() - started) * 1000
+            report("open prefetched", response.status_code == 200 and pacs.requests[method] == retrieves, f"{response.status_code} in {elapsed:.1f} ms, {pacs.requests[method] - retrieves} retrieves")
+
+            response = await client.get(f"{API}/dicomweb/studies/1.2.3.4.5.6.7.8.9/metadata")
+            report("unknown study", response.status_code == 404, f"{response.status_code}")
+            print("proxy:", pacs_proxy.stats())
+
+    pacs.shutdown()
+    return failures
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.pacs", description="PACS stand-in and proxy check")
+    parser.add_argument("command", nargs="?", choices=("check", "serve"), default="check")
+    parser.add_argument("--studies", type=int, default=3, help="studies of the one synthetic patient")
+    parser.add_argument("--series", type=int, default=2, help="series per study")
+    parser.add_argument("--instances", type=int, default=20, help="instances per series")
+    parser.add_argument("--method", choices=("get", "move"), default="get", help="retrieve with C-GET or C-MOVE")
+    parser.add_argument("--opens", type=int, default=8, help="concurrent first requests for one study")
+    parser.add_argument("--port", type=int, default=11113, help="port of the stand-in (serve)")
+    parser.add_argument("--destination", action="append", default=[], metavar="AE=HOST:PORT", help="C-MOVE destination (serve, repeatable)")
+    args = parser.parse_args(argv)
+
+    spec = ArchiveSpec(
+        studies=args.studies, series_per_study=args.series, instances_per_series=args.instances,
+        kinds=["native", "rle"], patients=1,
+    )
+    if args.command == "check":
+        return 1 if asyncio.run(check(spec, args.method, args.opens)) else 0
+
+    destinations = {}
+    for entry in args.destination:
+        ae_title, address = entry.split("=", 1)
+        host, port = address.rsplit(":", 1)
+        destinations[ae_title] = (host, int(port))
+    _, files = generate(spec)
+    pacs = PacsStandIn(files, destinations=destinations)
+    pacs.start(host="0.0.0.0", port=args.port)
+    print(f"{pacs.ae_title} serving {len(pacs.instances)} instances on port {args.port}")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pacs.shutdown()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,237 @@
+"""Drive the API through an in-process ASGI client and compare runs against a baseline"""
+
+import asyncio
+import os
+import platform
+import resource
+import sys
+import time
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional
+
+import httpx
+import numpy as np
+
+from benchmarks.generator import ArchiveSpec, Manifest, generate
+from benchmarks.scenarios import API, RUNNER_ROUTES, SCENARIOS, Scenario
+
+
+def peak_rss_mb() -> float:
+    """Peak resident set size of this process so far."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+class Result:
+    """Latencies and volume of one scenario."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.latencies: List[float] = []
+        self.errors = 0
+        self.bytes = 0
+        self.items = 0
+        self.elapsed = 0.0
+
+    def record(self, latency: float, response: httpx.Response, items: int = 1) -> None:
+        self.latencies.append(latency)
+        self.bytes += len(response.content)
+        self.items += items
+        if response.status_code >= 400:
+            self.errors += 1
+
+    def summary(self) -> Dict[str, Any]:
+        latencies_ms = np.array(self.latencies) * 1000 if self.latencies else np.zeros(1)
+        p50, p95, p99 = np.percentile(latencies_ms, [50, 95, 99])
+        elapsed = self.elapsed or 1e-9
+        return {
+            "requests": len(self.latencies),
+            "errors": self.errors,
+            "p50_ms": round(float(p50), 3),
+            "p95_ms": round(float(p95), 3),
+            "p99_ms": round(float(p99), 3),
+            "mean_ms": round(float(latencies_ms.mean()), 3),
+            "max_ms": round(float(latencies_ms.max()), 3),
+            "throughput_rps": round(len(self.latencies) / elapsed, 2),
+            "items_per_s": round(self.items / elapsed, 2),
+            "mb_per_s": round(self.bytes / elapsed / 1e6, 2),
+            "peak_rss_mb": peak_rss_mb(),
+        }
+
+
+async def measure(
+    name: str, calls: Iterable[Callable[[], Awaitable[httpx.Response]]], concurrency: int, items: int = 1
+) -> Result:
+    """Run request thunks with bounded concurrency, timing each one."""
+    result = Result(name)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def timed(call: Callable[[], Awaitable[httpx.Response]]) -> None:
+        async with semaphore:
+            started = time.perf_counter()
+            response = await call()
+            result.record(time.perf_counter() - started, response, items)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(timed(call) for call in calls))
+    result.elapsed = time.perf_counter() - started
+    return result
+
+
+class BenchmarkRunner:
+    """Seed a synthetic archive through the upload API, then run every scenario against it."""
+
+    def __init__(
+        self,
+        app,
+        spec: ArchiveSpec,
+        iterations: int = 50,
+        concurrency: int = 1,
+        warmup: int = 3,
+        upload_batch: int = 16,
+        log: Callable[[str], None] = print,
+    ):
+        self.app = app
+        self.spec = spec
+        self.iterations = iterations
+        self.concurrency = concurrency
+        self.warmup = warmup
+        self.upload_batch = upload_batch
+        self.log = log
+
+    def uncovered_routes(self) -> List[str]:
+        covered = {scenario.route for scenario in SCENARIOS} | RUNNER_ROUTES
+        return sorted(path for path in self.app.openapi()["paths"] if path not in covered)
+
+    async def run(self, selected: Optional[List[str]] = None) -> Dict[str, Any]:
+        results: Dict[str, Result] = {}
+        transport = httpx.ASGITransport(app=self.app)
+
+        async with self.app.router.lifespan_context(self.app):
+            async with httpx.AsyncClient(transport=transport, base_url="http://benchmark", timeout=None) as client:
+                manifest, files = generate(self.spec)
+                self.log(f"Uploading {self.spec.instance_count} instances")
+                results["upload"] = await self._upload(client, files)
+
+                for scenario in SCENARIOS:
+                    if selected and not any(pattern in scenario.name for pattern in selected):
+                        continue
+                    reason = scenario.unavailable(self.spec, manifest)
+                    if reason:
+                        self.log(f"Skipping {scenario.name}: {reason}")
+                        continue
+                    if scenario.setup is not None:
+                        await scenario.setup(client, manifest)
+                    results[scenario.name] = await self._run_scenario(client, manifest, scenario)
+                    self.log(f"{scenario.name}: p95 {results[scenario.name].summary()['p95_ms']} ms")
+
+                if not selected or any("upload_folder" in pattern for pattern in selected):
+                    results["upload_folder"] = await self._upload_folder(client)
+                if not selected or any("delete_study" in pattern for pattern in selected):
+                    results["delete_study"] = await self._delete_study(client, manifest)
+
+        return {
+            "spec": self.spec.to_dict(),
+            "settings": {"iterations": self.iterations, "concurrency": self.concurrency, "warmup": self.warmup},
+            "environment": {
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "cpus": os.cpu_count(),
+            },
+            "peak_rss_mb": peak_rss_mb(),
+            "uncovered_routes": self.uncovered_routes(),
+            "results": {name: result.summary() for name, result in results.items()},
+        }
+
+    async def _run_scenario(self, client: httpx.AsyncClient, manifest: Manifest, scenario: Scenario) -> Result:
+        iterations = scenario.iterations or self.iterations
+
+        def call(i: int) -> Callable[[], Awaitable[httpx.Response]]:
+            url, kwargs = scenario.build(manifest, i)
+            return lambda: client.request(scenario.method, url, **kwargs)
+
+        for i in range(self.warmup):
+            await call(i)()
+        return await measure(scenario.name, [call(self.warmup + i) for i in range(iterations)], self.concurrency)
+
+    async def _upload(self, client: httpx.AsyncClient, files: Iterable) -> Result:
+        """Seed the archive in multipart batches; items_per_s is the ingest rate."""
+        result = Result("upload")
+        started = time.perf_counter()
+        batch: List = []
+
+        async def send(parts: List) -> None:
+            t0 = time.perf_counter()
+            response = await client.post(f"{API}/upload/", files=[("files", part) for part in parts])
+            result.record(time.perf_counter() - t0, response, len(parts))
+
+        for filename, content in files:
+            batch.append((filename, content, "application/dicom"))
+            if len(batch) >= self.upload_batch:
+                await send(batch)
+                batch = []
+        if batch:
+            await send(batch)
+        result.elapsed = time.perf_counter() - started
+        return result
+
+    async def _upload_folder(self, client: httpx.AsyncClient) -> Result:
+        """Re-send part of the archive through the folder pipeline, polling the job until it finishes."""
+        _, files = generate(ArchiveSpec(**{**self.spec.to_dict(), "studies": 1}))
+        parts = [("files", (name, content, "application/dicom")) for name, content in files]
+        result = Result("upload_folder")
+        started = time.perf_counter()
+        response = await client.post(f"{API}/upload/folder", files=parts)
+        job_id = response.json()["job_id"]
+        while True:
+            job = await client.get(f"{API}/upload/jobs/{job_id}")
+            if job.json()["status"] not in ("pending", "running"):
+                break
+            await asyncio.sleep(0.01)
+        result.record(time.perf_counter() - started, job, len(parts))
+        result.elapsed = time.perf_counter() - started
+        return result
+
+    async def _delete_study(self, client: httpx.AsyncClient, manifest: Manifest) -> Result:
+        """Delete the last study (runs last, as it changes the archive)."""
+        study_uid = manifest.study_uids[-1]
+        return await measure("delete_study", [lambda: client.delete(f"{API}/studies/{study_uid}")], 1)
+
+
+def compare(
+    report: Dict[str, Any], baseline: Dict[str, Any], threshold: float, min_delta_ms: float = 1.0
+) -> List[str]:
+    """Regressions of ``report`` against ``baseline``.
+
+    A latency percentile regresses when it grows by more than ``threshold``
+    (a fraction) and by more than ``min_delta_ms``, which keeps sub-millisecond
+    noise out. Throughput regresses when it drops by more than ``threshold``
+    and the mean latency grew by more than ``min_delta_ms``.
+    """
+    regressions = []
+    for name, current in report["results"].items():
+        previous = baseline.get("results", {}).get(name)
+        if previous is None:
+            continue
+        for metric in ("p50_ms", "p95_ms", "p99_ms"):
+            before, after = previous[metric], current[metric]
+            if after > before * (1 + threshold) and after - before > min_delta_ms:
+                regressions.append(f"{name}: {metric} {before} -> {after}")
+        before, after = previous["throughput_rps"], current["throughput_rps"]
+        if after < before * (1 - threshold) and current["mean_ms"] - previous["mean_ms"] > min_delta_ms:
+            regressions.append(f"{name}: throughput_rps {before} -> {after}")
+        if current["errors"] > previous["errors"]:
+            regressions.append(f"{name}: errors {previous['errors']} -> {current['errors']}")
+
+    before, after = baseline.get("peak_rss_mb"), report["peak_rss_mb"]
+    if before and after > before * (1 + threshold):
+        regressions.append(f"peak_rss_mb {before} -> {after}")
+    return regressions
+
+
+def format_table(report: Dict[str, Any]) -> str:
+    columns = ("requests", "errors", "p50_ms", "p95_ms", "p99_ms", "throughput_rps", "mb_per_s", "peak_rss_mb")
+    width = max(len(name) for name in report["results"]) + 2
+    lines = ["scenario".ljust(width) + "".join(c.rjust(16) for c in columns)]
+    for name, summary in report["results"].items():
+        lines.append(name.ljust(width) + "".join(str(summary[c]).rjust(16) for c in columns))
+    return "\n".join(lines)
@@ -0,0 +1,275 @@
+"""One benchmark scenario per API route"""
+
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from benchmarks.generator import ArchiveSpec, Manifest, SeriesInfo
+
+
+API = "/api/v1"
+WADO = f"{API}/dicomweb"
+
+# Profiling token the benchmark CLI starts the app with, so the /profiles routes can be exercised
+PROFILE_TOKEN = "benchmark"
+
+# (url, extra httpx request arguments)
+RequestSpec = Tuple[str, Dict]
+
+
+@dataclass
+class Scenario:
+    """A named request pattern against one route.
+
+    ``build`` gets the archive manifest and the iteration number, so
+    successive requests can walk different instances and frames instead of
+    hitting one cached object.
+    """
+
+    name: str
+    route: str  # OpenAPI path the scenario covers
+    build: Callable[[Manifest, int], RequestSpec]
+    method: str = "GET"
+    iterations: Optional[int] = None  # overrides the run's iteration count
+    kinds: List[str] = field(default_factory=list)  # series kinds the scenario needs
+    requires: Optional[Callable[[ArchiveSpec], Optional[str]]] = None  # why the run cannot exercise it, if so
+    setup: Optional[Callable[[Any, Manifest], Awaitable[None]]] = None  # (client, manifest), before warmup
+
+    def unavailable(self, spec: ArchiveSpec, manifest: Manifest) -> Optional[str]:
+        """Why the scenario cannot run against this archive and app, or None."""
+        missing = [kind for kind in self.kinds if not manifest.of_kind(kind)]
+        if missing:
+            return f"archive has no {', '.join(missing)} series"
+        return self.requires(spec) if self.requires else None
+
+
+def _pick(items: list, i: int):
+    return items[i % len(items)]
+
+
+def _series(manifest: Manifest, kind: str, i: int) -> SeriesInfo:
+    return _pick(manifest.of_kind(kind), i)
+
+
+def _instance_url(series: SeriesInfo, sop_uid: str) -> str:
+    return f"{WADO}/studies/{series.study_uid}/series/{series.series_uid}/instances/{sop_uid}"
+
+
+def _walk(manifest: Manifest, kind: str, i: int) -> Tuple[SeriesInfo, str]:
+    """The i-th instance over all series of a kind, cycling."""
+    instances = [(s, sop) for s in manifest.of_kind(kind) for sop in s.sop_uids]
+    return _pick(instances, i)
+
+
+def _frame(manifest: Manifest, kind: str, i: int, **kwargs) -> RequestSpec:
+    series, sop_uid = _walk(manifest, kind, i)
+    frame = i % series.frames + 1
+    return f"{_instance_url(series, sop_uid)}/frames/{frame}", kwargs
+
+
+def _study(manifest: Manifest, i: int) -> str:
+    return _pick(manifest.study_uids, i)
+
+
+def _needs_levels(spec: ArchiveSpec) -> Optional[str]:
+    from app.services.pyramid import level_count
+
+    if level_count(spec.rows, spec.columns) == 0:
+        return f"{spec.rows}x{spec.columns} frames have no reduced resolution levels"
+    return None
+
+
+def _needs_metrics(spec: ArchiveSpec) -> Optional[str]:
+    from app.config import settings
+
+    return None if settings.METRICS_ENABLED else "metrics are disabled"
+
+
+def _needs_profiling(spec: ArchiveSpec) -> Optional[str]:
+    from app.config import settings
+
+    return None if settings.PROFILING_TOKEN == PROFILE_TOKEN else "the app was not started with the benchmark profiling token"
+
+
+async def _store_profile(client, manifest: Manifest) -> None:
+    """Profile one request, so there is a report to fetch."""
+    response = await client.get("/health", headers={"X-Profile": PROFILE_TOKEN})
+    manifest.context["profile_id"] = response.headers["x-profile-id"]
+
+
+SCENARIOS: List[Scenario] = [
+    # Service
+    Scenario("health", "/health", lambda m, i: ("/health", {})),
+    Scenario("cache_stats", "/cache/stats", lambda m, i: ("/cache/stats", {})),
+    Scenario("executor_stats", "/executor/stats", lambda m, i: ("/executor/stats", {})),
+    Scenario("frame_stats", "/frames/stats", lambda m, i: ("/frames/stats", {})),
+    Scenario("scp_stats", "/scp/stats", lambda m, i: ("/scp/stats", {})),
+    Scenario("pacs_stats", "/pacs/stats", lambda m, i: ("/pacs/stats", {})),
+    Scenario("archive_stats", "/archive/stats", lambda m, i: ("/archive/stats", {})),
+    Scenario("metrics", "/metrics", lambda m, i: ("/metrics", {}), requires=_needs_metrics),
+    # Incremental pass over an unchanged archive: directory stats only
+    Scenario("archive_reconcile", "/archive/reconcile", lambda m, i: ("/archive/reconcile", {}), method="POST"),
+    # Profiling: the cost of a profiled request, and reading reports back
+    Scenario(
+        "profiled_frame", f"{WADO}/studies/{{study_uid}}/series/{{series_uid}}/instances/{{sop_uid}}/frames/{{frames}}",
+        lambda m, i: _frame(m, "native", i, headers={"X-Profile": PROFILE_TOKEN}),
+        kinds=["native"], requires=_needs_profiling,
+    ),
+    Scenario(
+        "list_profiles", "/profiles",
+        lambda m, i: ("/profiles", {"headers": {"X-Profile": PROFILE_TOKEN}}), requires=_needs_profiling,
+    ),
+    Scenario(
+        "get_profile", "/profiles/{profile_id}",
+        lambda m, i: (f"/profiles/{m.context['profile_id']}", {"headers": {"X-Profile": PROFILE_TOKEN}}),
+        requires=_needs_profiling, setup=_store_profile,
+    ),
+    # Study browser API
+    Scenario("list_studies", f"{API}/studies/", lambda m, i: (f"{API}/studies/", {})),
+    Scenario("get_study", f"{API}/studies/{{study_uid}}", lambda m, i: (f"{API}/studies/{_study(m, i)}", {})),
+    Scenario(
+        "get_series", f"{API}/studies/{{study_uid}}/series/{{series_uid}}",
+        lambda m, i: (f"{API}/studies/{_pick(m.series, i).study_uid}/series/{_pick(m.series, i).series_uid}", {}),
+    ),
+    # QIDO-RS
+    Scenario(
+        "qido_studies", f"{WADO}/studies",
+        lambda m, i: (f"{WADO}/studies", {"params": {"PatientName": "BENCH*", "StudyDate": "20240101-20241231"}}),
+    ),
+    Scenario("qido_all_series", f"{WADO}/series", lambda m, i: (f"{WADO}/series", {"params": {"Modality": "CT"}})),
+    Scenario(
+        "qido_series", f"{WADO}/studies/{{study_uid}}/series",
+        lambda m, i: (f"{WADO}/studies/{_study(m, i)}/series", {}),
+    ),
+    Scenario(
+        "qido_all_instances", f"{WADO}/instances",
+        lambda m, i: (f"{WADO}/instances", {"params": {"limit": "100", "includefield": "all"}}),
+    ),
+    Scenario(
+        "qido_study_instances", f"{WADO}/studies/{{study_uid}}/instances",
+        lambda m, i: (f"{WADO}/studies/{_study(m, i)}/instances", {}),
+    ),
+    Scenario(
+        "qido_series_instances", f"{WADO}/studies/{{study_uid}}/series/{{series_uid}}/instances",
+        lambda m, i: (f"{WADO}/studies/{_pick(m.series, i).study_uid}/series/{_pick(m.series, i).series_uid}/instances", {}),
+    ),
+    # WADO-RS metadata
+    Scenario(
+        "instance_metadata", f"{WADO}/studies/{{study_uid}}/series/{{series_uid}}/instances/{{sop_uid}}/metadata",
+        lambda m, i: (f"{_instance_url(*_walk(m, 'native', i))}/metadata", {}), kinds=["native"],
+    ),
+    Scenario(
+        "series_metadata", f"{WADO}/studies/{{study_uid}}/series/{{series_uid}}/metadata",
+        lambda m, i: (f"{WADO}/studies/{_pick(m.series, i).study_uid}/series/{_pick(m.series, i).series_uid}/metadata", {}),
+    ),
+    Scenario(
+        "study_metadata", f"{WADO}/studies/{{study_uid}}/metadata",
+        lambda m, i: (f"{WADO}/studies/{_study(m, i)}/metadata", {}),
+    ),
+    # WADO-RS retrieve
+    Scenario(
+        "retrieve_instance", f"{WADO}/studies/{{study_uid}}/series/{{series_uid}}/instances/{{sop_uid}}",
+        lambda m, i: (_instance_url(*_walk(m, "native", i)), {}), kinds=["native"],
+    ),
+    Scenario(
+        "retrieve_series", f"{WADO}/studies/{{study_uid}}/series/{{series_uid}}",
+        lambda m, i: (f"{WADO}/studies/{_series(m, 'native', i).study_uid}/series/{_series(m, 'native', i).series_uid}", {}),
+        kinds=["native"],
+    ),
+    Scenario(
+        "retrieve_study", f"{WADO}/studies/{{study_uid}}",
+        lambda m, i: (f"{WADO}/studies/{_study(m, i)}", {}), iterations=5,
+    ),
+    Scenario(
+        "bulkdata", f"{WADO}/studies/{{study_uid}}/series/{{series_uid}}/instances/{{sop_uid}}/bulkdata/{{tag_path}}",
+        lambda m, i: (f"{_instance_url(*_walk(m, 'native', i))}/bulkdata/60003000", {}), kinds=["native"],
+    ),
+    # Frames
+    Scenario(
+        "frame_native", f"{WADO}/studies/{{study_uid}}/series/{{series_uid}}/instances/{{sop_uid}}/frames/{{frames}}",
+        lambda m, i: _frame(m, "native", i), kinds=["native"],
+    ),
+    Scenario(
+        "frame_native_multiframe", f"{WADO}/studies/{{study_uid}}/series/{{series_uid}}/instances/{{sop_uid}}/frames/{{frames}}",
+        lambda m, i: _frame(m, "native-multiframe", i), kinds=["native-multiframe"],
+    ),
+    Scenario(
+        "frame_rle_decoded", f"{WADO}/studies/{{study_uid}}/series/{{series_uid}}/instances/{{sop_uid}}/frames/{{frames}}",
+        lambda m, i: _frame(m, "rle", i), kinds=["rle"],
+    ),
+    Scenario(
+        "frame_rle_passthrough", f"{WADO}/studies/{{study_uid}}/series/{{series_uid}}/instances/{{sop_uid}}/frames/{{frames}}",
+        lambda m, i: _frame(m, "rle-multiframe", i, headers={"Accept": "image/x-dicom-rle"}), kinds=["rle-multiframe"],
+    ),
+    Scenario(
+        "frame_level", f"{WADO}/studies/{{study_uid}}/series/{{series_uid}}/instances/{{sop_uid}}/frames/{{frames}}",
+        lambda m, i: _frame(m, "native", i, params={"level": "1"}), kinds=["native"], requires=_needs_levels,
+    ),
+    Scenario(
+        "frames_multipart", f"{WADO}/studies/{{study_uid}}/series/{{series_uid}}/instances/{{sop_uid}}/frames/{{frames}}",
+        lambda m, i: (f"{_instance_url(*_walk(m, 'native-multiframe', i))}/frames/1,2,3", {}),
+        kinds=["native-multiframe"],
+    ),
+    # Volumes and reformatting
+    Scenario(
+        "volume", f"{WADO}/studies/{{study_uid}}/series/{{series_uid}}/volume",
+        lambda m, i: (f"{WADO}/studies/{_series(m, 'native', i).study_uid}/series/{_series(m, 'native', i).series_uid}/volume", {}),
+        kinds=["native"],
+    ),
+    Scenario(
+        "reformat_coronal", f"{WADO}/studies/{{study_uid}}/series/{{series_uid}}/reformat",
+        lambda m, i: (
+            f"{WADO}/studies/{_series(m, 'rle', i).study_uid}/series/{_series(m, 'rle', i).series_uid}/reformat",
+            {"params": {"plane": "coronal", "position": str(i % 64)}, "headers": {"Accept": "image/png"}},
+        ),
+        kinds=["rle"],
+    ),
+    Scenario(
+        "reformat_oblique_mip", f"{WADO}/studies/{{study_uid}}/series/{{series_uid}}/reformat",
+        lambda m, i: (
+            f"{WADO}/studies/{_series(m, 'native', i).study_uid}/series/{_series(m, 'native', i).series_uid}/reformat",
+            {"params": {"plane": "oblique", "row": "1,1,0", "column": "0,0,1", "thickness": "10", "mode": "mip"},
+             "headers": {"Accept": "application/octet-stream"}},
+        ),
+        kinds=["native"],
+    ),
+    # Rendered images and thumbnails
+    Scenario(
+        "rendered_frame",
+        f"{WADO}/studies/{{study_uid}}/series/{{series_uid}}/instances/{{sop_uid}}/frames/{{frame}}/rendered",
+        lambda m, i: (f"{_frame(m, 'rle-multiframe', i)[0]}/rendered", {"params": {"window": f"{40 + i},400"}}),
+        kinds=["rle-multiframe"],
+    ),
+    Scenario(
+        "rendered_instance", f"{WADO}/studies/{{study_uid}}/series/{{series_uid}}/instances/{{sop_uid}}/rendered",
+        lambda m, i: (f"{_instance_url(*_walk(m, 'native', i))}/rendered", {"params": {"viewport": "128,128"}}),
+        kinds=["native"],
+    ),
+    Scenario(
+        "rendered_series", f"{WADO}/studies/{{study_uid}}/series/{{series_uid}}/rendered",
+        lambda m, i: (f"{WADO}/studies/{_pick(m.series, i).study_uid}/series/{_pick(m.series, i).series_uid}/rendered", {}),
+    ),
+    Scenario(
+        "rendered_study", f"{WADO}/studies/{{study_uid}}/rendered",
+        lambda m, i: (f"{WADO}/studies/{_study(m, i)}/rendered", {}),
+    ),
+    Scenario(
+        "thumbnail_instance", f"{WADO}/studies/{{study_uid}}/series/{{series_uid}}/instances/{{sop_uid}}/thumbnail",
+        lambda m, i: (f"{_instance_url(*_walk(m, 'native', i))}/thumbnail", {}), kinds=["native"],
+    ),
+    Scenario(
+        "thumbnail_series", f"{WADO}/studies/{{study_uid}}/series/{{series_uid}}/thumbnail",
+        lambda m, i: (f"{WADO}/studies/{_pick(m.series, i).study_uid}/series/{_pick(m.series, i).series_uid}/thumbnail", {}),
+    ),
+    Scenario(
+        "thumbnail_study", f"{WADO}/studies/{{study_uid}}/thumbnail",
+        lambda m, i: (f"{WADO}/studies/{_study(m, i)}/thumbnail", {}),
+    ),
+]
+
+# Routes covered by the runner itself: uploads seed the archive, and deletion runs last
+RUNNER_ROUTES = {
+    f"{API}/upload/",
+    f"{API}/upload/folder",
+    f"{API}/upload/jobs/{{job_id}}",
+    f"{API}/studies/{{study_uid}}",  # DELETE
+}